@@ -0,0 +1,341 @@
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import re
+import time
+from collections import deque
+
+import openai
+
+from metrics import BACKEND_CALLS
+from upstream import DeadlineExceeded, LatencyWindow
+
+# ===================================================================
+# BACKEND INTERFACE
+# ===================================================================
+
+class Unsupported(Exception):
+    """The backend can't serve this kind of call (e.g. structured output); not a health failure."""
+
+
+class ImageBackend:
+    """Produces one image per call. ``name`` identifies it in config and metrics."""
+
+    kind = "image"
+
+    def __init__(self, name: str):
+        self.name = name
+
+    async def generate(self, prompt: str, size: str) -> str:
+        """Return one image as base64-encoded PNG."""
+        raise NotImplementedError
+
+
+class TextBackend:
+    kind = "text"
+
+    def __init__(self, name: str):
+        self.name = name
+
+    async def complete(self, prompt: str, json_mode: bool = False, schema: dict | None = None, system: str | None = None) -> str:
+        """Completion text; ``schema`` (a named JSON schema) asks for structured output."""
+        raise NotImplementedError
+
+    async def stream(self, prompt: str):
+        """Open a completion stream; returns an async iterator of text deltas."""
+        raise NotImplementedError
+
+
+# ===================================================================
+# OPENAI
+# ===================================================================
+
+class OpenAIImageBackend(ImageBackend):
+    # ``client`` is a zero-argument callable returning the AsyncOpenAI client,
+    # looked up per call so the client can be swapped (tests, lazy construction)
+
+    def __init__(self, upstream, client, model: str):
+        super().__init__(f"openai:{model}")
+        self.upstream = upstream
+        self.client = client
+        self.model = model
+
+    async def generate(self, prompt, size):
+        response = await self.upstream.call(f"images.{self.model}", lambda timeout: self.client().images.generate(
+            model=self.model,
+            prompt=prompt,
+            n=1,
+            size=size,
+            response_format="b64_json",
+            timeout=timeout,
+        ))
+        return response.data[0].b64_json
+
+
+class OpenAITextBackend(TextBackend):
+    def __init__(self, upstream, client, model: str):
+        super().__init__(f"openai:{model}")
+        self.upstream = upstream
+        self.client = client
+        self.model = model
+        # Cleared the first time the model rejects a json_schema response_format
+        self.structured_output = True
+
+    async def complete(self, prompt, json_mode=False, schema=None, system=None):
+        if schema is not None and not self.structured_output:
+            raise Unsupported(f"{self.name} does not support structured output")
+        try:
+            return await self._complete(prompt, json_mode, schema, system)
+        except openai.BadRequestError as e:
+            if schema is None or ("response_format" not in str(e) and "json_schema" not in str(e)):
+                raise
+            self.structured_output = False
+            raise Unsupported(f"{self.name} does not support structured output") from e
+
+    async def _complete(self, prompt, json_mode, schema, system):
+        extra = {}
+        if schema is not None:
+            extra["response_format"] = {"type": "json_schema", "json_schema": {**schema, "strict": True}}
+        elif json_mode:
+            extra["response_format"] = {"type": "json_object"}
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.append({"role": "user", "content": prompt})
+        response = await self.upstream.call(f"captions.{self.model}", lambda timeout: self.client().chat.completions.create(
+            model=self.model,
+            messages=messages,
+            timeout=timeout,
+            **extra,
+        ))
+        return response.choices[0].message.content or ""
+
+    async def stream(self, prompt):
+        # Only opening the stream is retried; hedging would double-bill every token
+        stream = await self.upstream.call(f"captions_stream.{self.model}", lambda timeout: self.client().chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            stream=True,
+            timeout=timeout,
+        ), hedge=False)
+        return _deltas(stream)
+
+
+async def _deltas(stream):
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            yield delta
+
+
+# ===================================================================
+# LOCAL STUB - deterministic output, no network; for development and tests
+# ===================================================================
+
+ONE_PIXEL_PNG = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+
+
+def _stub_png(prompt: str, size: str) -> str:
+    try:
+        from PIL import Image
+    except ImportError:
+        return ONE_PIXEL_PNG
+    digest = hashlib.sha256(f"{prompt}|{size}".encode("utf-8")).digest()
+    try:
+        width, height = (int(v) for v in size.split("x"))
+    except ValueError:
+        width = height = 1024
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), tuple(digest[:3])).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class StubImageBackend(ImageBackend):
+    """A solid-colour PNG of the requested size whose colour is derived from the prompt."""
+
+    def __init__(self, name="stub"):
+        super().__init__(name)
+
+    async def generate(self, prompt, size):
+        return await asyncio.to_thread(_stub_png, prompt, size)
+
+
+class StubTextBackend(TextBackend):
+    """Numbered captions (or the merged / structured JSON shapes) derived from the prompt."""
+
+    CAPTION_COUNT = re.compile(r"Write EXACTLY (\d+)")
+    SECTION_ID = re.compile(r'^### Section id: "([^"]+)" \((\d+) captions\)', re.MULTILINE)
+    HASHTAG_RANGE = re.compile(r"(\d+)[–-](\d+) (?:relevant )?hashtags")
+
+    def __init__(self, name="stub"):
+        super().__init__(name)
+
+    @classmethod
+    def _hashtags(cls, prompt: str, index: int) -> list[str]:
+        # As few as the platform rules in the prompt allow (but at least two)
+        match = cls.HASHTAG_RANGE.search(prompt)
+        count = max(2, int(match.group(1))) if match else 2
+        tag = hashlib.sha256(f"{prompt}|{index}".encode("utf-8")).hexdigest()[:6]
+        return ["#Spark", f"#Stub{tag}"] + [f"#Campaign{i}" for i in range(1, count - 1)]
+
+    @classmethod
+    def _caption(cls, prompt: str, index: int) -> str:
+        return f"Stub caption {index} for your campaign. " + " ".join(cls._hashtags(prompt, index))
+
+    def _text(self, prompt, json_mode, schema=None):
+        counts = self.CAPTION_COUNT.findall(prompt)
+        # The last count wins: repair prompts append "Write EXACTLY <k> replacement captions"
+        n = int(counts[-1]) if counts else 1
+        if schema is not None:
+            return json.dumps({"captions": [
+                {"body": f"Stub caption {i} for your campaign.", "hashtags": self._hashtags(prompt, i)}
+                for i in range(1, n + 1)
+            ]})
+        if json_mode:
+            return json.dumps({
+                section_id: [self._caption(section_id + prompt, i) for i in range(1, int(n) + 1)]
+                for section_id, n in self.SECTION_ID.findall(prompt)
+            })
+        return "\n\n\n".join(f"Caption {i}: {self._caption(prompt, i)}" for i in range(1, n + 1))
+
+    async def complete(self, prompt, json_mode=False, schema=None, system=None):
+        return self._text(prompt, json_mode, schema)
+
+    async def stream(self, prompt):
+        text = self._text(prompt, False)
+
+        async def chunks():
+            for start in range(0, len(text), 16):
+                yield text[start:start + 16]
+
+        return chunks()
+
+
+def build_backend(spec: str, kind: str, upstream=None, client=None):
+    """``"openai:<model>"`` or ``"stub"`` to an image or text backend."""
+    provider, _, model = spec.strip().partition(":")
+    if provider == "stub":
+        return StubImageBackend(spec) if kind == "image" else StubTextBackend(spec)
+    if provider == "openai" and model:
+        cls = OpenAIImageBackend if kind == "image" else OpenAITextBackend
+        return cls(upstream, client, model)
+    raise ValueError(f"Unknown {kind} backend: {spec!r}")
+
+
+# ===================================================================
+# ROUTER
+# ===================================================================
+
+class BackendHealth:
+    """Rolling latency of successful calls and outcomes from the last ``window`` seconds."""
+
+    def __init__(self, window=60.0):
+        self.window = window
+        self.latency = LatencyWindow(size=100)
+        self._outcomes = deque()
+
+    def record(self, ok: bool, seconds: float):
+        now = time.monotonic()
+        self._outcomes.append((now, ok))
+        if ok:
+            self.latency.add(seconds)
+        self._expire(now)
+
+    def _expire(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._outcomes.popleft()
+
+    def error_rate(self) -> tuple[float, int]:
+        self._expire(time.monotonic())
+        total = len(self._outcomes)
+        if not total:
+            return 0.0, 0
+        return sum(1 for _, ok in self._outcomes if not ok) / total, total
+
+
+class NoBackendAvailable(Exception):
+    pass
+
+
+class BackendRouter:
+    """Sends each call to the fastest healthy backend, falling back on failure.
+
+    Candidates are ordered by (unhealthy, preference tier, median latency).
+    A backend is unhealthy once at least ``min_samples`` calls in the last
+    ``window`` seconds failed at ``max_error_rate`` or more; since old outcomes
+    expire, an unhealthy backend is tried again after a quiet window.
+    ``preferences`` maps a platform to backend names to try before the rest.
+    Backends without latency samples sort first so new ones get measured.
+    """
+
+    def __init__(self, backends, preferences=None, window=60.0, max_error_rate=0.5, min_samples=3):
+        self.backends = {}
+        self.health = {}
+        self.preferences = {k.lower(): list(v) for k, v in (preferences or {}).items()}
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        for backend in backends:
+            self.register(backend)
+
+    def register(self, backend):
+        self.backends[backend.name] = backend
+        self.health.setdefault(backend.name, BackendHealth(self.window))
+
+    def healthy(self, name: str) -> bool:
+        rate, samples = self.health[name].error_rate()
+        return samples < self.min_samples or rate < self.max_error_rate
+
+    def configured(self, platform: str | None = None) -> list[str]:
+        """Backend names a platform may use, preferred first (stable; used for cache keys)."""
+        preferred = [n for n in self.preferences.get((platform or "").lower(), ()) if n in self.backends]
+        return preferred + [n for n in self.backends if n not in preferred]
+
+    def candidates(self, platform: str | None = None) -> list:
+        names = self.configured(platform)
+        preferred = set(self.preferences.get((platform or "").lower(), ()))
+
+        def score(name):
+            median = self.health[name].latency.percentile(0.5)
+            tier = 0 if not preferred or name in preferred else 1
+            return (not self.healthy(name), tier, median or 0.0)
+
+        return [self.backends[name] for name in sorted(names, key=score)]
+
+    async def call(self, platform, fn):
+        """Await ``fn(backend)`` on the best candidate, moving down the list while calls fail."""
+        error = None
+        for backend in self.candidates(platform):
+            started = time.monotonic()
+            try:
+                result = await fn(backend)
+            except DeadlineExceeded:
+                # No time left for anyone else either
+                raise
+            except Unsupported as e:
+                # Try the next backend, but this one isn't failing
+                error = error or e
+                continue
+            except Exception as e:
+                self.health[backend.name].record(False, time.monotonic() - started)
+                BACKEND_CALLS.inc(kind=backend.kind, backend=backend.name, outcome="error")
+                error = error or e
+                continue
+            self.health[backend.name].record(True, time.monotonic() - started)
+            BACKEND_CALLS.inc(kind=backend.kind, backend=backend.name, outcome="ok")
+            return result
+        if error is None:
+            raise NoBackendAvailable("No generation backend configured")
+        raise error
+
+    def stats(self) -> dict:
+        stats = {}
+        for name, health in self.health.items():
+            rate, samples = health.error_rate()
+            stats[name] = {
+                "healthy": self.healthy(name),
+                "error_rate": round(rate, 3),
+                "calls": samples,
+                "p50_s": health.latency.percentile(0.5),
+            }
+        return stats
@@ -0,0 +1,92 @@
+"""Micro-benchmark for the prompt builders: prompts/sec and memory per build.
+
+    python benchmarks/bench_prompts.py [--iterations 50000]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import GenerateRequest  # noqa: E402
+from prompt import build_caption_prompt, build_image_prompt  # noqa: E402
+
+PLATFORMS = ["linkedin", "instagram", "twitter", "x", "facebook"]
+
+
+def sample_requests():
+    return [
+        GenerateRequest(
+            username="bench",
+            platform=platform,
+            company="Spark Studio",
+            event="Product Launch",
+            title="Introducing AI Platform",
+            product_description="An AI marketing platform that plans, writes and designs campaigns.",
+            num_captions=4,
+            Target_audience="Marketing managers at B2B tech companies",
+            Product="Spark AI",
+            Style="minimalist",
+            color="blue, white, gold",
+            mood="energetic",
+            call_to_action="Sign up free",
+        )
+        for platform in PLATFORMS
+    ]
+
+
+def image_build(req):
+    return build_image_prompt(req)
+
+
+def caption_build(req):
+    return build_caption_prompt(
+        req.platform, req.company, req.event, req.title, req.product_description,
+        req.num_captions, req.Target_audience, req.Product, req.call_to_action,
+    )
+
+
+def throughput(fn, requests, iterations):
+    count = 0
+    started = time.perf_counter()
+    for i in range(iterations):
+        fn(requests[i % len(requests)])
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def allocations(fn, requests, iterations):
+    # Blocks/bytes allocated while building, averaged per build (peak is a single build's worst case)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    results = [fn(requests[i % len(requests)]) for i in range(iterations)]
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, "filename")
+    blocks = sum(s.count_diff for s in stats if s.count_diff > 0)
+    size = sum(s.size_diff for s in stats if s.size_diff > 0)
+    del results
+    return blocks / iterations, size / iterations, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=50_000)
+    args = parser.parse_args()
+
+    requests = sample_requests()
+    print(f"{'builder':<16}{'prompts/sec':>14}{'blocks/build':>14}{'bytes/build':>14}")
+    for name, fn in (("image_prompt", image_build), ("caption_prompt", caption_build)):
+        fn(requests[0])  # warm up
+        rate = throughput(fn, requests, args.iterations)
+        blocks, size, _ = allocations(fn, requests, min(args.iterations, 5_000))
+        print(f"{name:<16}{rate:>14,.0f}{blocks:>14.1f}{size:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
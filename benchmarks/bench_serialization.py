@@ -0,0 +1,96 @@
+"""Benchmark for /generate responses: serialization time and payload size per encoding and field selection.
+
+    python benchmarks/bench_serialization.py [--iterations 20000] [--images 4] [--captions 5]
+"""
+import argparse
+import gzip
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main opens its history / retention databases at import time
+_tmp = tempfile.mkdtemp(prefix="spark-bench-")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("SPARK_HISTORY_DB", os.path.join(_tmp, "history.db"))
+os.environ.setdefault("SPARK_RETENTION_DB", os.path.join(_tmp, "images.db"))
+os.environ.setdefault("SPARK_CACHE_DIR", os.path.join(_tmp, "cache"))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse, ORJSONResponse  # noqa: E402
+
+from benchmarks.bench_prompts import sample_requests  # noqa: E402
+from compression import CompressionMiddleware, brotli  # noqa: E402
+from main import assemble_result, build_prompts, select_fields  # noqa: E402
+from models import Caption  # noqa: E402
+
+CAPTION_BODY = (
+    "Launch day is here! Meet the platform that turns a one-line brief into a full campaign: "
+    "copy, visuals and a posting plan, tuned for every channel your audience lives on."
+)
+
+
+def sample_result(images: int, captions: int) -> dict:
+    request = sample_requests()[1].model_copy(update={"num_images": images, "num_captions": captions})
+    image_prompt, caption_prompt, size = build_prompts(request)
+    variants = [
+        {
+            "original": f"bench_generated_images/{i:032x}.png",
+            "webp": f"bench_generated_images/{i:032x}.webp",
+            "thumbnail": f"bench_generated_images/{i:032x}_thumb.webp",
+        }
+        for i in range(images)
+    ]
+    tags = [f"#Tag{i}" for i in range(10)]
+    caption_list = [Caption(body=CAPTION_BODY, hashtags=tags, char_count=len(CAPTION_BODY) + 60) for _ in range(captions)]
+    result = assemble_result(image_prompt, caption_prompt, size, variants, None, caption_list)
+    return {**result, "cache": "miss", "campaign_id": "0" * 32}
+
+
+def time_per_call(fn, iterations) -> float:
+    fn()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20_000)
+    parser.add_argument("--images", type=int, default=4)
+    parser.add_argument("--captions", type=int, default=5)
+    args = parser.parse_args()
+
+    result = sample_result(args.images, args.captions)
+
+    print("Serialization (us per response)")
+    serializers = {
+        "jsonable_encoder + JSONResponse (FastAPI default)": lambda: JSONResponse(jsonable_encoder(result)),
+        "JSONResponse": lambda: JSONResponse(result),
+        "ORJSONResponse": lambda: ORJSONResponse(result),
+    }
+    for name, fn in serializers.items():
+        print(f"  {name:<52}{time_per_call(fn, args.iterations):>10.1f}")
+
+    compressor = CompressionMiddleware(None)
+    encodings = ["identity", "gzip"] + (["br"] if brotli is not None else [])
+    shapes = {
+        "full": result,
+        "include_prompts=false": select_fields(result, include_prompts=False),
+        "fields=images,captions": select_fields(result, "images,captions"),
+    }
+
+    print("\nPayload bytes" + ("" if brotli is not None else " (brotli not installed)"))
+    print(f"  {'shape':<26}" + "".join(f"{e:>12}" for e in encodings) + f"{'gzip us':>12}")
+    for name, body in shapes.items():
+        raw = ORJSONResponse(body).body
+        sizes = [len(raw)] + [len(compressor.compress(e, raw)) for e in encodings[1:]]
+        gzip_us = time_per_call(lambda: gzip.compress(raw, compresslevel=compressor.gzip_level, mtime=0), 2_000)
+        print(f"  {name:<26}" + "".join(f"{s:>12,}" for s in sizes) + f"{gzip_us:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""Startup and scaling benchmark: import time, time to first response and throughput per server mode.
+
+    python benchmarks/bench_startup.py [--workers 1,2,4] [--runs 5] [--duration 5]
+
+Modes are single-process uvicorn and gunicorn with N uvicorn workers, with
+and without preload_app. Each server runs in a temporary directory with no
+real API key; throughput is measured on GET /campaigns (a SQLite read, the
+same for every worker) so it shows how the server scales with cores, not
+how fast OpenAI is. For the full generation mix against a running server:
+
+    python benchmarks/load_test.py --target http://127.0.0.1:8000
+"""
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import free_port  # noqa: E402
+
+
+def server_env(workdir):
+    return {
+        **os.environ,
+        "OPENAI_API_KEY": "bench",
+        "SPARK_IMAGE_ROOT": workdir,
+        "SPARK_CACHE_DIR": os.path.join(workdir, "cache"),
+        "SPARK_HISTORY_DB": os.path.join(workdir, "history.db"),
+        "SPARK_RETENTION_DB": os.path.join(workdir, "images.db"),
+        "SPARK_SHARED_STATE": os.path.join(workdir, "state.db"),
+    }
+
+
+def import_time(runs) -> float:
+    """Median seconds for a fresh interpreter to import main."""
+    samples = []
+    with tempfile.TemporaryDirectory(prefix="spark-startup-") as workdir:
+        for _ in range(runs):
+            output = subprocess.check_output(
+                [sys.executable, "-c", "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"],
+                cwd=ROOT, env=server_env(workdir),
+            )
+            samples.append(float(output))
+    return statistics.median(samples)
+
+
+def command(mode, workers, port):
+    if mode == "uvicorn":
+        return [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+                "--log-level", "warning"]
+    return [sys.executable, "-m", "gunicorn", "main:app", "-c", "gunicorn.conf.py",
+            "--bind", f"127.0.0.1:{port}", "--workers", str(workers), "--log-level", "warning"]
+
+
+def start(mode, workers, preload, workdir):
+    """Starts a server; returns (process, base URL, seconds until the first 200 on GET /)."""
+    port = free_port()
+    env = {**server_env(workdir), "SPARK_PRELOAD": "1" if preload else "0"}
+    started = time.perf_counter()
+    process = subprocess.Popen(command(mode, workers, port), cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f"{mode} exited with {process.returncode}")
+        try:
+            if httpx.get(base_url + "/", timeout=1).status_code == 200:
+                return process, base_url, time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        time.sleep(0.01)
+
+
+def stop(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def throughput(base_url, concurrency, duration) -> float:
+    done = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(client):
+        nonlocal done
+        while time.perf_counter() < deadline:
+            response = await client.get("/campaigns", params={"limit": 20})
+            response.raise_for_status()
+            done += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        return done / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", default=f"1,{os.cpu_count() or 1}", help="Comma-separated gunicorn worker counts")
+    parser.add_argument("--runs", type=int, default=5, help="Repetitions for the import and startup timings")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds of throughput per mode (0 to skip)")
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    print(f"import main: {import_time(args.runs) * 1000:.0f} ms (median of {args.runs})\n")
+
+    modes = [("uvicorn", 1, False)]
+    for workers in sorted({int(w) for w in args.workers.split(",")}):
+        modes += [("gunicorn", workers, False), ("gunicorn", workers, True)]
+
+    print(f"{'mode':<30}{'first 200 ms':>14}{'req/s':>10}")
+    for mode, workers, preload in modes:
+        name = "uvicorn" if mode == "uvicorn" else f"gunicorn x{workers}" + (" preload" if preload else "")
+        ready = []
+        rps = None
+        for run in range(args.runs):
+            with tempfile.TemporaryDirectory(prefix="spark-startup-") as workdir:
+                process, base_url, seconds = start(mode, workers, preload, workdir)
+                try:
+                    ready.append(seconds)
+                    if run == 0 and args.duration > 0:
+                        rps = asyncio.run(throughput(base_url, args.concurrency, args.duration))
+                finally:
+                    stop(process)
+        rps_text = f"{rps:>10.0f}" if rps is not None else f"{'-':>10}"
+        print(f"{name:<30}{statistics.median(ready) * 1000:>14.0f}{rps_text}")
+
+
+if __name__ == "__main__":
+    main()
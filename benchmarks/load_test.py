@@ -0,0 +1,301 @@
+"""Offline load test: main.app against the stub OpenAI server; reports req/s, latency percentiles and memory.
+
+    python benchmarks/load_test.py --concurrency 16 --duration 30
+    python benchmarks/load_test.py --requests 300 --max-p95 1.5 --min-rps 10   # exit 1 on regression
+    python benchmarks/load_test.py --target http://127.0.0.1:8000             # an already running server
+
+Without --target the app runs in-process under uvicorn with its OpenAI calls,
+images, cache and history redirected to the stub and a temporary directory,
+so nothing here costs API money. Payloads mirror the fields the index.html
+and streamlit_app.py forms send.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_openai import StubOpenAI  # noqa: E402
+
+PLATFORMS = (("linkedin", 0.4), ("instagram", 0.35), ("twitter", 0.25))
+# (want_images, want_captions): both toggles start checked in index.html
+OUTPUTS = (((True, True), 0.5), ((False, True), 0.3), ((True, False), 0.2))
+COMPANIES = ["Spark Studio", "Northwind Coffee", "Acme Robotics", "Bloom Skincare", "Atlas Fitness"]
+EVENTS = ["Product Launch", "Holiday Sale", "Webinar", "Anniversary", "Beta Program"]
+TITLES = ["Introducing AI Platform", "Winter Warmers", "Meet the Team", "10 Years Strong", "Early Access"]
+DESCRIPTIONS = [
+    "An AI marketing platform that plans, writes and designs campaigns.",
+    "Single-origin beans roasted weekly in small batches.",
+    "Warehouse robots that pick, pack and ship around the clock.",
+    "Clean skincare with five ingredients or fewer.",
+    "Strength classes for every level, in person and online.",
+]
+OPTIONAL = {
+    "Target_audience": ["Marketing managers at B2B tech companies", "Busy parents", "Gen Z students"],
+    "Product": ["Spark AI", "Morning Roast", "PickBot 3"],
+    "Style": ["minimalist", "photorealistic", "3D render", "flat illustration"],
+    "color": ["blue, white, gold", "warm earth tones", "neon pink and teal"],
+    "mood": ["energetic", "calm", "premium"],
+    "call_to_action": ["Sign up free", "Shop now", "Book a demo"],
+    "campaign_message": ["Work smarter, not harder", "Taste the difference"],
+}
+
+
+def weighted(rng, choices):
+    return rng.choices([c for c, _ in choices], weights=[w for _, w in choices])[0]
+
+
+def make_payload(rng, users=50):
+    want_images, want_captions = weighted(rng, OUTPUTS)
+    count = rng.choice([1, 2, 3, 3, 3, 4, 5])  # sliders default to 3
+    company = rng.choice(COMPANIES)
+    payload = {
+        "username": f"user_{rng.randrange(users)}",
+        "platform": weighted(rng, PLATFORMS),
+        "company": company,
+        "event": rng.choice(EVENTS),
+        "title": rng.choice(TITLES),
+        "product_description": rng.choice(DESCRIPTIONS),
+        "num_images": count if want_images else 0,
+        "num_captions": count if want_captions else 0,
+        "brand_name": company,
+        "want_images": want_images,
+        "want_captions": want_captions,
+        "features": [],
+        "layout": None,
+    }
+    for field, values in OPTIONAL.items():
+        payload[field] = rng.choice(values) if rng.random() < 0.5 else None
+    return payload
+
+
+class RequestMix:
+    """Fresh form payloads, with ``repeat_ratio`` of them resubmitting an earlier one (cache hits)."""
+
+    def __init__(self, seed=0, repeat_ratio=0.2, batch_ratio=0.0):
+        self.rng = random.Random(seed)
+        self.repeat_ratio = repeat_ratio
+        self.batch_ratio = batch_ratio
+        self.sent = []
+
+    def next(self):
+        if self.rng.random() < self.batch_ratio:
+            campaign = make_payload(self.rng)
+            return "/generate/batch", {"campaign": campaign, "platforms": [p for p, _ in PLATFORMS]}
+        if self.sent and self.rng.random() < self.repeat_ratio:
+            return "/generate", self.rng.choice(self.sent)
+        payload = make_payload(self.rng)
+        self.sent.append(payload)
+        return "/generate", payload
+
+
+# ===================================================================
+# IN-PROCESS SERVER
+# ===================================================================
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(stub, workdir):
+    # Must happen before main/generator are imported: they read these at import time
+    os.environ.update({
+        "OPENAI_API_KEY": "stub-key",
+        "OPENAI_BASE_URL": stub.base_url,
+        "SPARK_IMAGE_ROOT": workdir,
+        "SPARK_CACHE_DIR": os.path.join(workdir, "cache"),
+        "SPARK_HISTORY_DB": os.path.join(workdir, "history.db"),
+        "SPARK_RETENTION_DB": os.path.join(workdir, "images.db"),
+        # Measure the app, not the admission limits
+        "SPARK_UPSTREAM_RPM": os.getenv("SPARK_UPSTREAM_RPM", "1000000"),
+        "SPARK_UPSTREAM_TPM": os.getenv("SPARK_UPSTREAM_TPM", "1000000000"),
+        "SPARK_USER_RPM": os.getenv("SPARK_USER_RPM", "1000000"),
+        "SPARK_USER_BURST": os.getenv("SPARK_USER_BURST", "1000000"),
+    })
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config("main:app", host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("uvicorn failed to start")
+        time.sleep(0.05)
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+def memory_kib():
+    """(current RSS, peak RSS) of this process in KiB, from /proc on Linux."""
+    values = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    values[key] = int(rest.split()[0])
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak, peak
+    return values.get("VmRSS", 0), values.get("VmHWM", 0)
+
+
+# ===================================================================
+# LOAD GENERATOR
+# ===================================================================
+
+async def run_load(base_url, mix, concurrency, duration, total, timeout):
+    results = []
+    deadline = time.perf_counter() + duration if duration else None
+    issued = 0
+
+    async def worker(client):
+        nonlocal issued
+        while True:
+            if total is not None and issued >= total:
+                return
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            issued += 1
+            path, payload = mix.next()
+            started = time.perf_counter()
+            try:
+                response = await client.post(path, json=payload)
+                status = response.status_code
+                cache = response.json().get("cache") if status == 200 and path == "/generate" else None
+            except httpx.HTTPError as e:
+                status, cache = type(e).__name__, None
+            results.append({"path": path, "status": status, "cache": cache, "seconds": time.perf_counter() - started})
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(results, elapsed):
+    ok = sorted(r["seconds"] for r in results if r["status"] == 200)
+    statuses = {}
+    caches = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+        if r["cache"]:
+            caches[r["cache"]] = caches.get(r["cache"], 0) + 1
+    return {
+        "requests": len(results),
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "error_rate": round(1 - len(ok) / len(results), 4) if results else 0.0,
+        "latency_s": {
+            "p50": round(percentile(ok, 0.50), 4),
+            "p95": round(percentile(ok, 0.95), 4),
+            "p99": round(percentile(ok, 0.99), 4),
+            "max": round(ok[-1], 4) if ok else 0.0,
+        },
+        "status": statuses,
+        "cache": caches,
+    }
+
+
+def print_report(report):
+    latency = report["latency_s"]
+    print(f"requests     {report['requests']} in {report['elapsed_s']}s  ({report['rps']} req/s)")
+    print(f"latency      p50 {latency['p50'] * 1000:.0f}ms  p95 {latency['p95'] * 1000:.0f}ms  "
+          f"p99 {latency['p99'] * 1000:.0f}ms  max {latency['max'] * 1000:.0f}ms")
+    print(f"status       {report['status']}  error rate {report['error_rate']:.2%}")
+    if report["cache"]:
+        print(f"cache        {report['cache']}")
+    if "memory_kib" in report:
+        memory = report["memory_kib"]
+        print(f"memory       rss {memory['start'] / 1024:.0f} -> {memory['end'] / 1024:.0f} MiB  "
+              f"(peak {memory['peak'] / 1024:.0f} MiB)")
+    if "upstream" in report:
+        print(f"upstream     {report['upstream']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", help="Base URL of a running server (default: run main.app in-process)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds to run (ignored with --requests)")
+    parser.add_argument("--requests", type=int, help="Stop after this many requests")
+    parser.add_argument("--repeat-ratio", type=float, default=0.2, help="Share of resubmitted payloads")
+    parser.add_argument("--batch-ratio", type=float, default=0.0, help="Share of /generate/batch requests")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--image-latency", default="lognormal:0.4,0.3")
+    parser.add_argument("--chat-latency", default="lognormal:0.15,0.3")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--image-pixels", type=int, default=256)
+    parser.add_argument("--json", help="Also write the report to this file")
+    parser.add_argument("--max-p95", type=float, help="Fail if p95 latency (s) is above this")
+    parser.add_argument("--min-rps", type=float, help="Fail if throughput is below this")
+    parser.add_argument("--max-error-rate", type=float, help="Fail if the non-200 share is above this")
+    args = parser.parse_args()
+
+    mix = RequestMix(args.seed, args.repeat_ratio, args.batch_ratio)
+    duration = None if args.requests else args.duration
+
+    if args.target:
+        results, elapsed = asyncio.run(run_load(args.target, mix, args.concurrency, duration, args.requests, args.timeout))
+        report = summarize(results, elapsed)
+    else:
+        stub = StubOpenAI(image_latency=args.image_latency, chat_latency=args.chat_latency,
+                          error_rate=args.error_rate, error_status=args.error_status,
+                          image_pixels=args.image_pixels).start()
+        with tempfile.TemporaryDirectory(prefix="spark-load-") as workdir:
+            server, thread, base_url = start_app(stub, workdir)
+            start_rss, _ = memory_kib()
+            try:
+                results, elapsed = asyncio.run(run_load(base_url, mix, args.concurrency, duration, args.requests, args.timeout))
+            finally:
+                end_rss, peak_rss = memory_kib()
+                server.should_exit = True
+                thread.join()
+                stub.stop()
+        report = summarize(results, elapsed)
+        report["memory_kib"] = {"start": start_rss, "end": end_rss, "peak": peak_rss}
+        report["upstream"] = dict(stub.counts)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    failures = []
+    if args.max_p95 is not None and report["latency_s"]["p95"] > args.max_p95:
+        failures.append(f"p95 {report['latency_s']['p95']}s > {args.max_p95}s")
+    if args.min_rps is not None and report["rps"] < args.min_rps:
+        failures.append(f"{report['rps']} req/s < {args.min_rps}")
+    if args.max_error_rate is not None and report["error_rate"] > args.max_error_rate:
+        failures.append(f"error rate {report['error_rate']} > {args.max_error_rate}")
+    if failures:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
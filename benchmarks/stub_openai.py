@@ -0,0 +1,205 @@
+"""Stub OpenAI server for offline benchmarks: images and chat completions with tunable latency and errors.
+
+    python benchmarks/stub_openai.py --port 8089 --image-latency lognormal:8,0.3 --error-rate 0.02
+
+Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:8089/v1.
+
+Latency specs (seconds): ``fixed:0.5``, ``uniform:0.2,1.5``,
+``lognormal:<median>,<sigma>``, ``exp:<mean>``.
+"""
+import argparse
+import base64
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CAPTION_TEXT = (
+    "Launch day is here! Meet the tool that turns a one-line brief into a full campaign. "
+    "#Marketing #AI #Launch"
+)
+
+
+def parse_latency(spec: str):
+    """Turn a latency spec into a zero-argument sampler."""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    if kind == "exp":
+        return lambda: random.expovariate(1.0 / values[0])
+    raise ValueError(f"Unknown latency spec: {spec}")
+
+
+def make_png(pixels: int) -> str:
+    """Base64 PNG of random noise (incompressible, so the payload is realistically large)."""
+    try:
+        from PIL import Image
+    except ImportError:
+        pixels = 0
+    if pixels <= 0:
+        # 1x1 PNG
+        return "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+    image = Image.frombytes("RGB", (pixels, pixels), random.randbytes(pixels * pixels * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class StubOpenAI:
+    """ThreadingHTTPServer answering ``/v1/images/generations`` and ``/v1/chat/completions``.
+
+    Each request sleeps for a sample of its endpoint's latency distribution
+    and fails with ``error_status`` (with Retry-After on 429) at
+    ``error_rate``. Chat completions honour ``stream: true``,
+    ``response_format: json_schema`` (structured captions) and
+    ``json_object`` (the merged multi-platform request).
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, image_latency="fixed:0", chat_latency="fixed:0",
+                 error_rate=0.0, error_status=500, image_pixels=256):
+        self.image_latency = parse_latency(image_latency)
+        self.chat_latency = parse_latency(chat_latency)
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.image_b64 = make_png(image_pixels)
+        self.counts = {"images": 0, "chat": 0, "errors": 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def _chat_body(self, request):
+        content = request["messages"][-1]["content"]
+        response_format = (request.get("response_format") or {}).get("type")
+        if response_format == "json_schema":
+            # Structured captions: as many as asked for, with as few hashtags as the rules allow
+            counts = re.findall(r"Write EXACTLY (\d+)", content)
+            hashtag_range = re.search(r"(\d+)[–-](\d+) (?:relevant )?hashtags", content)
+            tags = max(1, int(hashtag_range.group(1))) if hashtag_range else 3
+            caption = {"body": CAPTION_TEXT.split(" #")[0], "hashtags": [f"#Tag{i}" for i in range(tags)]}
+            return json.dumps({"captions": [caption] * int(counts[-1] if counts else 1)})
+        if response_format == "json_object":
+            # Merged batch captions: answer every '### Section id: "<id>"' header
+            sections = re.findall(r'^### Section id: "([^"]+)"', content, re.MULTILINE)
+            return json.dumps({section: [CAPTION_TEXT] * 5 for section in sections})
+        return "\n\n".join(f"Caption {i}: {CAPTION_TEXT}" for i in range(1, 6))
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body, content_type="application/json", headers=()):
+                payload = body.encode() if isinstance(body, str) else body
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                is_image = self.path.endswith("/images/generations")
+                stub._count("images" if is_image else "chat")
+                time.sleep(max(0.0, (stub.image_latency if is_image else stub.chat_latency)()))
+
+                if random.random() < stub.error_rate:
+                    stub._count("errors")
+                    error = {"error": {"message": "stub error", "type": "stub", "code": None}}
+                    headers = [("Retry-After", "1")] if stub.error_status == 429 else []
+                    return self._send(stub.error_status, json.dumps(error), headers=headers)
+
+                if is_image:
+                    data = [{"b64_json": stub.image_b64} for _ in range(request.get("n", 1))]
+                    return self._send(200, json.dumps({"created": int(time.time()), "data": data}))
+
+                text = stub._chat_body(request)
+                if request.get("stream"):
+                    return self._stream(text)
+                return self._send(200, json.dumps({
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "stub"),
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": text}}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                }))
+
+            def _stream(self, text):
+                chunks = [text[i:i + 24] for i in range(0, len(text), 24)]
+                events = []
+                for i, chunk in enumerate(chunks):
+                    events.append({
+                        "id": "chatcmpl-stub",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": "stub",
+                        "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": "stop" if i == len(chunks) - 1 else None}],
+                    })
+                body = "".join(f"data: {json.dumps(e)}\n\n" for e in events) + "data: [DONE]\n\n"
+                self._send(200, body, content_type="text/event-stream")
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--image-latency", default="lognormal:8,0.3")
+    parser.add_argument("--chat-latency", default="lognormal:1.5,0.4")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--image-pixels", type=int, default=256)
+    args = parser.parse_args()
+
+    stub = StubOpenAI(args.host, args.port, args.image_latency, args.chat_latency,
+                      args.error_rate, args.error_status, args.image_pixels)
+    print(f"Stub OpenAI listening on {stub.base_url}")
+    try:
+        stub._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
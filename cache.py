@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def cache_key(*parts) -> str:
+    # Content address: same built prompts + generation params -> same key
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Two-tier /generate result cache: an in-memory LRU in front of a JSON-file store.
+
+    Entries expire after ``ttl`` seconds in both tiers. The disk tier is
+    trimmed least-recently-used first once it grows past ``max_bytes``.
+    """
+
+    def __init__(self, directory=".spark_cache", max_entries=256, ttl=24 * 3600, max_bytes=64 * 1024 * 1024, exists=os.path.exists):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.exists = exists
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+
+    # -------------------------------------------------------------------
+    # Public API
+    # -------------------------------------------------------------------
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created < self.ttl and self._images_exist(value):
+                    self._memory.move_to_end(key)
+                    return value
+                del self._memory[key]
+
+        entry = self._read_disk(key, now)
+        if entry is None:
+            return None
+        created, value = entry
+        with self._lock:
+            self._remember(key, created, value)
+        return value
+
+    def set(self, key, value):
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, value)
+        self._write_disk(key, created, value)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            for path, _, _ in self._disk_entries():
+                _unlink(path)
+            self._disk_bytes = 0
+
+    def _images_exist(self, value):
+        # A cached result is only useful while the image files it points at are still on disk
+        return all(self.exists(path) for path in (value or {}).get("images", ()))
+
+    # -------------------------------------------------------------------
+    # Memory tier
+    # -------------------------------------------------------------------
+
+    def _remember(self, key, created, value):
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    # -------------------------------------------------------------------
+    # Disk tier
+    # -------------------------------------------------------------------
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def _read_disk(self, key, now):
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        created, value = entry.get("created", 0), entry.get("value")
+        if now - created >= self.ttl or not self._images_exist(value):
+            self._drop_disk(path)
+            return None
+
+        # Bump mtime so size-based eviction is least-recently-used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return created, value
+
+    def _write_disk(self, key, created, value):
+        path = self._path(key)
+        data = json.dumps({"created": created, "value": value}, ensure_ascii=False).encode("utf-8")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        # Re-setting a key replaces its file: only the difference counts
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+            else:
+                self._disk_bytes += len(data) - replaced
+            if self._disk_bytes > self.max_bytes:
+                self._evict_disk()
+
+    def _drop_disk(self, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        _unlink(path)
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes = max(0, self._disk_bytes - size)
+
+    def _disk_entries(self):
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for shard in os.scandir(self.directory):
+            if not shard.is_dir():
+                continue
+            for item in os.scandir(shard.path):
+                if item.name.endswith(".json"):
+                    stat = item.stat()
+                    entries.append((item.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict_disk(self):
+        # Caller holds the lock. Oldest mtime == least recently read or written.
+        entries = self._disk_entries()
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+
+        for path, size, _ in sorted(entries, key=lambda e: e[2]):
+            if total <= target:
+                break
+            _unlink(path)
+            total -= size
+        self._disk_bytes = total
+
+
+def _unlink(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,128 @@
+import hashlib
+import io
+import math
+import os
+import uuid
+
+# The image prompts ask for key elements "within center 70%"; crops never cut into it
+SAFE_AREA = 0.7
+# Saliency is measured on a copy at most this many pixels on a side
+SALIENCY_SIZE = 128
+
+
+def parse_size(size: str) -> tuple[int, int]:
+    width, _, height = size.lower().partition("x")
+    return int(width), int(height)
+
+
+def crop_box(width, height, target_width, target_height, column_weights=None, row_weights=None, safe_area=SAFE_AREA):
+    """The ``(left, top, right, bottom)`` region of a ``width`` x ``height`` image to keep.
+
+    The region has the target aspect ratio when that is possible without
+    cutting into the centered ``safe_area`` share of either side; otherwise
+    it keeps the whole safe area and the rest is padded by ``derive_crop``.
+    Within what the safe area allows, it slides towards the highest summed
+    ``column_weights`` / ``row_weights`` (saliency at any resolution).
+    """
+    ratio = target_width / target_height
+    crop_width, crop_height = width, height
+    if width / height > ratio:
+        crop_width = min(width, max(round(height * ratio), math.ceil(width * safe_area)))
+    else:
+        crop_height = min(height, max(round(width / ratio), math.ceil(height * safe_area)))
+    left = _best_offset(width, crop_width, column_weights, safe_area)
+    top = _best_offset(height, crop_height, row_weights, safe_area)
+    return left, top, left + crop_width, top + crop_height
+
+
+def _best_offset(length, window, weights, safe_area):
+    # Offsets that keep [safe_start, safe_end) inside the window
+    safe_start = math.floor(length * (1 - safe_area) / 2)
+    safe_end = length - safe_start
+    low, high = max(0, safe_end - window), min(length - window, safe_start)
+    center = (length - window) // 2
+    if high <= low or not weights:
+        return min(max(center, low), high)
+
+    scale = len(weights) / length
+    prefix = [0]
+    for weight in weights:
+        prefix.append(prefix[-1] + weight)
+
+    def score(offset):
+        start = round(offset * scale)
+        end = max(start + 1, round((offset + window) * scale))
+        return prefix[min(end, len(weights))] - prefix[start]
+
+    # One candidate per saliency sample; ties go to the offset nearest the center
+    step = max(1, round(1 / scale))
+    candidates = sorted({low, high, min(max(center, low), high), *range(low, high + 1, step)})
+    return max(candidates, key=lambda offset: (score(offset), -abs(offset - center)))
+
+
+def saliency(im) -> tuple[list[float], list[float]]:
+    """Column and row sums of edge strength on a small grayscale copy of ``im``."""
+    from PIL import ImageFilter
+
+    small = im.convert("L")
+    small.thumbnail((SALIENCY_SIZE, SALIENCY_SIZE))
+    edges = small.filter(ImageFilter.FIND_EDGES)
+    width, height = edges.size
+    pixels = list(edges.getdata())
+    columns = [sum(pixels[x::width]) for x in range(width)]
+    rows = [sum(pixels[y * width:(y + 1) * width]) for y in range(height)]
+    return columns, rows
+
+
+def fit(im, target_width, target_height):
+    """``im`` resized to exactly the target size, padded with a blurred extension of itself if its ratio differs."""
+    from PIL import Image, ImageFilter
+
+    width, height = im.size
+    if abs(width / height - target_width / target_height) < 0.01:
+        return im.resize((target_width, target_height), Image.LANCZOS)
+
+    # Background: the image scaled to cover the target and blurred, so the
+    # bars continue its colours instead of being flat
+    cover = max(target_width / width, target_height / height)
+    background = im.resize((math.ceil(width * cover), math.ceil(height * cover)), Image.BILINEAR)
+    left = (background.width - target_width) // 2
+    top = (background.height - target_height) // 2
+    background = background.crop((left, top, left + target_width, top + target_height))
+    background = background.filter(ImageFilter.GaussianBlur(max(target_width, target_height) / 40))
+
+    contain = min(target_width / width, target_height / height)
+    foreground = im.resize((round(width * contain), round(height * contain)), Image.LANCZOS)
+    background.paste(foreground, ((target_width - foreground.width) // 2, (target_height - foreground.height) // 2))
+    return background
+
+
+def derive_crop(path, size, safe_area=SAFE_AREA):
+    """Write ``path`` re-framed to ``size`` (e.g. "1536x1024") next to it; runs in the process pool.
+
+    Returns the new file's path. Like generated originals, it is named by the
+    SHA-256 of its bytes.
+    """
+    from PIL import Image
+
+    target_width, target_height = parse_size(size)
+    with Image.open(path) as im:
+        im.load()
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA")
+        if im.size == (target_width, target_height):
+            return path
+        columns, rows = saliency(im)
+        box = crop_box(im.width, im.height, target_width, target_height, columns, rows, safe_area)
+        framed = fit(im.crop(box), target_width, target_height)
+
+    buffer = io.BytesIO()
+    framed.save(buffer, "PNG")
+    data = buffer.getvalue()
+    crop_path = os.path.join(os.path.dirname(path), hashlib.sha256(data).hexdigest()[:32] + ".png")
+    if not os.path.exists(crop_path):
+        tmp = f"{crop_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, crop_path)
+    return crop_path
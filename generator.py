@@ -1,38 +1,386 @@
-from openai import OpenAI
-import base64
+from openai import BadRequestError
+import asyncio
+import json
 import os
+import re
+from contextlib import nullcontext
 from dotenv import load_dotenv
+from backends import BackendRouter, Unsupported, build_backend
+from image_store import ImageStore
+from metrics import CAPTION_REPAIRS, stage
+from models import Caption
+from prompt import get_platform_rules
+from upstream import ResilientClient, RetryPolicy
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+IMAGE_MODEL = "dall-e-3"
+CAPTION_MODEL = os.getenv("CAPTION_MODEL", "gpt-4o-mini")
+# Upper bound on parallel single-image calls per request
+IMAGE_CONCURRENCY = int(os.getenv("IMAGE_CONCURRENCY", "5"))
 
-def generate_image(username, prompt, n, size):
-    # FIXED: Folder naming convention
-    OUTPUT_DIR = username + "_" + "generated_images"
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Pooled, deadline-aware upstream client with retries, optional hedging and a circuit breaker
+upstream = ResilientClient(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_connections=int(os.getenv("SPARK_HTTP_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("SPARK_HTTP_MAX_KEEPALIVE", "20")),
+    keepalive_expiry=float(os.getenv("SPARK_HTTP_KEEPALIVE_EXPIRY", "30")),
+    call_timeout=float(os.getenv("SPARK_UPSTREAM_TIMEOUT", "90")),
+    retry=RetryPolicy(max_attempts=int(os.getenv("SPARK_UPSTREAM_ATTEMPTS", "3"))),
+    hedge_percentile=float(os.environ["SPARK_HEDGE_PERCENTILE"]) if os.getenv("SPARK_HEDGE_PERCENTILE") else None,
+    breaker_threshold=int(os.getenv("SPARK_BREAKER_THRESHOLD", "5")),
+    breaker_reset=float(os.getenv("SPARK_BREAKER_RESET", "30")),
+)
+# Set to replace the AsyncOpenAI client the backends use (tests); by default
+# it is upstream.openai, built on first use in each worker process
+async_client = None
 
-    response = client.images.generate(
-        model="dall-e-3", # Ensure you use a valid model name
-        prompt=prompt,
-        n=n,
-        size=size,
-        response_format="b64_json" # REQUIRED to get data for local saving
+# ===================================================================
+# BACKENDS - SPARK_IMAGE_BACKENDS / SPARK_TEXT_BACKENDS list "openai:<model>"
+# or "stub" entries; SPARK_MODEL_PREFERENCES maps a platform to the ones it
+# should try first, e.g. {"instagram": {"image": ["openai:gpt-image-1"]}}
+# ===================================================================
+
+def _build_router(kind, specs, preferences):
+    names = [spec.strip() for spec in specs.split(",") if spec.strip()]
+    per_platform = {platform: list(prefs.get(kind, ())) for platform, prefs in preferences.items()}
+    # A backend named only in a preference is registered too
+    for preferred in per_platform.values():
+        names += [name for name in preferred if name not in names]
+    backends = [build_backend(name, kind, upstream, lambda: async_client or upstream.openai) for name in names]
+    return BackendRouter(
+        backends,
+        per_platform,
+        window=float(os.getenv("SPARK_BACKEND_WINDOW", "60")),
+        max_error_rate=float(os.getenv("SPARK_BACKEND_MAX_ERROR_RATE", "0.5")),
     )
 
-    image_files = []
 
-    for i, img in enumerate(response.data):
-        image_base64 = img.b64_json
-        image_bytes = base64.b64decode(image_base64)
-        file_name = f"image_{i+1}.png"
-        file_path = os.path.join(OUTPUT_DIR, file_name)
-        
-        with open(file_path, "wb") as f:
-            f.write(image_bytes)
+_preferences = json.loads(os.getenv("SPARK_MODEL_PREFERENCES", "{}"))
+image_backends = _build_router("image", os.getenv("SPARK_IMAGE_BACKENDS", f"openai:{IMAGE_MODEL}"), _preferences)
+text_backends = _build_router("text", os.getenv("SPARK_TEXT_BACKENDS", f"openai:{CAPTION_MODEL}"), _preferences)
+
+image_store = ImageStore(root=os.getenv("SPARK_IMAGE_ROOT", "."))
+
+# Matches the "Caption 1:", "Caption 2:" headers build_caption_prompt asks for
+# (tolerates markdown bold and "1." / "1)" variants the model sometimes emits)
+CAPTION_HEADER = re.compile(r"^[ \t]*\**[ \t]*caption[ \t]*\d+[ \t]*[:.)\-]?\**[ \t]*", re.IGNORECASE | re.MULTILINE)
+
+
+def split_captions(text, n):
+    # parts[0] is whatever came before the first header ("Here are 2 captions:"), never a caption
+    parts = [p.strip() for p in CAPTION_HEADER.split(text or "")]
+    captions = [p for p in parts[1:] if p]
+
+    # Model ignored the numbering: fall back to the blank-line separator
+    if not captions:
+        captions = [p.strip() for p in re.split(r"\n\s*\n", text or "") if p.strip()]
+
+    return captions[:n] if n else captions
+
+
+class CaptionStreamSplitter:
+    """Split a streamed completion into captions as each "Caption N:" header arrives.
+
+    ``feed`` returns the captions completed by the new text; ``close`` flushes
+    the last one. A header is only trusted once something follows it, so a
+    chunk ending in "Caption 1" can't be mistaken for a finished "Caption 1:".
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._seen_header = False
+
+    def feed(self, delta):
+        self._buffer += delta
+        headers = [m for m in CAPTION_HEADER.finditer(self._buffer) if m.end() < len(self._buffer)]
+        if not headers:
+            return []
+
+        self._seen_header = True
+        captions = []
+        for current, following in zip(headers, headers[1:]):
+            text = self._buffer[current.end():following.start()].strip()
+            if text:
+                captions.append(text)
+
+        # Keep only the caption still being written (drops any preamble too)
+        self._buffer = self._buffer[headers[-1].start():]
+        return captions
+
+    def close(self):
+        if not self._seen_header:
+            return split_captions(self._buffer, 0)
+        return [p for p in (p.strip() for p in CAPTION_HEADER.split(self._buffer)) if p]
+
+
+def _image_error(index, exc):
+    return {"index": index + 1, "error": str(exc) or type(exc).__name__}
+
+
+# ===================================================================
+# IMAGES - fanned out on the event loop, so requests don't hold a thread
+# ===================================================================
+
+async def agenerate_image_batch(username, prompt, n, size, concurrency=None, semaphore=None, on_image=None, platform=None):
+    """Fan ``n`` single-image calls out in parallel, at most ``concurrency`` at a time.
+
+    Each image is decoded and written as soon as its call returns. Returns
+    ``(images, errors)``: the ImageStore variants (``{"original", "webp",
+    "thumbnail"}``) of the images that succeeded, in index order, and one
+    ``{"index", "error"}`` entry per image that failed. ``on_image(index,
+    variants)`` is awaited as each image lands. Each call goes to the best
+    image backend for ``platform``.
+    """
+    semaphore = semaphore or asyncio.Semaphore(max(1, concurrency or IMAGE_CONCURRENCY))
+
+    async def one(index):
+        with stage("image_slot_wait"):
+            await semaphore.acquire()
+        try:
+            image_base64 = await image_backends.call(platform, lambda backend: backend.generate(prompt, size))
+        finally:
+            semaphore.release()
+        variants = await image_store.asave(username, image_base64)
+        if on_image is not None:
+            await on_image(index, variants)
+        return variants
+
+    outcomes = await asyncio.gather(*(one(i) for i in range(n)), return_exceptions=True)
+
+    images = []
+    errors = []
+    for index, outcome in enumerate(outcomes):
+        if isinstance(outcome, BaseException):
+            errors.append(_image_error(index, outcome))
+        else:
+            images.append(outcome)
+    return images, errors
+
+
+# ===================================================================
+# STRUCTURED CAPTIONS - JSON-schema output, checked against platform rules
+# ===================================================================
+
+CAPTION_SCHEMA = {
+    "name": "captions",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "captions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "body": {"type": "string"},
+                        "hashtags": {"type": "array", "items": {"type": "string"}},
+                    },
+                    "required": ["body", "hashtags"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["captions"],
+        "additionalProperties": False,
+    },
+}
+
+STRUCTURED_CAPTION_SYSTEM = (
+    "Return the captions as JSON: one object per caption with the caption text (no hashtags) in "
+    '"body" and its hashtags, each starting with #, in "hashtags". '
+    "Ignore any numbering or blank-line separator rules in the instructions."
+)
+
+CAPTION_REPAIR_NOTE = (
+    "\n\nSome captions written for this brief broke these rules:\n{issues}\n"
+    "Write EXACTLY {k} replacement captions that follow every rule above."
+)
+
+# How many times captions that break the platform rules are regenerated
+CAPTION_REPAIR_ATTEMPTS = int(os.getenv("SPARK_CAPTION_REPAIR_ATTEMPTS", "1"))
+
+HASHTAG = re.compile(r"#[^\s#]+")
+TRAILING_HASHTAGS = re.compile(r"(?:\s*#[^\s#]+)+\s*$")
+
+
+def make_caption(body, hashtags, rules) -> Caption:
+    hashtags = ["#" + tag.strip().lstrip("#") for tag in hashtags if tag.strip().lstrip("#")]
+    caption = Caption(body=body.strip(), hashtags=hashtags)
+    text = caption.text
+    caption.char_count = len(text)
+    caption.issues = rules.caption_issues(text, hashtags)
+    return caption
+
+
+def caption_from_text(text, rules) -> Caption:
+    # Free-text caption: the trailing run of hashtags is its hashtag list
+    match = TRAILING_HASHTAGS.search(text)
+    if match is None:
+        return make_caption(text, [], rules)
+    return make_caption(text[:match.start()], HASHTAG.findall(match.group()), rules)
+
+
+def parse_structured_captions(text, rules) -> list[Caption] | None:
+    """Captions from a CAPTION_SCHEMA response, or None if the text isn't that shape."""
+    try:
+        data = json.loads(text or "")
+    except ValueError:
+        return None
+    items = data.get("captions") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return None
+
+    captions = []
+    for item in items:
+        if isinstance(item, str):
+            captions.append(caption_from_text(item, rules))
+        elif isinstance(item, dict) and isinstance(item.get("body"), str):
+            hashtags = item.get("hashtags")
+            if not isinstance(hashtags, list):
+                hashtags = []
+            captions.append(make_caption(item["body"], [t for t in hashtags if isinstance(t, str)], rules))
+    return captions
+
+
+async def _complete_captions(prompt, n, platform=None, semaphore=None) -> list[Caption]:
+    rules = get_platform_rules(platform)
+    async with semaphore or nullcontext():
+        try:
+            text = await text_backends.call(platform, lambda backend: backend.complete(
+                prompt, schema=CAPTION_SCHEMA, system=STRUCTURED_CAPTION_SYSTEM,
+            ))
+        except (Unsupported, BadRequestError):
+            # No backend with structured output support (remembered per backend, so later
+            # requests skip straight here): ask for the numbered text format
+            text = await text_backends.call(platform, lambda backend: backend.complete(prompt))
+
+    with stage("caption_parse"):
+        captions = parse_structured_captions(text, rules)
+        if captions is None:
+            captions = [caption_from_text(t, rules) for t in split_captions(text, n)]
+    return captions[:n]
+
+
+async def repair_captions(prompt, captions, n, platform=None, semaphore=None) -> list[Caption]:
+    """Regenerate only the captions that break the platform rules (and any missing ones).
+
+    A replacement is kept only if it breaks fewer rules than the caption it
+    replaces; after CAPTION_REPAIR_ATTEMPTS rounds whatever is left is
+    returned with its ``issues`` filled in.
+    """
+    captions = list(captions[:n])
+    for _ in range(CAPTION_REPAIR_ATTEMPTS):
+        failing = [i for i, caption in enumerate(captions) if caption.issues]
+        slots = failing + list(range(len(captions), n))
+        if not slots:
+            break
+
+        issues = sorted({issue for i in failing for issue in captions[i].issues}) or ["fewer captions than requested"]
+        note = CAPTION_REPAIR_NOTE.format(issues="\n".join(f"- {issue}" for issue in issues), k=len(slots))
+        try:
+            replacements = await _complete_captions(prompt + note, len(slots), platform, semaphore)
+        except Exception:
+            # Keep the imperfect captions rather than failing the request
+            break
+
+        CAPTION_REPAIRS.inc(len(slots), platform=get_platform_rules(platform).name)
+        for slot, replacement in zip(slots, replacements):
+            if slot >= len(captions):
+                captions.append(replacement)
+            elif len(replacement.issues) < len(captions[slot].issues):
+                captions[slot] = replacement
+    return captions
+
+
+async def agenerate_captions(prompt, n, semaphore=None, platform=None) -> list[Caption]:
+    captions = await _complete_captions(prompt, n, platform, semaphore)
+    return await repair_captions(prompt, captions, n, platform, semaphore)
+
+
+CAPTION_REPLACE_NOTE = (
+    "\n\nThese captions were already written for this brief:\n{existing}\n"
+    "Write EXACTLY {k} new captions that take a different angle from all of them."
+)
+
+
+async def areplace_captions(prompt, existing, k, platform=None) -> list[Caption]:
+    """``k`` fresh captions for the same brief, steered away from the ``existing`` ones."""
+    listed = "\n".join(f"- {text}" for text in existing) or "- (none)"
+    replace_prompt = prompt + CAPTION_REPLACE_NOTE.format(existing=listed, k=k)
+    captions = await _complete_captions(replace_prompt, k, platform)
+    return await repair_captions(replace_prompt, captions, k, platform)
+
+
+MERGED_CAPTION_PREAMBLE = (
+    "You are writing social media captions for several platforms in one pass.\n"
+    "Each section below has its own instructions; follow them for that section only.\n"
+    "Ignore the numbering and blank-line separator rules inside the sections: return ONLY a JSON object "
+    "whose keys are the section ids and whose values are arrays of caption strings "
+    "(each caption includes its hashtags)."
+)
+
+
+def build_merged_caption_prompt(sections):
+    parts = [MERGED_CAPTION_PREAMBLE]
+    for section_id, (prompt, n, _) in sections.items():
+        parts.append(f'### Section id: "{section_id}" ({n} captions)\n{prompt}')
+    return "\n\n".join(parts)
+
+
+async def agenerate_captions_merged(sections, semaphore=None):
+    """Generate captions for several caption prompts with a single structured completion.
+
+    ``sections`` maps an id to ``(prompt, n, platform)``; returns the same ids
+    mapped to Caption lists. Sections the model leaves out or garbles are
+    regenerated one by one with their own prompt, and captions that break
+    their platform's rules are repaired per section.
+    """
+    if len(sections) == 1:
+        (section_id, (prompt, n, platform)), = sections.items()
+        return {section_id: await agenerate_captions(prompt, n, semaphore=semaphore, platform=platform)}
+
+    # Sections span platforms, so the merged call uses the default backend order
+    prompt = build_merged_caption_prompt(sections)
+    async with semaphore or nullcontext():
+        text = await text_backends.call(None, lambda backend: backend.complete(prompt, json_mode=True))
+
+    try:
+        data = json.loads(text or "{}")
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    parsed = {}
+    for section_id, (_, n, platform) in sections.items():
+        captions = data.get(section_id)
+        if isinstance(captions, list) and captions and all(isinstance(c, str) for c in captions):
+            rules = get_platform_rules(platform)
+            parsed[section_id] = [caption_from_text(c.strip(), rules) for c in captions][:n]
+
+    async def finish(section_id):
+        prompt, n, platform = sections[section_id]
+        if section_id not in parsed:
+            return await agenerate_captions(prompt, n, semaphore=semaphore, platform=platform)
+        return await repair_captions(prompt, parsed[section_id], n, platform, semaphore)
+
+    return dict(zip(sections, await asyncio.gather(*(finish(section_id) for section_id in sections))))
+
+
+async def astream_captions(prompt, n, platform=None):
+    # Yields each caption as soon as the model has finished writing it
+    # Falling back to another backend is only possible until the stream opens
+    deltas = await text_backends.call(platform, lambda backend: backend.stream(prompt))
+    splitter = CaptionStreamSplitter()
+    emitted = 0
 
-        # Return full relative path for the frontend to append to the URL
-        relative_path = os.path.join(OUTPUT_DIR, file_name)
-        image_files.append(relative_path)
+    async for delta in deltas:
+        for caption in splitter.feed(delta):
+            if emitted < n:
+                emitted += 1
+                yield caption
 
-    return image_files
\ No newline at end of file
+    for caption in splitter.close():
+        if emitted < n:
+            emitted += 1
+            yield caption
@@ -0,0 +1,28 @@
+# Production server: gunicorn managing uvicorn workers.
+#
+#   WEB_CONCURRENCY=4 gunicorn main:app -c gunicorn.conf.py
+#
+# One worker by default. Rate limits, jobs and history are shared between
+# workers, but some state is still per process, so with WEB_CONCURRENCY > 1
+# each of these only covers the worker that happened to serve the request:
+# /metrics, /debug/profiles, the totals and last_run of /admin/storage, and
+# the lock that serialises regenerations of one campaign.
+#
+# The app is imported once in the master (preload_app) and forked, so workers
+# start in milliseconds and share the imported modules' memory pages. Nothing
+# that holds a socket or thread is created at import time: OpenAI clients and
+# SQLite connections are built lazily in each worker.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = os.getenv("SPARK_PRELOAD", "1") == "1"
+
+# Generation requests can legitimately take a minute or more
+timeout = int(os.getenv("SPARK_WORKER_TIMEOUT", "180"))
+graceful_timeout = 30
+keepalive = 5
+
+# Rate limits and background jobs must hold across workers, not per process
+os.environ.setdefault("SPARK_SHARED_STATE", "spark_state.db")
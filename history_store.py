@@ -0,0 +1,234 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from prompt import get_platform_rules
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    company TEXT NOT NULL,
+    title TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    num_images INTEGER NOT NULL,
+    num_captions INTEGER NOT NULL,
+    request TEXT NOT NULL,
+    result TEXT NOT NULL,
+    preview TEXT
+);
+CREATE INDEX IF NOT EXISTS campaigns_created ON campaigns (created_at, id);
+CREATE INDEX IF NOT EXISTS campaigns_username ON campaigns (username, created_at, id);
+CREATE INDEX IF NOT EXISTS campaigns_platform ON campaigns (platform, created_at, id);
+CREATE INDEX IF NOT EXISTS campaigns_company ON campaigns (company, created_at, id);
+"""
+
+SUMMARY_COLUMNS = "id, username, platform, company, title, created_at, num_images, num_captions"
+
+
+def platform_name(platform: str | None) -> str:
+    # Registered name, so aliases ("x" / "twitter") are one platform in filters and stats
+    return get_platform_rules(platform).name if platform else ""
+
+
+def preview_path(result: dict) -> str | None:
+    # Enough for a list view: one small image instead of the whole payload
+    variants = result.get("image_variants") or []
+    first = variants[0] if variants else {}
+    return first.get("thumbnail") or first.get("original") or next(iter(result.get("images") or []), None)
+
+
+def encode_cursor(created_at: float, campaign_id: str) -> str:
+    raw = json.dumps([created_at, campaign_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, campaign_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return float(created_at), str(campaign_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+class CampaignStore:
+    """Server-side campaign history in SQLite (WAL mode).
+
+    Every generated result is one row; listing is keyset-paginated on
+    ``(created_at, id)`` so a page costs the same no matter how long the
+    history is. Methods are blocking; call them via ``asyncio.to_thread``.
+    """
+
+    def __init__(self, path="spark_history.db"):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Opened on first use, one per thread and per process (a preloaded app forks
+        # after importing this); WAL lets readers run alongside the writer
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _migrate(conn):
+        # Databases from before the preview column: add it, and fill it (and the
+        # registered platform names) in from the stored results once
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(campaigns)")}
+        if "preview" in columns:
+            return
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(campaigns)")}
+            if "preview" in columns:
+                return  # another connection migrated first
+            conn.execute("ALTER TABLE campaigns ADD COLUMN preview TEXT")
+            rows = conn.execute("SELECT id, platform, result FROM campaigns").fetchall()
+            conn.executemany(
+                "UPDATE campaigns SET platform = ?, preview = ? WHERE id = ?",
+                [(platform_name(row["platform"]), preview_path(json.loads(row["result"])), row["id"]) for row in rows],
+            )
+
+    # -------------------------------------------------------------------
+    # Writes
+    # -------------------------------------------------------------------
+
+    def add(self, request: dict, result: dict) -> str:
+        return self.add_many([(request, result)])[0]
+
+    def add_many(self, entries) -> list[str]:
+        """Insert ``(request, result)`` pairs in one transaction; returns their ids in order."""
+        now = time.time()
+        rows = []
+        for request, result in entries:
+            rows.append((
+                uuid.uuid4().hex,
+                request.get("username") or "",
+                platform_name(request.get("platform")),
+                request.get("company") or "",
+                request.get("title") or "",
+                now,
+                len(result.get("images") or ()),
+                len(result.get("captions") or ()),
+                json.dumps(request, ensure_ascii=False),
+                json.dumps(result, ensure_ascii=False),
+                preview_path(result),
+            ))
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO campaigns (id, username, platform, company, title, created_at, num_images, num_captions, request, result, preview)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return [row[0] for row in rows]
+
+    def update_result(self, campaign_id: str, result: dict) -> bool:
+        cursor = self._connect().execute(
+            "UPDATE campaigns SET result = ?, num_images = ?, num_captions = ?, preview = ? WHERE id = ?",
+            (
+                json.dumps(result, ensure_ascii=False),
+                len(result.get("images") or ()),
+                len(result.get("captions") or ()),
+                preview_path(result),
+                campaign_id,
+            ),
+        )
+        return cursor.rowcount > 0
+
+    # -------------------------------------------------------------------
+    # Reads
+    # -------------------------------------------------------------------
+
+    def get(self, campaign_id: str) -> dict | None:
+        row = self._connect().execute(
+            f"SELECT {SUMMARY_COLUMNS}, request, result FROM campaigns WHERE id = ?", (campaign_id,)
+        ).fetchone()
+        return self._row(row, include_result=True) if row else None
+
+    def list(self, username=None, platform=None, company=None, limit=20, cursor=None, include_result=False) -> dict:
+        where, params = self._filters(username, platform, company)
+        if cursor:
+            created_at, campaign_id = decode_cursor(cursor)
+            where.append("(created_at, id) < (?, ?)")
+            params += [created_at, campaign_id]
+
+        columns = SUMMARY_COLUMNS + (", request, result" if include_result else ", preview")
+        sql = f"SELECT {columns} FROM campaigns"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        rows = self._connect().execute(sql, params + [limit + 1]).fetchall()
+
+        items = [self._row(row, include_result) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = encode_cursor(last["created_at"], last["id"])
+        return {"items": items, "next_cursor": next_cursor}
+
+    def stats(self, username=None, platform=None, company=None) -> dict:
+        where, params = self._filters(username, platform, company)
+        clause = (" WHERE " + " AND ".join(where)) if where else ""
+        conn = self._connect()
+
+        totals = conn.execute(
+            "SELECT COUNT(*) AS campaigns, COALESCE(SUM(num_images), 0) AS images,"
+            " COALESCE(SUM(num_captions), 0) AS captions, MAX(created_at) AS last_created_at"
+            f" FROM campaigns{clause}",
+            params,
+        ).fetchone()
+        by_platform = conn.execute(
+            f"SELECT platform, COUNT(*) AS campaigns FROM campaigns{clause} GROUP BY platform ORDER BY campaigns DESC",
+            params,
+        ).fetchall()
+
+        return {
+            "campaigns": totals["campaigns"],
+            "images": totals["images"],
+            "captions": totals["captions"],
+            "last_created_at": totals["last_created_at"],
+            "by_platform": {row["platform"]: row["campaigns"] for row in by_platform},
+        }
+
+    # -------------------------------------------------------------------
+    # Helpers
+    # -------------------------------------------------------------------
+
+    @staticmethod
+    def _filters(username, platform, company):
+        where, params = [], []
+        if username:
+            where.append("username = ?")
+            params.append(username)
+        if platform:
+            where.append("platform = ?")
+            params.append(platform_name(platform))
+        if company:
+            where.append("company = ?")
+            params.append(company)
+        return where, params
+
+    @staticmethod
+    def _row(row, include_result) -> dict:
+        item = {key: row[key] for key in ("id", "username", "platform", "company", "title", "created_at", "num_images", "num_captions")}
+        if include_result:
+            item["request"] = json.loads(row["request"])
+            item["result"] = json.loads(row["result"])
+        else:
+            item["preview"] = row["preview"]
+        return item
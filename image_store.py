@@ -0,0 +1,200 @@
+import asyncio
+import base64
+import hashlib
+import multiprocessing
+import os
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from crops import derive_crop
+from metrics import stage
+
+IMAGE_DIR_SUFFIX = "_generated_images"
+
+# Multiple of 4 so every slice of the base64 text decodes on its own
+DECODE_CHUNK = 256 * 1024
+
+IMAGE_EXTENSIONS = {".png": "image/png", ".webp": "image/webp"}
+# <sha256 prefix>.png / .webp / _thumb.webp: names that can never change content
+CONTENT_ADDRESSED_NAME = re.compile(r"^[0-9a-f]{32}(_thumb)?\.(png|webp)$")
+
+THUMBNAIL_SIZE = (384, 384)
+WEBP_QUALITY = 85
+
+
+def user_dir_name(username: str) -> str:
+    # Usernames come straight from the form; keep them from escaping the store
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", username or "").strip(".") or "anonymous"
+    return safe + IMAGE_DIR_SUFFIX
+
+
+def _atomic_target(path):
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+def make_derivatives(path, thumbnail_size=THUMBNAIL_SIZE, quality=WEBP_QUALITY):
+    """Write ``<hash>.webp`` and ``<hash>_thumb.webp`` next to ``path``; runs in the process pool."""
+    from PIL import Image
+
+    stem = os.path.splitext(path)[0]
+    webp_path = stem + ".webp"
+    thumb_path = stem + "_thumb.webp"
+    if os.path.exists(webp_path) and os.path.exists(thumb_path):
+        return webp_path, thumb_path
+
+    with Image.open(path) as im:
+        im.load()
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA")
+
+        tmp = _atomic_target(webp_path)
+        im.save(tmp, "WEBP", quality=quality, method=4)
+        os.replace(tmp, webp_path)
+
+        thumb = im.copy()
+        thumb.thumbnail(thumbnail_size)
+        tmp = _atomic_target(thumb_path)
+        thumb.save(tmp, "WEBP", quality=quality, method=4)
+        os.replace(tmp, thumb_path)
+
+    return webp_path, thumb_path
+
+
+class ImageStore:
+    """Content-addressed image files under ``root/<username>_generated_images/``.
+
+    Originals are named by the SHA-256 of their bytes, so a new campaign never
+    overwrites an image an earlier response (or a cached frontend URL) points
+    at. Paths handed out are relative to ``root`` — the same form the
+    ``/images`` route takes.
+    """
+
+    def __init__(self, root=".", derivatives=True, workers=None):
+        self.root = root
+        self.derivatives = derivatives
+        self.workers = workers
+        # Called with each new image's variants dict (e.g. to index it for retention)
+        self.listeners = []
+        self._pool = None
+
+    def abspath(self, relative_path: str) -> str:
+        return os.path.join(self.root, relative_path)
+
+    def exists(self, relative_path: str) -> bool:
+        return os.path.exists(self.abspath(relative_path))
+
+    def resolve(self, relative_path: str) -> str | None:
+        """Map a ``<user>_generated_images/<file>`` path to a file in the store, or None.
+
+        Anything else — other directories, other file types, traversal — is
+        rejected, so the image route can never serve arbitrary files.
+        """
+        parts = relative_path.replace("\\", "/").split("/")
+        if len(parts) != 2:
+            return None
+        directory, name = parts
+        if not directory.endswith(IMAGE_DIR_SUFFIX) or directory.startswith("."):
+            return None
+        if name.startswith(".") or os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+            return None
+
+        path = os.path.realpath(self.abspath(os.path.join(directory, name)))
+        root = os.path.realpath(self.root)
+        if os.path.dirname(os.path.dirname(path)) != root or not os.path.isfile(path):
+            return None
+        return path
+
+    # -------------------------------------------------------------------
+    # Originals
+    # -------------------------------------------------------------------
+
+    def save_base64(self, username: str, image_base64: str) -> str:
+        """Decode ``image_base64`` to disk chunk by chunk; returns the relative path."""
+        directory = user_dir_name(username)
+        os.makedirs(self.abspath(directory), exist_ok=True)
+
+        if "\n" in image_base64 or "\r" in image_base64:
+            image_base64 = "".join(image_base64.split())
+
+        digest = hashlib.sha256()
+        tmp_path = _atomic_target(self.abspath(os.path.join(directory, "upload")))
+        try:
+            with open(tmp_path, "wb") as f:
+                for start in range(0, len(image_base64), DECODE_CHUNK):
+                    chunk = base64.b64decode(image_base64[start:start + DECODE_CHUNK])
+                    digest.update(chunk)
+                    f.write(chunk)
+
+            relative_path = os.path.join(directory, digest.hexdigest()[:32] + ".png")
+            # Same bytes already stored: the existing file is identical, keep it
+            if self.exists(relative_path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, self.abspath(relative_path))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return relative_path
+
+    # -------------------------------------------------------------------
+    # Derivatives (WebP + thumbnail) in a process pool
+    # -------------------------------------------------------------------
+
+    def _executor(self):
+        if self._pool is None:
+            # spawn: forking a process that is running an event loop and threads is unsafe
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers or min(4, os.cpu_count() or 1),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._pool
+
+    def _variants(self, original, derived=None):
+        variants = {"original": original, "webp": None, "thumbnail": None}
+        if derived:
+            webp_path, thumb_path = derived
+            variants["webp"] = os.path.relpath(webp_path, self.root)
+            variants["thumbnail"] = os.path.relpath(thumb_path, self.root)
+        for listener in self.listeners:
+            listener(variants)
+        return variants
+
+    async def asave(self, username: str, image_base64: str) -> dict:
+        """Store one image and its derivatives without blocking the event loop.
+
+        Returns ``{"original", "webp", "thumbnail"}``; a derivative is ``None``
+        if Pillow could not produce it.
+        """
+        with stage("image_decode_write"):
+            original = await asyncio.to_thread(self.save_base64, username, image_base64)
+        return await self._aderivatives(original)
+
+    async def acrop(self, original: str, size: str) -> dict:
+        """Store ``original`` re-framed to ``size`` as a new image, with its derivatives.
+
+        Cropping and padding run in the process pool (see ``crops.derive_crop``);
+        returns the same variants dict as ``asave``.
+        """
+        loop = asyncio.get_running_loop()
+        with stage("image_crop"):
+            path = await loop.run_in_executor(self._executor(), derive_crop, self.abspath(original), size)
+        return await self._aderivatives(os.path.relpath(path, self.root))
+
+    async def _aderivatives(self, original):
+        derived = None
+        if self.derivatives:
+            loop = asyncio.get_running_loop()
+            try:
+                with stage("image_derivatives"):
+                    derived = await loop.run_in_executor(self._executor(), make_derivatives, self.abspath(original))
+            except Exception:
+                derived = None
+        return self._variants(original, derived)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,234 @@
+import asyncio
+import contextvars
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from models import GenerateRequest
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class QueueFull(Exception):
+    pass
+
+
+@dataclass
+class Job:
+    request: GenerateRequest
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    images: dict = field(default_factory=dict)
+    captions: dict = field(default_factory=dict)
+    result: dict | None = None
+    error: str | None = None
+    events: list = field(default_factory=list)
+    version: int = 0
+    _changed: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED)
+
+    def publish(self, event: str, data: dict):
+        self.events.append((event, data))
+        # Wake every subscriber, then arm a fresh event for the next update
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def snapshot(self) -> dict:
+        request = self.request
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": {
+                "images_done": len(self.images),
+                "images_total": request.num_images if request.want_images else 0,
+                "captions_done": len(self.captions),
+                "captions_total": request.num_captions if request.want_captions else 0,
+            },
+            "partial": {
+                "images": [self.images[i] for i in sorted(self.images)],
+                "captions": [self.captions[i] for i in sorted(self.captions)],
+            },
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class StoredJob:
+    """A job owned by another worker process, as last saved to the shared store."""
+
+    def __init__(self, job_id: str, snapshot: dict, events: list):
+        self.id = job_id
+        self._snapshot = snapshot
+        self.events = events
+
+    @property
+    def done(self) -> bool:
+        return self._snapshot["status"] in (SUCCEEDED, FAILED)
+
+    def snapshot(self) -> dict:
+        return self._snapshot
+
+
+class JobManager:
+    """Bounded queue of generation jobs drained by a fixed pool of worker tasks.
+
+    ``runner(request, emit)`` does the actual work and returns the final result;
+    it reports partial output through ``await emit(event, data)``, where event
+    is ``"image"`` (data ``{"index", "path"}``) or ``"caption"`` (``{"index", "text"}``).
+
+    With a ``store`` (``shared_state.SharedState``) every update is also
+    saved there, so with several worker processes a job can be polled or
+    streamed through whichever worker the request lands on.
+    """
+
+    def __init__(self, runner, workers=2, max_queue=100, ttl=3600, store=None, poll_interval=0.5):
+        self.runner = runner
+        self.workers = workers
+        self.max_queue = max_queue
+        self.ttl = ttl
+        self.store = store
+        self.poll_interval = poll_interval
+        self._jobs = {}
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        # Workers may be started lazily from inside a request; don't let them
+        # inherit that request's context variables (e.g. its upstream deadline)
+        self._tasks = [contextvars.Context().run(asyncio.create_task, self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def submit(self, request: GenerateRequest) -> Job:
+        self.start()
+        self._prune()
+
+        job = Job(request=request)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFull(f"Job queue is full ({self.max_queue} pending)")
+
+        self._jobs[job.id] = job
+        self._publish(job, "status", {"status": QUEUED})
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    async def find(self, job_id: str) -> Job | StoredJob | None:
+        """This process's job, else the shared store's copy of another worker's."""
+        job = self._jobs.get(job_id)
+        if job is not None or self.store is None:
+            return job
+        stored = await asyncio.to_thread(self.store.load_job, job_id)
+        return StoredJob(job_id, *stored) if stored is not None else None
+
+    def _publish(self, job: Job, event: str, data: dict):
+        job.publish(event, data)
+        if self.store is None:
+            return
+        job.version += 1
+        # Off the event loop; save_job drops a version that arrives after a newer one
+        asyncio.get_running_loop().run_in_executor(
+            None, self.store.save_job, job.id, job.version, job.done, job.snapshot(), list(job.events),
+        )
+
+    async def events(self, job: Job | StoredJob):
+        """Yield every event of ``job`` from the beginning, then live ones until it finishes."""
+        if isinstance(job, StoredJob):
+            async for event in self._stored_events(job):
+                yield event
+            return
+
+        sent = 0
+        while True:
+            changed = job._changed
+            while sent < len(job.events):
+                yield job.events[sent]
+                sent += 1
+            if job.done:
+                return
+            await changed.wait()
+
+    async def _stored_events(self, job: StoredJob):
+        sent = 0
+        while True:
+            while sent < len(job.events):
+                yield job.events[sent]
+                sent += 1
+            if job.done:
+                return
+            await asyncio.sleep(self.poll_interval)
+            stored = await asyncio.to_thread(self.store.load_job, job.id)
+            if stored is None:
+                return
+            job = StoredJob(job.id, *stored)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        job.status = RUNNING
+        job.started_at = time.time()
+        self._publish(job, "status", {"status": RUNNING})
+
+        async def emit(event, data):
+            if event == "image":
+                job.images[data["index"]] = data["path"]
+            elif event == "caption":
+                job.captions[data["index"]] = data["text"]
+            self._publish(job, event, data)
+
+        try:
+            job.result = await self.runner(job.request, emit)
+            job.status = SUCCEEDED
+        except asyncio.CancelledError:
+            job.error = "Job cancelled"
+            job.status = FAILED
+            raise
+        except Exception as e:
+            detail = getattr(e, "detail", None)
+            job.error = str(detail or e) or type(e).__name__
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+            if job.status == SUCCEEDED:
+                self._publish(job, "result", job.result)
+            else:
+                self._publish(job, "error", {"error": job.error})
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [j.id for j in self._jobs.values() if j.done and j.finished_at < cutoff]:
+            del self._jobs[job_id]
+        if self.store is not None:
+            asyncio.get_running_loop().run_in_executor(None, self.store.prune_jobs, cutoff)
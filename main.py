@@ -1,13 +1,70 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
+import asyncio
+import hmac
+import itertools
 import json
-from generator import generate_captions, generate_image
-from models import GenerateRequest
-from prompt import build_caption_prompt, build_image_prompt
+import math
+import os
+import re
+import sqlite3
+import time
+import weakref
+from collections import Counter
+from contextlib import asynccontextmanager
+from cache import ResultCache, cache_key
+from compression import CompressionMiddleware
+from generator import (
+    agenerate_captions,
+    agenerate_captions_merged,
+    agenerate_image_batch,
+    areplace_captions,
+    astream_captions,
+    caption_from_text,
+    image_backends,
+    image_store,
+    repair_captions,
+    text_backends,
+    upstream,
+)
+from history_store import CampaignStore
+from image_store import CONTENT_ADDRESSED_NAME, IMAGE_EXTENSIONS
+from jobs import JobManager, QueueFull
+from metrics import PROMPT_TOKENS, REGISTRY, MetricsMiddleware, ProfileStore, set_stage_labels, stage
+from models import BatchGenerateRequest, GenerateRequest, RegenerateRequest
+from prompt import build_caption_prompt, build_image_prompt, count_tokens, get_platform_rules, prompt_token_counts
+from retention import ImageRetention
+from scheduler import FairScheduler, Overloaded
+from shared_state import SharedState
+from similarity import SimilarityIndex, fingerprint, request_scope
+from singleflight import SingleFlight
+from sse import SSE_HEADERS, format_sse
+from upstream import CircuitOpenError, request_deadline
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    jobs.start()
+    retention.start()
+    if shared_state is not None:
+        shared_state.start()
+    yield
+    if shared_state is not None:
+        await shared_state.stop()
+    await retention.stop()
+    await jobs.stop()
+    image_store.shutdown()
+    await upstream.aclose()
+
+
+try:
+    import orjson  # noqa: F401
+    JSON_RESPONSE = ORJSONResponse
+except ImportError:
+    JSON_RESPONSE = JSONResponse
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan, default_response_class=JSON_RESPONSE)
 
 # ===================================================================
 # CORS MIDDLEWARE - Allows frontend to connect to backend
@@ -20,46 +77,292 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ===================================================================
+# UPSTREAM DEADLINES - every OpenAI call (and its retries) must finish
+# before the client gives up on us (streamlit_app.py waits 120s)
+# ===================================================================
+REQUEST_DEADLINE = float(os.getenv("SPARK_REQUEST_DEADLINE", "110"))
+JOB_DEADLINE = float(os.getenv("SPARK_JOB_DEADLINE", "600"))
+
+
+class DeadlineMiddleware:
+    def __init__(self, app, seconds):
+        self.app = app
+        self.seconds = seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        with request_deadline(self.seconds):
+            await self.app(scope, receive, send)
+
+
+app.add_middleware(DeadlineMiddleware, seconds=REQUEST_DEADLINE)
+
+# ===================================================================
+# COMPRESSION - gzip (or brotli, if installed) for JSON bodies
+# ===================================================================
+app.add_middleware(CompressionMiddleware, minimum_size=int(os.getenv("SPARK_COMPRESS_MIN_BYTES", "1024")))
+
+# ===================================================================
+# METRICS - per-stage histograms at /metrics, Server-Timing on every
+# response; SPARK_PROFILING=1 lets "X-Profile: 1" requests be profiled
+# ===================================================================
+profiles = ProfileStore() if os.getenv("SPARK_PROFILING") == "1" else None
+app.add_middleware(MetricsMiddleware, profiles=profiles)
+
+
+# ===================================================================
+# SHARED STATE - limiter buckets and job progress that every worker process
+# sees; set SPARK_SHARED_STATE (gunicorn.conf.py does) when running several
+# ===================================================================
+shared_state = SharedState(
+    os.environ["SPARK_SHARED_STATE"],
+    sync_interval=float(os.getenv("SPARK_SHARED_SYNC_INTERVAL", "0.2")),
+) if os.getenv("SPARK_SHARED_STATE") else None
+
+def shared_bucket(name, rate, capacity):
+    return shared_state.bucket(f"scheduler:{name}", rate, capacity)
+
+
+# ===================================================================
+# ADMISSION CONTROL - global RPM/TPM buckets, per-user buckets, fair queuing
+# ===================================================================
+scheduler = FairScheduler(
+    rpm=float(os.getenv("SPARK_UPSTREAM_RPM", "500")),
+    tpm=float(os.getenv("SPARK_UPSTREAM_TPM", "200000")),
+    user_rpm=float(os.getenv("SPARK_USER_RPM", "60")),
+    user_burst=float(os.getenv("SPARK_USER_BURST", "20")),
+    max_queue_depth=int(os.getenv("SPARK_MAX_QUEUE_DEPTH", "200")),
+    max_wait=float(os.getenv("SPARK_MAX_QUEUE_WAIT", "30")),
+    weights=json.loads(os.getenv("SPARK_USER_WEIGHTS", "{}")),
+    bucket=shared_bucket if shared_state is not None else None,
+)
+
+# Rough completion size per caption, for the TPM bucket
+CAPTION_OUTPUT_TOKENS = 150
+
+
+def upstream_cost(request: GenerateRequest, image_prompt, caption_prompt):
+    requests = tokens = 0
+    # Registered name, not the raw field: the label set must stay bounded
+    platform = get_platform_rules(request.platform).name
+    if image_prompt is not None:
+        requests += request.num_images
+        PROMPT_TOKENS.observe(count_tokens(image_prompt), kind="image", platform=platform)
+    if caption_prompt is not None:
+        requests += 1
+        prompt_tokens = count_tokens(caption_prompt)
+        PROMPT_TOKENS.observe(prompt_tokens, kind="caption", platform=platform)
+        tokens += prompt_tokens + CAPTION_OUTPUT_TOKENS * request.num_captions
+    return requests, tokens
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+    )
+
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
 # ===================================================================
 # SERVE GENERATED IMAGES
 # ===================================================================
-app.mount("/images", StaticFiles(directory="."), name="images")
+# Only the image store is exposed (not the working directory). Content-addressed
+# files never change, so browsers may cache them forever and revalidate for free.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
 
-def default_size_for_platform(platform: str) -> str:
-    p = platform.lower()
 
-    if p == "linkedin":
-        return "1024x1536"   # vertical professional
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses weak comparison: W/"x" matches "x"
+    candidates = [c.strip().removeprefix("W/") for c in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
 
-    if p == "instagram":
-        return "1024x1536"   # vertical feed optimized
 
-    if p in ("twitter", "x"):
-        return "1536x1024"   # horizontal
+def _parse_range(range_header: str, size: int):
+    """Return (start, end) inclusive for a single byte range, None to ignore it, or raise ValueError if unsatisfiable."""
+    match = RANGE_HEADER.match(range_header.strip())
+    if not match:
+        return None  # multi-range or malformed: ignore and send the whole file
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("unsatisfiable range")
+    return start, end
 
-    return "1024x1024"
 
-@app.post("/generate")
-def generate(request: GenerateRequest):
-    if not request.want_images and not request.want_captions:
-        raise HTTPException(status_code=400, detail="Select want_images or want_captions")
+def _iter_file(path: str, start: int, length: int, chunk_size: int = 64 * 1024):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
 
-    result = {}
+
+@app.api_route("/images/{image_path:path}", methods=["GET", "HEAD"])
+async def serve_image(image_path: str, request: Request):
+    path = image_store.resolve(image_path)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    retention.touch(image_path)
+
+    headers = {"Accept-Ranges": "bytes"}
+
+    # Serve the WebP derivative of a PNG to <img> fetches that say they accept it. Only
+    # those: browsers also accept image/webp on navigations and downloads, which must
+    # get the PNG bytes the .png name promises
+    if path.endswith(".png"):
+        headers["Vary"] = "Accept, Sec-Fetch-Dest"
+        if request.headers.get("sec-fetch-dest") == "image" and "image/webp" in request.headers.get("accept", ""):
+            webp_path = image_store.resolve(image_path[:-len(".png")] + ".webp")
+            if webp_path is not None:
+                path = webp_path
+
+    name = os.path.basename(path)
+    stat = await asyncio.to_thread(os.stat, path)
+    if CONTENT_ADDRESSED_NAME.match(name):
+        headers["ETag"] = f'"{name}"'
+        headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    else:
+        headers["ETag"] = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        headers["Cache-Control"] = "no-cache"
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    media_type = IMAGE_EXTENSIONS[os.path.splitext(name)[1].lower()]
+    range_header = request.headers.get("range")
+    if range_header:
+        try:
+            byte_range = _parse_range(range_header, stat.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            length = end - start + 1
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+            headers["Content-Length"] = str(length)
+            if request.method == "HEAD":
+                return Response(status_code=206, headers=headers, media_type=media_type)
+            return StreamingResponse(_iter_file(path, start, length), status_code=206, headers=headers, media_type=media_type)
+
+    return FileResponse(path, headers=headers, media_type=media_type, stat_result=stat)
+
+# ===================================================================
+# IMAGE RETENTION - byte quotas with least-recently-used eviction
+# ===================================================================
+retention = ImageRetention(
+    image_store,
+    path=os.getenv("SPARK_RETENTION_DB", "spark_images.db"),
+    quota_bytes=int(os.getenv("SPARK_IMAGE_QUOTA_BYTES", "0")),
+    user_quota_bytes=int(os.getenv("SPARK_USER_IMAGE_QUOTA_BYTES", "0")),
+    interval=float(os.getenv("SPARK_RETENTION_INTERVAL", "300")),
+    min_age=float(os.getenv("SPARK_RETENTION_MIN_AGE", "3600")),
+)
+image_store.listeners.append(retention.record_variants)
+
+# ===================================================================
+# RESULT CACHE - replays identical campaigns without calling OpenAI
+# ===================================================================
+result_cache = ResultCache(
+    directory=os.getenv("SPARK_CACHE_DIR", ".spark_cache"),
+    max_entries=int(os.getenv("SPARK_CACHE_ENTRIES", "256")),
+    ttl=int(os.getenv("SPARK_CACHE_TTL", str(24 * 3600))),
+    max_bytes=int(os.getenv("SPARK_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+    exists=image_store.exists,
+)
+inflight = SingleFlight()
+
+# Near-duplicates (a changed comma, different case, one extra word) of a
+# recent campaign for the same user and platform replay its result too,
+# for requests that opt in with allow_similar
+similar_results = SimilarityIndex(
+    max_distance=int(os.getenv("SPARK_SIMILAR_DISTANCE", "3")),
+    max_entries=int(os.getenv("SPARK_SIMILAR_ENTRIES", "10000")),
+    ttl=int(os.getenv("SPARK_CACHE_TTL", str(24 * 3600))),
+)
+
+
+def cached_result(request: GenerateRequest, key: str):
+    # Blocking. (result, response fields describing the hit) or (None, None)
+    result = result_cache.get(key)
+    scope, request_hash = request_scope(request), fingerprint(request)
+    if result is not None:
+        # Also re-indexes entries the disk tier kept across a restart
+        if "cropped_from" not in result:
+            similar_results.add(scope, request_hash, key)
+        return result, {"cache": "hit"}
+    if not request.allow_similar:
+        return None, None
+
+    match = similar_results.lookup(scope, request_hash)
+    if match is None:
+        return None, None
+    similar_key, distance = match
+    result = result_cache.get(similar_key)
+    if result is None or "cropped_from" in result:
+        # Expired, or its images were evicted (or a batch crop, which only exact batch hits reuse)
+        similar_results.discard(similar_key)
+        return None, None
+    return result, {"cache": "similar", "similarity": {"distance": distance, "max_distance": similar_results.max_distance}}
+
+
+def remember_result(request: GenerateRequest, key: str, result: dict):
+    # Blocking. Batch crops are not indexed: their request names the target platform,
+    # but the images were generated (with another prompt) for the source platform
+    result_cache.set(key, result)
+    if "cropped_from" not in result:
+        similar_results.add(request_scope(request), fingerprint(request), key)
+
+# ===================================================================
+# CAMPAIGN HISTORY - every generated campaign, queryable by page
+# ===================================================================
+history = CampaignStore(os.getenv("SPARK_HISTORY_DB", "spark_history.db"))
+
+async def record_campaigns(entries) -> list:
+    # entries: (request, result) pairs; the generated result matters more than its history row
+    rows = [(request.model_dump(), {k: v for k, v in result.items() if k != "cache"}) for request, result in entries]
+    try:
+        with stage("history_write"):
+            return await asyncio.to_thread(history.add_many, rows)
+    except sqlite3.Error:
+        return [None] * len(rows)
+
+async def record_campaign(request: GenerateRequest, result: dict):
+    return (await record_campaigns([(request, result)]))[0]
+
+def default_size_for_platform(platform: str) -> str:
+    # Per-platform sizes live in the prompt.py platform registry
+    return get_platform_rules(platform).default_size
+
+def build_prompts(request: GenerateRequest):
+    image_prompt = caption_prompt = size = None
 
     if request.want_images:
         image_prompt = build_image_prompt(request)
         size = default_size_for_platform(request.platform)
 
-        images = generate_image(
-            username=request.username,
-            prompt=image_prompt,
-            n=request.num_images,
-            size=size
-        )
-        result["images"] = images
-        result["image_prompt"] = image_prompt
-        result["size"] = size
-
     if request.want_captions:
         caption_prompt = build_caption_prompt(
             request.platform,
@@ -73,15 +376,689 @@ def generate(request: GenerateRequest):
             request.call_to_action
         )
 
-        captions = generate_captions(
-            prompt=caption_prompt,
-            n=request.num_captions
-        )
-        result["captions"] = captions
+    return image_prompt, caption_prompt, size
+
+
+def request_fingerprint(request: GenerateRequest, image_prompt, caption_prompt, size) -> str:
+    # Per user: results point at files in the user's own image folder (and count against
+    # their storage quota), and a coalesced request must not skip its own user's rate limit
+    return cache_key(
+        request.username,
+        image_prompt, size, request.num_images if request.want_images else 0, image_backends.configured(request.platform),
+        caption_prompt, request.num_captions if request.want_captions else 0, text_backends.configured(request.platform),
+    )
+
+
+def assemble_result(image_prompt, caption_prompt, size, images=None, image_errors=None, captions=None, platform=None,
+                    image_platform=None):
+    result = {}
+
+    if image_prompt is not None:
+        if image_errors and not images:
+            raise HTTPException(status_code=502, detail=f"Image generation failed: {image_errors[0]['error']}")
+        result["image_prompt"] = image_prompt
+        result["size"] = size
+        result["images"] = [variants["original"] for variants in images]
+        # Same order as "images"; lets galleries load the small thumbnails first
+        result["image_variants"] = images
+        if image_errors:
+            # Partial success: report which images failed instead of failing the batch
+            result["image_errors"] = image_errors
+
+    if caption_prompt is not None:
+        # "captions" stays a list of strings for existing clients; the parts live in caption_details
+        result["captions"] = [caption.text for caption in captions]
+        result["caption_details"] = [caption.model_dump() for caption in captions]
         result["caption_prompt"] = caption_prompt
 
+    result["prompt_tokens"] = prompt_token_counts(platform, image_prompt, caption_prompt, image_platform)
+    return result
+
+
+async def run_generation(request: GenerateRequest, image_prompt, caption_prompt, size, on_event=None):
+    # on_event(kind, data), if given, is awaited with each image/caption as soon as it is ready
+    tasks = {}
+
+    async def on_image(index, variants):
+        await on_event("image", {"index": index + 1, "path": variants["original"], "variants": variants})
+
+    async def captions_task():
+        if on_event is None:
+            return await agenerate_captions(prompt=caption_prompt, n=request.num_captions, platform=request.platform)
+
+        # Progress listeners get each caption as soon as its block is complete
+        streamed = []
+        async for text in astream_captions(caption_prompt, request.num_captions, platform=request.platform):
+            streamed.append(text)
+            await on_event("caption", {"index": len(streamed), "text": text})
+
+        rules = get_platform_rules(request.platform)
+        captions = await repair_captions(
+            caption_prompt, [caption_from_text(text, rules) for text in streamed], request.num_captions, request.platform,
+        )
+        # Repaired (or re-formatted) captions replace what was streamed at that index
+        for index, caption in enumerate(captions):
+            if index >= len(streamed) or caption.text != streamed[index]:
+                await on_event("caption", {"index": index + 1, "text": caption.text})
+        return captions
+
+    if image_prompt is not None:
+        tasks["images"] = agenerate_image_batch(
+            username=request.username,
+            prompt=image_prompt,
+            n=request.num_images,
+            size=size,
+            on_image=on_image if on_event is not None else None,
+            platform=request.platform,
+        )
+
+    if caption_prompt is not None:
+        tasks["captions"] = captions_task()
+
+    # Images and captions don't depend on each other: run both upstream calls at once
+    outputs = dict(zip(tasks.keys(), await asyncio.gather(*tasks.values())))
+    images, image_errors = outputs.get("images", (None, None))
+
+    return assemble_result(image_prompt, caption_prompt, size, images, image_errors, outputs.get("captions"), request.platform)
+
+
+PROMPT_FIELDS = ("image_prompt", "caption_prompt")
+# Needed to interpret whatever else was selected
+ALWAYS_FIELDS = {"cache", "similarity", "campaign_id", "image_errors", "error"}
+
+
+def select_fields(result: dict, fields: str | None = None, include_prompts: bool = True) -> dict:
+    # fields=images,captions keeps only those keys; include_prompts=false drops the (long) prompts
+    if fields:
+        wanted = {name.strip() for name in fields.split(",") if name.strip()} | ALWAYS_FIELDS
+        result = {k: v for k, v in result.items() if k in wanted}
+    if not include_prompts:
+        result = {k: v for k, v in result.items() if k not in PROMPT_FIELDS}
+    return result
+
+
+def validate_request(request: GenerateRequest):
+    if not request.want_images and not request.want_captions:
+        raise HTTPException(status_code=400, detail="Select want_images or want_captions")
+
+
+async def generate_and_store(request: GenerateRequest, key, image_prompt, caption_prompt, size, on_event=None, max_wait=None):
+    requests, tokens = upstream_cost(request, image_prompt, caption_prompt)
+    with stage("queue_wait"):
+        await scheduler.acquire(request.username, requests, tokens, max_wait=max_wait)
+
+    result = await run_generation(request, image_prompt, caption_prompt, size, on_event=on_event)
+    # Only complete results are worth replaying
+    if "image_errors" not in result:
+        await asyncio.to_thread(remember_result, request, key, result)
     return result
 
+
+@app.post("/generate")
+async def generate(request: GenerateRequest, fields: str | None = None, include_prompts: bool = True):
+    validate_request(request)
+    set_stage_labels(get_platform_rules(request.platform).name, request.want_images, request.want_captions)
+
+    image_prompt, caption_prompt, size = build_prompts(request)
+    key = request_fingerprint(request, image_prompt, caption_prompt, size)
+
+    if request.use_cache:
+        with stage("cache_lookup"):
+            cached, hit = await asyncio.to_thread(cached_result, request, key)
+        if cached is not None:
+            response = {**cached, **hit, "campaign_id": await record_campaign(request, cached)}
+            return JSON_RESPONSE(select_fields(response, fields, include_prompts))
+
+    async def produce():
+        return await generate_and_store(request, key, image_prompt, caption_prompt, size)
+
+    # Identical campaigns already in flight share one upstream call (and one set of files)
+    result, shared = await inflight.do(key, produce)
+
+    if shared:
+        status = "coalesced"
+    else:
+        status = "miss" if request.use_cache else "bypass"
+    response = {**result, "cache": status, "campaign_id": await record_campaign(request, result)}
+    # Already JSON-safe: skip FastAPI's jsonable_encoder pass over the whole result
+    return JSON_RESPONSE(select_fields(response, fields, include_prompts))
+
+@app.post("/generate/captions/stream")
+async def stream_captions(request: GenerateRequest):
+    # Captions only: each one is pushed as an SSE "caption" event the moment it is complete
+    request = request.model_copy(update={"want_images": False, "want_captions": True})
+    validate_request(request)
+    set_stage_labels(get_platform_rules(request.platform).name, False, True)
+    _, caption_prompt, _ = build_prompts(request)
+
+    # Admitted before the stream starts, so an overload is still a plain 429
+    requests, tokens = upstream_cost(request, None, caption_prompt)
+    with stage("queue_wait"):
+        await scheduler.acquire(request.username, requests, tokens)
+
+    async def stream():
+        started = time.perf_counter()
+        captions = []
+        try:
+            async for text in astream_captions(caption_prompt, request.num_captions, platform=request.platform):
+                captions.append(text)
+                yield format_sse("caption", {
+                    "index": len(captions),
+                    "text": text,
+                    "elapsed_ms": round((time.perf_counter() - started) * 1000),
+                })
+        except Exception as e:
+            yield format_sse("error", {"error": str(e) or type(e).__name__})
+            return
+        yield format_sse("done", {"captions": captions, "caption_prompt": caption_prompt})
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# ===================================================================
+# BATCH - one campaign across several platforms in a single call
+# ===================================================================
+
+BATCH_CONCURRENCY = int(os.getenv("SPARK_BATCH_CONCURRENCY", "8"))
+
+
+def expand_batch(batch: BatchGenerateRequest) -> list[list[GenerateRequest]]:
+    campaigns = list(batch.campaigns)
+    if batch.campaign is not None:
+        campaigns.insert(0, batch.campaign)
+
+    groups = []
+    for campaign in campaigns:
+        if not batch.platforms:
+            groups.append([campaign])
+            continue
+        # dict keeps order and drops repeated platforms
+        platforms = dict.fromkeys(p.strip().lower() for p in batch.platforms if p.strip())
+        groups.append([campaign.model_copy(update={"platform": p}) for p in platforms])
+    return groups
+
+
+def assign_crop_sources(items):
+    # Per campaign, the platform whose size most of the others share (the first on a tie)
+    # generates the images; the rest are cropped from them, so they report its image prompt
+    image_items = {}
+    for item in items:
+        if item["prompts"][0] is not None:
+            image_items.setdefault(item["group"], []).append(item)
+    for group_items in image_items.values():
+        sizes = Counter(item["prompts"][2] for item in group_items)
+        source = max(group_items, key=lambda item: sizes[item["prompts"][2]])
+        for item in group_items:
+            if item is not source:
+                _, caption_prompt, size = item["prompts"]
+                item["prompts"] = (source["prompts"][0], caption_prompt, size)
+                item["crop_source"] = source
+
+
+@app.post("/generate/batch")
+async def generate_batch(batch: BatchGenerateRequest, fields: str | None = None, include_prompts: bool = True):
+    groups = expand_batch(batch)
+    if not groups:
+        raise HTTPException(status_code=400, detail="Provide campaign and platforms, or campaigns")
+    for group in groups:
+        for request in group:
+            validate_request(request)
+
+    # Mixed platforms: label the batch's stages as a whole
+    set_stage_labels("batch", any(r.want_images for g in groups for r in g), any(r.want_captions for g in groups for r in g))
+
+    # Every upstream call in the batch (images and captions) shares one budget
+    budget = asyncio.Semaphore(max(1, batch.max_concurrency or BATCH_CONCURRENCY))
+
+    items = []
+    for group_index, group in enumerate(groups):
+        for request in group:
+            items.append({"group": group_index, "request": request, "prompts": build_prompts(request)})
+    if batch.derive_crops:
+        assign_crop_sources(items)
+    for item in items:
+        item["key"] = request_fingerprint(item["request"], *item["prompts"])
+
+    with stage("cache_lookup"):
+        cached = await asyncio.gather(*(
+            asyncio.to_thread(cached_result, item["request"], item["key"]) if item["request"].use_cache else asyncio.sleep(0, (None, None))
+            for item in items
+        ))
+    pending = []
+    for item, (result, hit) in zip(items, cached):
+        if result is not None:
+            item["result"] = {**result, **hit}
+        else:
+            pending.append(item)
+
+    # Each user in the batch is charged for their own campaigns; cropped images cost no upstream calls
+    charges = {}
+    for item in pending:
+        requests, tokens = upstream_cost(
+            item["request"], None if "crop_source" in item else item["prompts"][0], item["prompts"][1],
+        )
+        charged = charges.setdefault(item["request"].username, [0, 0])
+        charged[0] += requests
+        charged[1] += tokens
+    for username, (requests, tokens) in charges.items():
+        if scheduler.exceeds_limits(requests, tokens):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Batch needs {requests} upstream calls for {username!r}, more than the rate limits admit at once; split it",
+            )
+    if charges:
+        acquires = [
+            asyncio.ensure_future(scheduler.acquire(username, requests, tokens))
+            for username, (requests, tokens) in charges.items()
+        ]
+        try:
+            with stage("queue_wait"):
+                await asyncio.gather(*acquires)
+        except BaseException:
+            # One user overloaded (or the client left): the others must not stay queued for work that won't run
+            for acquire in acquires:
+                acquire.cancel()
+            await asyncio.gather(*acquires, return_exceptions=True)
+            raise
+
+    image_tasks = {}
+
+    def images_task(item):
+        # Shared: a crop source's images are awaited by each platform cropped from them
+        if id(item) not in image_tasks:
+            image_tasks[id(item)] = asyncio.ensure_future(images_for(item))
+        return image_tasks[id(item)]
+
+    async def images_for(item):
+        image_prompt, _, size = item["prompts"]
+        if image_prompt is None:
+            return None, None
+        if "crop_source" in item:
+            return await crops_for(item["crop_source"], size)
+        return await agenerate_image_batch(
+            username=item["request"].username,
+            prompt=image_prompt,
+            n=item["request"].num_images,
+            size=size,
+            semaphore=budget,
+            platform=item["request"].platform,
+        )
+
+    async def crops_for(source, size):
+        if "result" in source:
+            # The source was a cache hit
+            images = source["result"].get("image_variants") or [{"original": p} for p in source["result"].get("images", [])]
+            errors = list(source["result"].get("image_errors", []))
+        else:
+            images, errors = await images_task(source)
+        outcomes = await asyncio.gather(*(image_store.acrop(v["original"], size) for v in images), return_exceptions=True)
+        # The source's errors are shared with it and every other crop, so build a new list;
+        # a failed crop takes the index of its source image, which skips the source's failures
+        failed = {error["index"] for error in errors}
+        slots = (slot for slot in itertools.count(1) if slot not in failed)
+        errors = sorted(list(errors) + [
+            {"index": slot, "error": str(outcome) or type(outcome).__name__}
+            for slot, outcome in zip(slots, outcomes) if isinstance(outcome, BaseException)
+        ], key=lambda error: error["index"])
+        return [outcome for outcome in outcomes if not isinstance(outcome, BaseException)], errors
+
+    async def captions_for(group_items):
+        # Section ids must be unique within a merged completion
+        sections = {}
+        owners = {}
+        for item in group_items:
+            section_id = f"{item['request'].platform}-{len(sections) + 1}"
+            sections[section_id] = (item["prompts"][1], item["request"].num_captions, item["request"].platform)
+            owners[section_id] = id(item)
+        if batch.merge_captions:
+            captions = await agenerate_captions_merged(sections, semaphore=budget)
+        else:
+            outputs = await asyncio.gather(*(
+                agenerate_captions(p, n, semaphore=budget, platform=platform)
+                for p, n, platform in sections.values()
+            ))
+            captions = dict(zip(sections, outputs))
+        return {owners[section_id]: captions[section_id] for section_id in sections}
+
+    caption_groups = {}
+    for item in pending:
+        if item["prompts"][1] is not None:
+            caption_groups.setdefault(item["group"], []).append(item)
+
+    image_outcomes, caption_outcomes = await asyncio.gather(
+        asyncio.gather(*(images_task(item) for item in pending), return_exceptions=True),
+        asyncio.gather(*(captions_for(g) for g in caption_groups.values()), return_exceptions=True),
+    )
+
+    captions_by_item = {}
+    caption_failures = {}
+    for group_items, outcome in zip(caption_groups.values(), caption_outcomes):
+        for item in group_items:
+            if isinstance(outcome, BaseException):
+                caption_failures[id(item)] = outcome
+            else:
+                captions_by_item[id(item)] = outcome[id(item)]
+
+    for item, image_outcome in zip(pending, image_outcomes):
+        failure = image_outcome if isinstance(image_outcome, BaseException) else caption_failures.get(id(item))
+        try:
+            if failure is not None:
+                raise failure
+            images, image_errors = image_outcome
+            # A crop reports its source's image prompt, built from the source platform's template
+            source_platform = item["crop_source"]["request"].platform if "crop_source" in item else None
+            result = assemble_result(
+                *item["prompts"], images, image_errors, captions_by_item.get(id(item)), item["request"].platform,
+                source_platform,
+            )
+        except Exception as e:
+            item["result"] = {"error": str(getattr(e, "detail", None) or e) or type(e).__name__}
+            continue
+        if source_platform is not None:
+            result["cropped_from"] = source_platform
+        if "image_errors" not in result:
+            await asyncio.to_thread(remember_result, item["request"], item["key"], result)
+        item["result"] = {**result, "cache": "miss" if item["request"].use_cache else "bypass"}
+
+    # One history transaction for the whole batch
+    stored = [item for item in items if "error" not in item["result"]]
+    campaign_ids = await record_campaigns([(item["request"], item["result"]) for item in stored])
+    for item, campaign_id in zip(stored, campaign_ids):
+        item["result"]["campaign_id"] = campaign_id
+
+    campaigns = [{"platforms": {}} for _ in groups]
+    for item in items:
+        campaign = campaigns[item["group"]]
+        campaign.setdefault("company", item["request"].company)
+        campaign.setdefault("title", item["request"].title)
+        campaign["platforms"][item["request"].platform] = select_fields(item["result"], fields, include_prompts)
+
+    return JSON_RESPONSE({"campaigns": campaigns})
+
+
+# ===================================================================
+# BACKGROUND JOBS - submit now, poll or stream progress, fetch later
+# ===================================================================
+
+async def run_job(request: GenerateRequest, emit):
+    with request_deadline(JOB_DEADLINE):
+        return await _run_job(request, emit)
+
+
+async def _run_job(request: GenerateRequest, emit):
+    set_stage_labels(get_platform_rules(request.platform).name, request.want_images, request.want_captions)
+    image_prompt, caption_prompt, size = build_prompts(request)
+    key = request_fingerprint(request, image_prompt, caption_prompt, size)
+
+    if request.use_cache:
+        with stage("cache_lookup"):
+            cached, hit = await asyncio.to_thread(cached_result, request, key)
+        if cached is not None:
+            variants = cached.get("image_variants") or [{"original": p} for p in cached.get("images", [])]
+            for index, image in enumerate(variants, 1):
+                await emit("image", {"index": index, "path": image["original"], "variants": image})
+            for index, text in enumerate(cached.get("captions", []), 1):
+                await emit("caption", {"index": index, "text": text})
+            return {**cached, **hit, "campaign_id": await record_campaign(request, cached)}
+
+    # Jobs stream their own progress, so they skip single-flight coalescing
+    # Background jobs may wait for their turn for as long as the job deadline allows
+    result = await generate_and_store(request, key, image_prompt, caption_prompt, size, on_event=emit, max_wait=JOB_DEADLINE)
+    status = "miss" if request.use_cache else "bypass"
+    return {**result, "cache": status, "campaign_id": await record_campaign(request, result)}
+
+
+jobs = JobManager(
+    run_job,
+    workers=int(os.getenv("SPARK_JOB_WORKERS", "4")),
+    max_queue=int(os.getenv("SPARK_JOB_QUEUE", "100")),
+    ttl=int(os.getenv("SPARK_JOB_TTL", "3600")),
+    store=shared_state,
+)
+
+
+async def get_job_or_404(job_id: str):
+    job = await jobs.find(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(request: GenerateRequest):
+    validate_request(request)
+    try:
+        job = jobs.submit(request)
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "10"})
+
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "events_url": f"/jobs/{job.id}/events",
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, fields: str | None = None, include_prompts: bool = True):
+    snapshot = (await get_job_or_404(job_id)).snapshot()
+    if snapshot["result"] is not None:
+        snapshot["result"] = select_fields(snapshot["result"], fields, include_prompts)
+    return JSON_RESPONSE(snapshot)
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    job = await get_job_or_404(job_id)
+
+    async def stream():
+        async for event, data in jobs.events(job):
+            yield format_sse(event, data)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+# ===================================================================
+# CAMPAIGN HISTORY API - keyset pagination, so a page costs the same
+# whether there are ten campaigns or a million
+# ===================================================================
+
+@app.get("/campaigns")
+async def list_campaigns(
+    username: str | None = None,
+    platform: str | None = None,
+    company: str | None = None,
+    limit: int = 20,
+    cursor: str | None = None,
+    include_result: bool = False,
+):
+    limit = max(1, min(limit, 100))
+    try:
+        return await asyncio.to_thread(history.list, username, platform, company, limit, cursor, include_result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/campaigns/stats")
+async def campaign_stats(username: str | None = None, platform: str | None = None, company: str | None = None):
+    return await asyncio.to_thread(history.stats, username, platform, company)
+
+
+async def get_campaign_or_404(campaign_id: str):
+    campaign = await asyncio.to_thread(history.get, campaign_id)
+    if campaign is None:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return campaign
+
+
+@app.get("/campaigns/{campaign_id}")
+async def get_campaign(campaign_id: str, fields: str | None = None, include_prompts: bool = True):
+    campaign = await get_campaign_or_404(campaign_id)
+    campaign["result"] = select_fields(campaign["result"], fields, include_prompts)
+    return JSON_RESPONSE(campaign)
+
+
+def regenerate_slots(indices, current: int, requested: int, kind: str) -> list[int]:
+    # 1-based; a slot past the current list fills an image/caption that failed the first time
+    slots = sorted(set(indices))
+    limit = max(current, requested)
+    bad = [i for i in slots if not 1 <= i <= limit]
+    if bad:
+        raise HTTPException(status_code=400, detail=f"{kind} index out of range 1-{limit}: {bad}")
+    return slots
+
+
+# Regenerations of the same campaign run one at a time so neither overwrites the other
+# (within one worker; see gunicorn.conf.py)
+_regenerate_locks = weakref.WeakValueDictionary()
+
+
+@app.post("/campaigns/{campaign_id}/regenerate")
+async def regenerate_campaign(campaign_id: str, body: RegenerateRequest):
+    """Replace only the listed images/captions of a stored campaign, reusing its stored prompts."""
+    if not body.images and not body.captions:
+        raise HTTPException(status_code=400, detail="List the images and/or captions to regenerate")
+
+    lock = _regenerate_locks.setdefault(campaign_id, asyncio.Lock())
+    async with lock:
+        campaign = await get_campaign_or_404(campaign_id)
+        request = GenerateRequest(**campaign["request"])
+        result = campaign["result"]
+        set_stage_labels(get_platform_rules(request.platform).name, bool(body.images), bool(body.captions))
+
+        image_prompt, caption_prompt = result.get("image_prompt"), result.get("caption_prompt")
+        if body.images and image_prompt is None:
+            raise HTTPException(status_code=400, detail="This campaign has no images")
+        if body.captions and caption_prompt is None:
+            raise HTTPException(status_code=400, detail="This campaign has no captions")
+
+        # Stored images skip the slots that failed, while image_errors (and the
+        # slots asked for here) count every image requested
+        images = list(result.get("images") or [])
+        variants = list(result.get("image_variants") or [{"original": path} for path in images])
+        failed_before = {error["index"] for error in result.get("image_errors", [])}
+        stored_slots = (slot for slot in itertools.count(1) if slot not in failed_before)
+        slotted = dict(zip(stored_slots, zip(images, variants)))
+        captions = list(result.get("captions") or [])
+        rules = get_platform_rules(request.platform)
+        details = list(result.get("caption_details") or [caption_from_text(text, rules).model_dump() for text in captions])
+        image_slots = regenerate_slots(body.images, max([*slotted, *failed_before], default=0), request.num_images, "Image")
+        caption_slots = regenerate_slots(body.captions, len(captions), request.num_captions, "Caption")
+
+        # Same accounting as a fresh request, but only for the items being redone
+        tokens = 0
+        if caption_slots:
+            tokens = count_tokens(caption_prompt) + CAPTION_OUTPUT_TOKENS * len(caption_slots)
+        with stage("queue_wait"):
+            await scheduler.acquire(request.username, len(image_slots) + (1 if caption_slots else 0), tokens)
+
+        async def new_images():
+            if not image_slots:
+                return [], []
+            return await agenerate_image_batch(
+                username=request.username,
+                prompt=image_prompt,
+                n=len(image_slots),
+                size=result.get("size") or default_size_for_platform(request.platform),
+                platform=request.platform,
+            )
+
+        async def new_captions():
+            if not caption_slots:
+                return []
+            return await areplace_captions(caption_prompt, captions, len(caption_slots), platform=request.platform)
+
+        (fresh_images, image_errors), fresh_captions = await asyncio.gather(new_images(), new_captions())
+        if image_slots and not fresh_images:
+            raise HTTPException(status_code=502, detail=f"Image generation failed: {image_errors[0]['error']}")
+
+        # Batch error indices are 1-based positions within image_slots
+        failed = {error["index"] - 1 for error in image_errors}
+        new_errors = [{"index": image_slots[error["index"] - 1], "error": error["error"]} for error in image_errors]
+        image_slots = [slot for position, slot in enumerate(image_slots) if position not in failed]
+
+        replaced = {"images": [], "captions": []}
+        for slot, image in zip(image_slots, fresh_images):
+            slotted[slot] = image["original"], image
+            replaced["images"].append(slot)
+        images = [slotted[slot][0] for slot in sorted(slotted)]
+        variants = [slotted[slot][1] for slot in sorted(slotted)]
+        # Captions have no failed slots; ones past the end are appended, so report where they landed
+        for slot, caption in zip(caption_slots, fresh_captions):
+            if slot <= len(captions):
+                captions[slot - 1], details[slot - 1] = caption.text, caption.model_dump()
+            else:
+                captions.append(caption.text)
+                details.append(caption.model_dump())
+                slot = len(captions)
+            replaced["captions"].append(slot)
+
+        updated = dict(result)
+        if image_prompt is not None:
+            updated["images"], updated["image_variants"] = images, variants
+            retried = set(replaced["images"]) | {error["index"] for error in new_errors}
+            remaining_errors = [e for e in result.get("image_errors", []) if e["index"] not in retried] + new_errors
+            remaining_errors.sort(key=lambda error: error["index"])
+            if remaining_errors:
+                updated["image_errors"] = remaining_errors
+            else:
+                updated.pop("image_errors", None)
+        if caption_prompt is not None:
+            updated["captions"], updated["caption_details"] = captions, details
+
+        with stage("history_write"):
+            await asyncio.to_thread(history.update_result, campaign_id, updated)
+
+    return {**updated, "campaign_id": campaign_id, "regenerated": replaced}
+
+# ===================================================================
+# OBSERVABILITY
+# ===================================================================
+
+@app.get("/metrics")
+def get_metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/backends")
+def get_backends():
+    return {"image": image_backends.stats(), "text": text_backends.stats()}
+
+
+@app.get("/debug/profiles/{profile_id}")
+def get_profile(profile_id: str):
+    # Folded stacks (flamegraph.pl / speedscope) of a request sent with "X-Profile: 1"
+    folded = profiles.get(profile_id) if profiles is not None else None
+    if folded is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(folded)
+
+# ===================================================================
+# ADMIN
+# ===================================================================
+# Without SPARK_ADMIN_TOKEN the admin endpoints are disabled
+ADMIN_TOKEN = os.getenv("SPARK_ADMIN_TOKEN")
+
+def require_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set SPARK_ADMIN_TOKEN")
+    if not hmac.compare_digest(request.headers.get("x-admin-token", "").encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+@app.get("/admin/storage")
+async def get_storage(request: Request):
+    require_admin(request)
+    return await asyncio.to_thread(retention.stats)
+
+
+@app.post("/admin/storage/gc")
+async def collect_storage(request: Request):
+    # Runs a retention pass now instead of waiting for the next interval
+    require_admin(request)
+    run = await retention.run_now()
+    return {"run": run, **await asyncio.to_thread(retention.stats)}
+
 # Health check endpoint for Railway
 @app.get("/")
 def read_root():
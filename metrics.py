@@ -0,0 +1,340 @@
+import bisect
+import contextvars
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+# ===================================================================
+# METRIC TYPES - Prometheus text exposition, no client library needed
+# ===================================================================
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra="") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", *self._samples()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = defaultdict(float)
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] += amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_label_text(self.labels, key)} {_number(v)}" for key, v in values]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [count per bucket..., overflow], sum
+        self._counts = {}
+        self._sums = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        self.observe_key(self._key(labels), value)
+
+    def observe_key(self, key: tuple, value: float):
+        # Hot-path variant: ``key`` is the label values, already strings, in label order
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            self._sums[key] += value
+
+    def count(self, **labels) -> int:
+        return sum(self._counts.get(self._key(labels), ()))
+
+    def _samples(self):
+        with self._lock:
+            series = sorted((key, list(counts)) for key, counts in self._counts.items())
+        lines = []
+        for key, counts in series:
+            cumulative = 0
+            for bound, n in zip((*self.buckets, float("inf")), counts):
+                cumulative += n
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {_number(self._sums[key])}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: _Metric):
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# ===================================================================
+# SPARK METRICS
+# ===================================================================
+
+STAGE_LABELS = ("stage", "platform", "want_images", "want_captions")
+
+REQUEST_SECONDS = Histogram("spark_request_duration_seconds", "HTTP request latency.", ("handler", "method", "status"))
+REQUESTS_IN_FLIGHT = Gauge("spark_requests_in_flight", "HTTP requests currently being served.")
+STAGE_SECONDS = Histogram("spark_stage_duration_seconds", "Time spent in each generation stage.", STAGE_LABELS)
+UPSTREAM_IN_FLIGHT = Gauge("spark_upstream_in_flight", "OpenAI calls currently outstanding.", ("operation",))
+UPSTREAM_RETRIES = Counter("spark_upstream_retries_total", "OpenAI calls retried after a transient failure.", ("operation",))
+UPSTREAM_ERRORS = Counter("spark_upstream_errors_total", "Failed OpenAI call attempts.", ("operation", "error"))
+PROMPT_TOKENS = Histogram(
+    "spark_prompt_tokens", "Input tokens per upstream prompt.", ("kind", "platform"),
+    buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192),
+)
+CAPTION_REPAIRS = Counter("spark_caption_repairs_total", "Captions regenerated for breaking platform rules.", ("platform",))
+IMAGES_EVICTED = Counter("spark_images_evicted_total", "Images removed by retention to stay under quota.")
+IMAGE_BYTES_RECLAIMED = Counter("spark_image_bytes_reclaimed_total", "Bytes freed by image retention.")
+IMAGE_STORE_BYTES = Gauge("spark_image_store_bytes", "Bytes used by the image store as of the last retention run.")
+BACKEND_CALLS = Counter("spark_backend_calls_total", "Routed generation calls per backend.", ("kind", "backend", "outcome"))
+
+# ===================================================================
+# STAGE TIMING - per-request collector feeding Server-Timing
+# ===================================================================
+
+# Stage label values for the current request: (platform, want_images, want_captions)
+_stage_labels = contextvars.ContextVar("stage_labels", default=("default", "false", "false"))
+# [(stage, seconds)] for the current request; None outside a request
+_timings = contextvars.ContextVar("stage_timings", default=None)
+
+
+def set_stage_labels(platform=None, want_images=None, want_captions=None):
+    # platform must come from a bounded set (a registered platform name): every value is a new series
+    _stage_labels.set((
+        (platform or "default").lower(),
+        "true" if want_images else "false",
+        "true" if want_captions else "false",
+    ))
+
+
+def record_stage(name: str, seconds: float):
+    STAGE_SECONDS.observe_key((name, *_stage_labels.get()), seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+class stage:
+    """``with stage("name"):`` times the block into STAGE_SECONDS and the request's Server-Timing.
+
+    A plain class rather than @contextmanager: it wraps microsecond-scale
+    work such as prompt rendering, so its own overhead has to stay small.
+    """
+
+    __slots__ = ("name", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_stage(self.name, time.perf_counter() - self.started)
+
+
+def server_timing(timings) -> str:
+    """Server-Timing header value; repeated stages (e.g. one per image) are summed with their count."""
+    totals = {}
+    for name, seconds in timings:
+        total, count = totals.get(name, (0.0, 0))
+        totals[name] = (total + seconds, count + 1)
+    entries = []
+    for name, (total, count) in totals.items():
+        desc = f';desc="x{count}"' if count > 1 else ""
+        entries.append(f"{name}{desc};dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+# ===================================================================
+# SAMPLING PROFILER - opt-in, one request at a time
+# ===================================================================
+
+class SamplingProfiler:
+    """Samples one thread's Python stack every ``interval`` seconds from a helper thread.
+
+    ``stop()`` returns the stacks in folded format (``a;b;c <count>`` per
+    line), ready for flamegraph.pl or speedscope. The event loop is shared,
+    so samples taken while the profiled request awaits include whatever else
+    the loop was running at that moment.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.stacks = defaultdict(int)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="spark-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self) -> str:
+        self._stop.set()
+        self._thread.join()
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items(), key=lambda kv: -kv[1]))
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            if frames:
+                self.stacks[";".join(reversed(frames))] += 1
+
+
+class ProfileStore:
+    """The last ``size`` request profiles, by id."""
+
+    def __init__(self, size=20):
+        self.size = size
+        self._profiles = OrderedDict()
+
+    def add(self, folded: str) -> str:
+        profile_id = uuid.uuid4().hex
+        self._profiles[profile_id] = folded
+        while len(self._profiles) > self.size:
+            self._profiles.popitem(last=False)
+        return profile_id
+
+    def get(self, profile_id: str) -> str | None:
+        return self._profiles.get(profile_id)
+
+
+# ===================================================================
+# ASGI MIDDLEWARE
+# ===================================================================
+
+class MetricsMiddleware:
+    """Times every HTTP request, adds a ``Server-Timing`` header and, when
+    ``profiles`` is set, profiles requests sent with an ``X-Profile: 1`` header."""
+
+    def __init__(self, app, profiles: ProfileStore | None = None, profile_interval=0.005):
+        self.app = app
+        self.profiles = profiles
+        self.profile_interval = profile_interval
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = []
+        token = _timings.set(timings)
+        started = time.perf_counter()
+        status = 500
+        handler = "unmatched"
+        profiler = None
+        if self.profiles is not None and (b"x-profile", b"1") in scope.get("headers", ()):
+            profiler = SamplingProfiler(interval=self.profile_interval).start()
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = time.perf_counter() - started
+                value = server_timing([*timings, ("total", elapsed)])
+                headers = list(message.get("headers", ()))
+                headers.append((b"server-timing", value.encode("latin-1")))
+                if profiler is not None:
+                    profile_id = self.profiles.add(profiler.stop())
+                    headers.append((b"x-profile-id", profile_id.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            endpoint = scope.get("endpoint")
+            if endpoint is not None:
+                handler = endpoint.__name__
+            REQUEST_SECONDS.observe(time.perf_counter() - started, handler=handler, method=scope["method"], status=status)
+            if profiler is not None and profiler._thread.is_alive():
+                profiler.stop()
+            _timings.reset(token)
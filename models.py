@@ -15,6 +15,11 @@ class GenerateRequest(BaseModel):
 
     want_images: bool = True
     want_captions: bool = False
+    # Set to False to skip the result cache and always call OpenAI
+    use_cache: bool = True
+    # Set to True to also accept a recent near-identical campaign's result. Off by default:
+    # a one-word fact change ("2024" -> "2025", "Free" -> "No" shipping) is near-identical too
+    allow_similar: bool = False
 
     Target_audience: str | None = None
     Product: str | None = None
@@ -24,4 +29,37 @@ class GenerateRequest(BaseModel):
     features: list[str] | None = None
     layout: str | None = None
     mood: str | None = None
-    call_to_action: str | None = None
\ No newline at end of file
+    call_to_action: str | None = None
+
+
+class BatchGenerateRequest(BaseModel):
+    # One campaign fanned out to several platforms, and/or several complete campaigns.
+    # When platforms is set it applies to every campaign in the batch.
+    campaign: GenerateRequest | None = None
+    campaigns: list[GenerateRequest] = []
+    platforms: list[str] = []
+
+    max_concurrency: int | None = None
+    merge_captions: bool = True
+    # Generate each campaign's images once, at the size most of its platforms use,
+    # and crop / pad them locally for the other platforms instead of calling OpenAI again
+    derive_crops: bool = False
+
+
+class RegenerateRequest(BaseModel):
+    # 1-based slots of the stored campaign's images / captions to replace; image slots
+    # count failed images too, like the indices in "image_errors"
+    images: list[int] = []
+    captions: list[int] = []
+
+
+class Caption(BaseModel):
+    # One generated caption, split into its parts; issues lists any platform rule it still breaks
+    body: str
+    hashtags: list[str] = []
+    char_count: int = 0
+    issues: list[str] = []
+
+    @property
+    def text(self) -> str:
+        return f"{self.body}\n\n{' '.join(self.hashtags)}" if self.hashtags else self.body
@@ -1,36 +1,25 @@
+import json
+import os
+from dataclasses import dataclass, field
+from functools import lru_cache
+from string import Formatter
+
+from metrics import stage
 from models import GenerateRequest
+from scheduler import estimate_tokens
 
-def build_image_prompt(req:GenerateRequest) -> str:
-   
-    company = req.company or "the brand"
-    event = req.event or "a promotional campaign"
-    title = req.title or "Marketing Campaign"
-    description = req.product_description or "a modern digital product"
-    audience = req.Target_audience or "modern digital users"
-    color = req.color or "dynamic gradient tones"
-    style = req.Style or "modern digital illustration"
-    mood = req.mood or "bold, innovative, premium"
-
-    base = f"""
-Create a high-impact, visually striking social media campaign image.
+# ===================================================================
+# STATIC PROMPT PIECES - compiled once, filled with a single .format()
+# ===================================================================
 
-Brand context:
-Company: {company}
-Campaign/Event: {event}
-Theme: {title}
+# Prompts open with everything that is the same for every request on a
+# platform and end with the campaign's own fields, so the provider's prompt
+# cache can reuse the shared prefix across requests.
 
-Product essence:
-{description}
-
-Target audience:
-{audience}
+IMAGE_INSTRUCTIONS = """
+Create a high-impact, visually striking social media campaign image for the campaign described at the end.
 
-Call to action:
-{req.call_to_action or "Engage with our latest offering!"}
 Art direction:
-- Style: {style}
-- Mood: {mood}
-- Color palette inspiration: {color}
 - Cinematic lighting and strong depth
 - Clear focal point with dynamic composition
 - Layered background elements for richness
@@ -48,28 +37,293 @@ Avoid if not mentioned:
 - Text overlays, logos, or watermarks
 - if logo is given, still don't change it, logo should be as it is, don't change it, just use it as it is in the image, don't modify it in any way
 """.strip()
-    platform = (req.platform or "").lower()
-    match platform.lower():
-        case "linkedin":
-            return (
-                base + " Professional corporate design, clean minimal layout, ample whitespace, "
-                "subtle gradients, premium look, safe margins (keep key elements within center 70%)."
-            )
-        case "instagram":
-            return (
-                base + " Modern vibrant aesthetic, bold composition, lifestyle-friendly look, "
-                "rich visuals, high contrast, trendy but clean, safe margins."
-            )
-        case "twitter" | "x":
-            return (
-                base + " Bold, simple, high-contrast design, minimal elements, clear focal point, "
-                "optimized for fast scrolling, safe margins."
-            )
-        case _:
-            return base + " Clean modern design, safe margins, high quality."
+
+IMAGE_CONTEXT_TEMPLATE = """
+
+Brand context:
+Company: {company}
+Campaign/Event: {event}
+Theme: {title}
+
+Product essence:
+{description}
+
+Target audience:
+{audience}
+
+Call to action:
+{call_to_action}
+
+Campaign art direction:
+- Style: {style}
+- Mood: {mood}
+- Color palette inspiration: {color}"""
+
+CAPTION_FORMAT_INSTRUCTION = (
+    "\nFORMATTING RULES:\n"
+    "- Each caption must include BOTH the text AND hashtags together\n"
+    "- Separate each caption with TWO blank lines (\\n\\n)\n"
+    "- Do NOT separate hashtags from caption text\n"
+    "- Number the captions (Caption 1:, Caption 2:, etc.)"
+)
+
+CAPTION_COUNT_INSTRUCTION = "\n\nWrite EXACTLY {n} complete captions."
+
+
+def _literal(text: str) -> str:
+    # Config-supplied text goes into a format template; keep its braces literal
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+class CompiledTemplate:
+    """A ``str.format``-style template parsed once into literal segments.
+
+    ``render`` only splices string values between the precomputed literals
+    and joins them, which is several times cheaper than re-parsing the
+    template with ``.format()`` on every request.
+    """
+
+    __slots__ = ("template", "fields", "_parts")
+
+    def __init__(self, template: str):
+        self.template = template
+        parts = [""]
+        fields = []
+        for literal, field_name, _, _ in Formatter().parse(template):
+            # Escaped braces arrive as extra literal chunks; fold them into the current one
+            parts[-1] += literal
+            if field_name is not None:
+                parts.extend((None, ""))
+                fields.append(field_name)
+        self.fields = tuple(fields)
+        self._parts = parts
+
+    @property
+    def prefix(self) -> str:
+        """The literal text before the first field: identical in every render."""
+        return self._parts[0]
+
+    def render(self, values: dict) -> str:
+        parts = self._parts.copy()
+        parts[1::2] = [values[name] for name in self.fields]
+        return "".join(parts)
+
+
+# ===================================================================
+# PLATFORM REGISTRY
+# ===================================================================
+
+@dataclass(frozen=True)
+class PlatformRules:
+    """Everything that varies by platform: prompt wording, caption limits and default image size.
+
+    ``caption_intro`` introduces the campaign context near the end of the
+    caption prompt, with ``{n}`` standing for the caption count;
+    ``caption_rules`` and ``image_style`` go in the static prefix.
+    ``max_chars`` and ``hashtags`` (min, max) are what ``caption_issues``
+    checks generated captions against.
+    """
+
+    name: str
+    image_style: str
+    caption_intro: str
+    caption_rules: str
+    aliases: tuple[str, ...] = ()
+    default_size: str = "1024x1024"
+    max_chars: int | None = None
+    hashtags: tuple[int, int] | None = None
+
+    image_template: CompiledTemplate = field(init=False, repr=False, compare=False)
+    caption_template: CompiledTemplate = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        image_template = IMAGE_INSTRUCTIONS + "\n\nPlatform look:" + _literal(self.image_style) + IMAGE_CONTEXT_TEMPLATE
+        intro = _literal(self.caption_intro).replace("{{n}}", "{n}")
+        caption_template = (
+            "Caption guidelines:\n" + _literal(self.caption_rules) + CAPTION_FORMAT_INSTRUCTION
+            + "\n\n" + intro + "{context}" + CAPTION_COUNT_INSTRUCTION
+        )
+        object.__setattr__(self, "image_template", CompiledTemplate(image_template))
+        object.__setattr__(self, "caption_template", CompiledTemplate(caption_template))
+
+    def caption_issues(self, text: str, hashtags) -> list[str]:
+        """Ways a caption (full text plus its hashtag list) breaks this platform's rules."""
+        issues = []
+        if not text.strip():
+            issues.append("caption is empty")
+        if self.max_chars is not None and len(text) > self.max_chars:
+            issues.append(f"{len(text)} characters; keep it to {self.max_chars}")
+        if self.hashtags is not None:
+            low, high = self.hashtags
+            if not low <= len(hashtags) <= high:
+                issues.append(f"{len(hashtags)} hashtags; use {low}-{high}")
+        return issues
+
+
+DEFAULT_PLATFORM = PlatformRules(
+    name="default",
+    image_style=" Clean modern design, safe margins, high quality.",
+    caption_intro="Write {n} social media captions for: ",
+    caption_rules="- Include relevant hashtags at the end of each caption\n",
+)
+
+_PLATFORMS: dict[str, PlatformRules] = {}
+
+
+def register_platform(rules: PlatformRules):
+    for key in (rules.name, *rules.aliases):
+        _PLATFORMS[key.lower()] = rules
+
+
+def get_platform_rules(platform: str | None) -> PlatformRules:
+    return _PLATFORMS.get((platform or "").lower(), DEFAULT_PLATFORM)
+
+
+def registered_platforms() -> list[str]:
+    return sorted({rules.name for rules in _PLATFORMS.values()})
+
+
+def load_platform_config(path: str):
+    """Register platforms from a JSON list of PlatformRules fields (e.g. SPARK_PLATFORMS_FILE)."""
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    for entry in entries:
+        entry = dict(entry)
+        entry["aliases"] = tuple(entry.get("aliases", ()))
+        if entry.get("hashtags") is not None:
+            entry["hashtags"] = tuple(entry["hashtags"])
+        register_platform(PlatformRules(**entry))
+
+
+register_platform(PlatformRules(
+    name="linkedin",
+    image_style=(
+        " Professional corporate design, clean minimal layout, ample whitespace, "
+        "subtle gradients, premium look, safe margins (keep key elements within center 70%)."
+    ),
+    caption_intro="Write {n} professional LinkedIn captions for: ",
+    caption_rules=(
+        "- 3–5 lines each\n"
+        "- Confident, business-friendly tone\n"
+        "- Include 3–8 relevant hashtags at the end of each caption\n"
+        "- Avoid excessive emojis\n"
+    ),
+    default_size="1024x1536",   # vertical professional
+    max_chars=3000,
+    hashtags=(3, 8),
+))
+
+register_platform(PlatformRules(
+    name="instagram",
+    image_style=(
+        " Modern vibrant aesthetic, bold composition, lifestyle-friendly look, "
+        "rich visuals, high contrast, trendy but clean, safe margins."
+    ),
+    caption_intro="Write {n} Instagram captions for: ",
+    caption_rules=(
+        "- Friendly and catchy\n"
+        "- 1–3 short paragraphs\n"
+        "- Can use a few emojis\n"
+        "- Include 8–15 hashtags at the end of each caption\n"
+    ),
+    default_size="1024x1536",   # vertical feed optimized
+    max_chars=2200,
+    hashtags=(8, 15),
+))
+
+register_platform(PlatformRules(
+    name="twitter",
+    aliases=("x",),
+    image_style=(
+        " Bold, simple, high-contrast design, minimal elements, clear focal point, "
+        "optimized for fast scrolling, safe margins."
+    ),
+    caption_intro="Write {n} X (Twitter) posts for: ",
+    caption_rules=(
+        "- Max ~200 characters each\n"
+        "- Punchy and engaging\n"
+        "- Include 1–3 hashtags at the end of each post\n"
+    ),
+    default_size="1536x1024",   # horizontal
+    max_chars=200,
+    hashtags=(1, 3),
+))
+
+if os.getenv("SPARK_PLATFORMS_FILE"):
+    load_platform_config(os.environ["SPARK_PLATFORMS_FILE"])
+
+
+# ===================================================================
+# TOKEN ACCOUNTING - exact with tiktoken installed, estimated otherwise
+# ===================================================================
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(os.getenv("SPARK_TOKENIZER", "o200k_base"))
+    except Exception:
+        # Not installed, or the encoding files can't be fetched
+        return None
+
+
+@lru_cache(maxsize=1024)
+def count_tokens(text: str | None) -> int:
+    # Cached: admission control and the response both count the same prompt
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def prompt_token_counts(platform: str | None, image_prompt: str | None, caption_prompt: str | None,
+                        image_platform: str | None = None) -> dict:
+    """Input tokens per prompt, and how many of them are the platform's shared (cacheable) prefix.
+
+    ``image_platform`` is the platform whose template built ``image_prompt``
+    when that is not ``platform`` (batch crops reuse another platform's images).
+    """
+    rules = get_platform_rules(platform)
+    counts = {}
+    if image_prompt is not None:
+        image_rules = get_platform_rules(image_platform or platform)
+        counts["image"] = {"total": count_tokens(image_prompt), "static_prefix": count_tokens(image_rules.image_template.prefix)}
+    if caption_prompt is not None:
+        counts["caption"] = {"total": count_tokens(caption_prompt), "static_prefix": count_tokens(rules.caption_template.prefix)}
+    return counts
+
+
+# ===================================================================
+# PROMPT BUILDERS
+# ===================================================================
+
+def build_image_prompt(req:GenerateRequest) -> str:
+    with stage("prompt_image"):
+        return _render_image_prompt(req)
+
+
+def _render_image_prompt(req: GenerateRequest) -> str:
+    return get_platform_rules(req.platform).image_template.render({
+        "company": req.company or "the brand",
+        "event": req.event or "a promotional campaign",
+        "title": req.title or "Marketing Campaign",
+        "description": req.product_description or "a modern digital product",
+        "audience": req.Target_audience or "modern digital users",
+        "call_to_action": req.call_to_action or "Engage with our latest offering!",
+        "style": req.Style or "modern digital illustration",
+        "mood": req.mood or "bold, innovative, premium",
+        "color": req.color or "dynamic gradient tones",
+    })
 
 
 def build_caption_prompt(platform: str, company: str, event: str, title: str, details: str, n: int, target_audience: str | None = None, product: str | None = None, call_to_action: str | None = None) -> str:
+    with stage("prompt_caption"):
+        return _render_caption_prompt(platform, company, event, title, details, n, target_audience, product, call_to_action)
+
+
+def _render_caption_prompt(platform, company, event, title, details, n, target_audience, product, call_to_action) -> str:
     context = f"{company} — {event}. Title: {title}. Details: {details}."
 
     if target_audience:
@@ -79,46 +333,4 @@ def build_caption_prompt(platform: str, company: str, event: str, title: str, de
     if call_to_action:
         context += f" Call to action: {call_to_action}"
 
-    # FIXED: Clear formatting instructions that match the split logic
-    format_instruction = (
-        "\n\nFORMATTING RULES:\n"
-        "- Write EXACTLY {n} complete captions\n"
-        "- Each caption must include BOTH the text AND hashtags together\n"
-        "- Separate each caption with TWO blank lines (\\n\\n)\n"
-        "- Do NOT separate hashtags from caption text\n"
-        "- Number the captions (Caption 1:, Caption 2:, etc.)"
-    )
-
-    match platform.lower():
-        case "linkedin":
-            return (
-                f"Write {n} professional LinkedIn captions for: {context}\n"
-                "- 3–5 lines each\n"
-                "- Confident, business-friendly tone\n"
-                "- Include 3–8 relevant hashtags at the end of each caption\n"
-                "- Avoid excessive emojis\n"
-                + format_instruction.format(n=n)
-            )
-        case "instagram":
-            return (
-                f"Write {n} Instagram captions for: {context}\n"
-                "- Friendly and catchy\n"
-                "- 1–3 short paragraphs\n"
-                "- Can use a few emojis\n"
-                "- Include 8–15 hashtags at the end of each caption\n"
-                + format_instruction.format(n=n)
-            )
-        case "twitter" | "x":
-            return (
-                f"Write {n} X (Twitter) posts for: {context}\n"
-                "- Max ~200 characters each\n"
-                "- Punchy and engaging\n"
-                "- Include 1–3 hashtags at the end of each post\n"
-                + format_instruction.format(n=n)
-            )
-        case _:
-            return (
-                f"Write {n} social media captions for: {context}\n"
-                "- Include relevant hashtags at the end of each caption\n"
-                + format_instruction.format(n=n)
-            )
\ No newline at end of file
+    return get_platform_rules(platform).caption_template.render({"n": str(n), "context": context})
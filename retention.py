@@ -0,0 +1,303 @@
+import asyncio
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process only
+    fcntl = None
+
+from image_store import CONTENT_ADDRESSED_NAME, IMAGE_DIR_SUFFIX, IMAGE_EXTENSIONS
+from metrics import IMAGE_BYTES_RECLAIMED, IMAGE_STORE_BYTES, IMAGES_EVICTED
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    image TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_image ON files (image);
+CREATE INDEX IF NOT EXISTS files_owner ON files (owner, last_access);
+CREATE INDEX IF NOT EXISTS files_last_access ON files (last_access);
+"""
+
+
+def image_key(relative_path: str) -> str:
+    """Files that make up one image (original, WebP, thumbnail) share a key and are evicted together."""
+    directory, _, name = relative_path.replace("\\", "/").rpartition("/")
+    if CONTENT_ADDRESSED_NAME.match(name):
+        return f"{directory}/{name[:32]}"
+    return relative_path
+
+
+class ImageRetention:
+    """Size / last-access index of the image store with LRU eviction under byte quotas.
+
+    Writes and reads are recorded in memory (cheap enough for the request
+    path) and folded into a SQLite index by ``collect``, which runs in a
+    worker thread from the background task. ``collect`` then evicts whole
+    images, least recently used first, until each user is under
+    ``user_quota_bytes`` and the store is under ``quota_bytes`` (down to
+    ``low_watermark`` of the quota, so it doesn't run on every new image).
+    Images younger than ``min_age`` seconds are never evicted; a response
+    that just handed out their URLs may not have been fetched yet. A quota
+    of 0 means unlimited.
+    """
+
+    def __init__(self, store, path="spark_images.db", quota_bytes=0, user_quota_bytes=0,
+                 interval=300.0, min_age=3600.0, low_watermark=0.9):
+        self.store = store
+        self.path = path
+        self.quota_bytes = quota_bytes
+        self.user_quota_bytes = user_quota_bytes
+        self.interval = interval
+        self.min_age = min_age
+        self.low_watermark = low_watermark
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._written = set()
+        self._touched = {}
+        self._scanned = False
+        self._task = None
+        self._running = None
+        self.totals = {"runs": 0, "evicted_images": 0, "evicted_files": 0, "reclaimed_bytes": 0}
+        self.last_run = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # -------------------------------------------------------------------
+    # Request-path hooks (memory only)
+    # -------------------------------------------------------------------
+
+    def record_variants(self, variants: dict):
+        """ImageStore listener: a new original and its derivatives were written."""
+        with self._lock:
+            self._written.update(path for path in variants.values() if path)
+
+    def touch(self, relative_path: str):
+        with self._lock:
+            self._touched[image_key(relative_path)] = time.time()
+
+    # -------------------------------------------------------------------
+    # Index maintenance (blocking; worker thread)
+    # -------------------------------------------------------------------
+
+    def flush(self):
+        with self._lock:
+            written, self._written = self._written, set()
+            touched, self._touched = self._touched, {}
+
+        now = time.time()
+        rows = []
+        for relative_path in written:
+            try:
+                size = os.stat(self.store.abspath(relative_path)).st_size
+            except OSError:
+                continue
+            rows.append((relative_path, image_key(relative_path), _owner(relative_path), size, now))
+
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO files (path, image, owner, size, last_access) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT(path) DO UPDATE SET size = excluded.size, last_access = excluded.last_access",
+                rows,
+            )
+            conn.executemany("UPDATE files SET last_access = ? WHERE image = ?", [(t, k) for k, t in touched.items()])
+
+    def scan(self):
+        """Reconcile the index with the files on disk (first run, or after files were removed by hand)."""
+        root = self.store.root
+        on_disk = {}
+        with os.scandir(root) as entries:
+            directories = [e.name for e in entries if e.is_dir() and e.name.endswith(IMAGE_DIR_SUFFIX)]
+        for directory in directories:
+            with os.scandir(os.path.join(root, directory)) as entries:
+                for entry in entries:
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                        stat = entry.stat()
+                        on_disk[f"{directory}/{entry.name}"] = (stat.st_size, stat.st_mtime)
+
+        conn = self._connect()
+        indexed = {row[0] for row in conn.execute("SELECT path FROM files")}
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in indexed - on_disk.keys()])
+            conn.executemany(
+                "INSERT INTO files (path, image, owner, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                [(p, image_key(p), _owner(p), size, mtime) for p, (size, mtime) in on_disk.items() if p not in indexed],
+            )
+        self._scanned = True
+
+    @contextlib.contextmanager
+    def _exclusive(self):
+        # With several worker processes only one collects at a time; the others just flush
+        if fcntl is None:
+            yield True
+            return
+        with open(f"{self.path}.lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def collect(self) -> dict:
+        """Flush pending updates and evict until every quota holds; returns this run's stats."""
+        with self._exclusive() as owned:
+            if owned:
+                return self._collect()
+        self.flush()
+        return {"skipped": "another process is collecting"}
+
+    def _collect(self) -> dict:
+        started = time.monotonic()
+        if not self._scanned:
+            self.scan()
+        self.flush()
+
+        conn = self._connect()
+        cutoff = time.time() - self.min_age
+        evicted_images = evicted_files = reclaimed = 0
+
+        if self.user_quota_bytes:
+            over = conn.execute(
+                "SELECT owner, SUM(size) FROM files GROUP BY owner HAVING SUM(size) > ?", (self.user_quota_bytes,)
+            ).fetchall()
+            for owner, used in over:
+                candidates = conn.execute(
+                    "SELECT image, SUM(size), MAX(last_access) AS la FROM files WHERE owner = ?"
+                    " GROUP BY image HAVING la < ? ORDER BY la",
+                    (owner, cutoff),
+                )
+                images, files, freed = self._evict(conn, candidates, used - self.user_quota_bytes * self.low_watermark)
+                evicted_images, evicted_files, reclaimed = evicted_images + images, evicted_files + files, reclaimed + freed
+
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        if self.quota_bytes and total > self.quota_bytes:
+            candidates = conn.execute(
+                "SELECT image, SUM(size), MAX(last_access) AS la FROM files GROUP BY image HAVING la < ? ORDER BY la",
+                (cutoff,),
+            )
+            images, files, freed = self._evict(conn, candidates, total - self.quota_bytes * self.low_watermark)
+            evicted_images, evicted_files, reclaimed = evicted_images + images, evicted_files + files, reclaimed + freed
+
+        self.totals["runs"] += 1
+        self.totals["evicted_images"] += evicted_images
+        self.totals["evicted_files"] += evicted_files
+        self.totals["reclaimed_bytes"] += reclaimed
+        IMAGES_EVICTED.inc(evicted_images)
+        IMAGE_BYTES_RECLAIMED.inc(reclaimed)
+        IMAGE_STORE_BYTES.set(conn.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0])
+
+        self.last_run = {
+            "finished_at": time.time(),
+            "duration_s": round(time.monotonic() - started, 4),
+            "evicted_images": evicted_images,
+            "evicted_files": evicted_files,
+            "reclaimed_bytes": reclaimed,
+        }
+        return self.last_run
+
+    def _evict(self, conn, candidates, need_bytes):
+        images = files = freed = 0
+        # Materialize first: the deletes below would disturb an open cursor
+        for image, size, _ in candidates.fetchall():
+            if freed >= need_bytes:
+                break
+            paths = [row[0] for row in conn.execute("SELECT path FROM files WHERE image = ?", (image,))]
+            for relative_path in paths:
+                try:
+                    os.remove(self.store.abspath(relative_path))
+                except FileNotFoundError:
+                    pass
+                files += 1
+            conn.execute("DELETE FROM files WHERE image = ?", (image,))
+            images += 1
+            freed += size
+            directory = os.path.dirname(self.store.abspath(paths[0])) if paths else None
+            if directory:
+                try:
+                    os.rmdir(directory)  # only succeeds once the user's folder is empty
+                except OSError:
+                    pass
+        return images, files, freed
+
+    def usage(self, top=10) -> dict:
+        conn = self._connect()
+        total, files = conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM files").fetchone()
+        users = conn.execute(
+            "SELECT owner, SUM(size) AS used, COUNT(DISTINCT image) FROM files GROUP BY owner ORDER BY used DESC LIMIT ?",
+            (top,),
+        ).fetchall()
+        return {
+            "bytes": total,
+            "files": files,
+            "top_users": [{"user": owner, "bytes": used, "images": images} for owner, used, images in users],
+        }
+
+    def stats(self) -> dict:
+        return {
+            "quota_bytes": self.quota_bytes,
+            "user_quota_bytes": self.user_quota_bytes,
+            "min_age_s": self.min_age,
+            "interval_s": self.interval,
+            "usage": self.usage(),
+            "totals": dict(self.totals),
+            "last_run": self.last_run,
+        }
+
+    # -------------------------------------------------------------------
+    # Background task
+    # -------------------------------------------------------------------
+
+    async def run_now(self) -> dict:
+        # One collection at a time, whether from the timer or the admin endpoint
+        if self._running is None:
+            self._running = asyncio.Lock()
+        async with self._running:
+            return await asyncio.to_thread(self.collect)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.to_thread(self.flush)
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_now()
+            except Exception:
+                # A failed run (disk error, locked database) is retried next interval
+                pass
+            await asyncio.sleep(self.interval)
+
+
+def _owner(relative_path: str) -> str:
+    directory = relative_path.replace("\\", "/").partition("/")[0]
+    return directory[:-len(IMAGE_DIR_SUFFIX)] if directory.endswith(IMAGE_DIR_SUFFIX) else directory
@@ -0,0 +1,234 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+
+class Overloaded(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def estimate_tokens(text: str | None) -> int:
+    # ~4 characters per token for English prose; good enough for admission control
+    return len(text) // 4 + 1 if text else 0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def deficit_wait(self, amount: float, now: float) -> float:
+        # Unlike wait_time, amount may exceed capacity (work queued ahead of us)
+        self._refill(now)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.tokens -= min(amount, self.capacity)
+
+
+class _Waiter:
+    __slots__ = ("username", "requests", "tokens", "finish_tag", "future")
+
+    def __init__(self, username, requests, tokens, finish_tag, future):
+        self.username = username
+        self.requests = requests
+        self.tokens = tokens
+        self.finish_tag = finish_tag
+        self.future = future
+
+
+class FairScheduler:
+    """Admission control in front of the upstream calls.
+
+    A global request bucket and token bucket mirror the OpenAI RPM/TPM limits
+    and each username gets its own request bucket. Waiting work is released
+    in weighted-fair-queuing order: every user's next item carries a virtual
+    finish tag, and the smallest tag whose user bucket can afford it goes
+    first, so one tenant's burst only delays that tenant. When the queue is
+    too deep or the estimated wait too long, ``acquire`` raises
+    ``Overloaded`` with a Retry-After hint instead of queueing.
+
+    ``bucket(name, rate, capacity)`` builds the buckets; pass one returning
+    ``shared_state.SharedTokenBucket`` to enforce the limits across worker
+    processes (queueing order stays per process).
+    """
+
+    def __init__(
+        self,
+        rpm=500,
+        tpm=200_000,
+        user_rpm=60,
+        user_burst=20,
+        max_queue_depth=200,
+        max_wait=30.0,
+        weights=None,
+        bucket=None,
+    ):
+        self.bucket = bucket or (lambda name, rate, capacity: TokenBucket(rate, capacity))
+        self.requests = self.bucket("requests", rpm / 60.0, max(1.0, rpm / 6.0))
+        self.tokens = self.bucket("tokens", tpm / 60.0, max(1.0, tpm / 6.0))
+        self.user_rpm = user_rpm
+        self.user_burst = user_burst
+        self.max_queue_depth = max_queue_depth
+        self.max_wait = max_wait
+        self.weights = weights or {}
+        self._user_buckets = {}
+        self._queues = {}
+        self._last_finish = {}
+        self._virtual_time = 0.0
+        self._depth = 0
+        self._queued_requests = 0.0
+        self._queued_tokens = 0.0
+        self._timer = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._depth
+
+    def _user_bucket(self, username):
+        bucket = self._user_buckets.get(username)
+        if bucket is None:
+            if len(self._user_buckets) >= 10_000:
+                self._prune_idle()
+            bucket = self._user_buckets[username] = self.bucket(f"user:{username}", self.user_rpm / 60.0, self.user_burst)
+        return bucket
+
+    def _prune_idle(self):
+        # An idle user with a full bucket is indistinguishable from a new one
+        now = time.monotonic()
+        for username in [u for u in self._user_buckets if u not in self._queues]:
+            bucket = self._user_buckets[username]
+            bucket._refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._user_buckets[username]
+                if self._last_finish.get(username, 0.0) <= self._virtual_time:
+                    self._last_finish.pop(username, None)
+
+    def _finish_tag(self, username: str, requests: float) -> float:
+        weight = self.weights.get(username, 1.0)
+        start = max(self._virtual_time, self._last_finish.get(username, 0.0))
+        return start + requests / weight
+
+    def estimated_wait(self, username: str, requests: float, tokens: float) -> float:
+        """Seconds until new work for ``username`` could start, given what WFQ would release first."""
+        now = time.monotonic()
+        finish_tag = self._finish_tag(username, requests)
+        ahead_requests = ahead_tokens = user_requests = 0.0
+        for queue in self._queues.values():
+            for waiter in queue:
+                if waiter.finish_tag <= finish_tag:
+                    ahead_requests += waiter.requests
+                    ahead_tokens += waiter.tokens
+                if waiter.username == username:
+                    user_requests += waiter.requests
+        return max(
+            self.requests.deficit_wait(ahead_requests + requests, now),
+            self.tokens.deficit_wait(ahead_tokens + tokens, now),
+            self._user_bucket(username).deficit_wait(user_requests + requests, now),
+        )
+
+    def exceeds_limits(self, requests: float, tokens: float = 0, max_wait: float | None = None) -> bool:
+        """True when even idle buckets could not admit this much work within ``max_wait``.
+
+        ``acquire`` would answer such work with an ``Overloaded`` whose
+        Retry-After can never come true; callers should reject or split it.
+        """
+        max_wait = self.max_wait if max_wait is None else max_wait
+        return max(
+            (requests - self.requests.capacity) / self.requests.rate,
+            (tokens - self.tokens.capacity) / self.tokens.rate,
+            (requests - self.user_burst) / (self.user_rpm / 60.0),
+        ) > max_wait
+
+    async def acquire(self, username: str, requests: float = 1, tokens: float = 0, max_wait: float | None = None):
+        """Wait until ``requests`` upstream calls using ``tokens`` tokens may start for ``username``."""
+        max_wait = self.max_wait if max_wait is None else max_wait
+        username = username or "anonymous"
+
+        if self._depth >= self.max_queue_depth:
+            raise Overloaded("Too many queued generation requests", max(1.0, self.estimated_wait(username, requests, tokens)))
+        wait = self.estimated_wait(username, requests, tokens)
+        if wait > max_wait:
+            raise Overloaded(f"Estimated wait {wait:.0f}s exceeds {max_wait:.0f}s", wait)
+
+        finish_tag = self._finish_tag(username, requests)
+        self._last_finish[username] = finish_tag
+
+        waiter = _Waiter(username, requests, tokens, finish_tag, asyncio.get_running_loop().create_future())
+        self._queues.setdefault(username, deque()).append(waiter)
+        self._depth += 1
+        self._queued_requests += requests
+        self._queued_tokens += tokens
+        self._pump()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            # Client went away while queued: give its place back
+            self._remove(waiter)
+            raise
+
+    def _remove(self, waiter):
+        queue = self._queues.get(waiter.username)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            self._depth -= 1
+            self._queued_requests -= waiter.requests
+            self._queued_tokens -= waiter.tokens
+            if not queue:
+                del self._queues[waiter.username]
+
+    def _pump(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._queues:
+            now = time.monotonic()
+            best = None
+            soonest = math.inf
+            for username, queue in self._queues.items():
+                head = queue[0]
+                wait = self._user_bucket(username).wait_time(head.requests, now)
+                if wait > 0:
+                    soonest = min(soonest, wait)
+                elif best is None or head.finish_tag < best.finish_tag:
+                    best = head
+
+            if best is None:
+                self._schedule(soonest)
+                return
+
+            global_wait = max(self.requests.wait_time(best.requests, now), self.tokens.wait_time(best.tokens, now))
+            if global_wait > 0:
+                self._schedule(global_wait)
+                return
+
+            self.requests.take(best.requests, now)
+            self.tokens.take(best.tokens, now)
+            self._user_bucket(best.username).take(best.requests, now)
+            self._virtual_time = max(self._virtual_time, best.finish_tag)
+            self._remove(best)
+            if not best.future.done():
+                best.future.set_result(None)
+
+    def _schedule(self, delay):
+        if math.isfinite(delay):
+            self._timer = asyncio.get_running_loop().call_later(delay, self._pump)
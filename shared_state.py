@@ -0,0 +1,181 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import weakref
+
+from scheduler import TokenBucket
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    done INTEGER NOT NULL,
+    updated REAL NOT NULL,
+    snapshot TEXT NOT NULL,
+    events TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated);
+"""
+
+
+class SharedState:
+    """State every worker process must agree on, in one local SQLite file.
+
+    Holds the rate limiter's token buckets and background job snapshots, so
+    limits hold across workers and any worker can answer for any job. No
+    server to run: the file just has to be on a disk all workers see.
+    """
+
+    def __init__(self, path="spark_state.db", sync_interval=0.2):
+        self.path = path
+        self.sync_interval = sync_interval
+        self._local = threading.local()
+        self._buckets = weakref.WeakValueDictionary()
+        self._task = None
+
+    def connect(self) -> sqlite3.Connection:
+        # Per thread and per process: a connection inherited through fork must not be reused
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Limiter levels and job progress are worth nothing after a crash; skip the fsyncs
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # -------------------------------------------------------------------
+    # Jobs
+    # -------------------------------------------------------------------
+
+    def save_job(self, job_id: str, version: int, done: bool, snapshot: dict, events: list):
+        # Saves can finish out of order (they run on a thread pool); an older version never wins
+        self.connect().execute(
+            "INSERT INTO jobs (id, version, done, updated, snapshot, events) VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT(id) DO UPDATE SET version = excluded.version, done = excluded.done,"
+            " updated = excluded.updated, snapshot = excluded.snapshot, events = excluded.events"
+            " WHERE excluded.version > jobs.version",
+            (job_id, version, int(done), time.time(), json.dumps(snapshot), json.dumps(events)),
+        )
+
+    def load_job(self, job_id: str) -> tuple[dict, list] | None:
+        row = self.connect().execute("SELECT snapshot, events FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), [tuple(event) for event in json.loads(row[1])]
+
+    def prune_jobs(self, finished_before: float):
+        self.connect().execute("DELETE FROM jobs WHERE done = 1 AND updated < ?", (finished_before,))
+
+    # -------------------------------------------------------------------
+    # Token buckets
+    # -------------------------------------------------------------------
+
+    def bucket(self, name: str, rate: float, capacity: float) -> "SharedTokenBucket":
+        bucket = SharedTokenBucket(name, rate, capacity)
+        self._buckets[name] = bucket
+        return bucket
+
+    def sync_buckets(self):
+        """Merge every live bucket with its shared level, in one write transaction. Blocking."""
+        buckets = list(self._buckets.values())
+        if not buckets:
+            return
+        conn = self.connect()
+        taken = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Stored levels carry wall-clock timestamps so every process refills them the same way
+            now = time.time()
+            stored = {name: (tokens, updated) for name, tokens, updated in conn.execute("SELECT name, tokens, updated FROM buckets")}
+            levels = []
+            for bucket in buckets:
+                with bucket.lock:
+                    consumed, bucket.consumed = bucket.consumed, 0.0
+                taken.append((bucket, consumed))
+                tokens, updated = stored.get(bucket.name, (bucket.capacity, now))
+                levels.append(min(bucket.capacity, tokens + max(0.0, now - updated) * bucket.rate) - consumed)
+            conn.executemany(
+                "INSERT INTO buckets (name, tokens, updated) VALUES (?, ?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                [(bucket.name, level, now) for bucket, level in zip(buckets, levels)],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            # Not recorded: carry it over to the next sync
+            for bucket, consumed in taken:
+                with bucket.lock:
+                    bucket.consumed += consumed
+            raise
+
+        synced = time.monotonic()
+        for bucket, level in zip(buckets, levels):
+            with bucket.lock:
+                # Anything taken while the transaction ran is not in the shared level yet
+                bucket.tokens = level - bucket.consumed
+                bucket.updated = synced
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._sync_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await asyncio.to_thread(self.sync_buckets)
+        except sqlite3.Error:
+            pass
+
+    async def _sync_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.sync_buckets)
+            except sqlite3.Error:
+                # Locked or unavailable: the local levels keep working, retry next interval
+                pass
+            await asyncio.sleep(self.sync_interval)
+
+
+class SharedTokenBucket(TokenBucket):
+    """``scheduler.TokenBucket`` whose level is shared through ``SharedState``.
+
+    The scheduler only ever reads and takes from the in-process level, so
+    admission never waits on SQLite. ``SharedState.sync_buckets``, run in the
+    background, adds what this process took since the last sync to the
+    shared level and pulls back what every process left. Between syncs each
+    process can overshoot by what it admits in one sync interval.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float):
+        super().__init__(rate, capacity)
+        self.name = name
+        self.consumed = 0.0
+        # The sync runs on a worker thread
+        self.lock = threading.Lock()
+
+    def wait_time(self, amount: float, now: float) -> float:
+        with self.lock:
+            return super().wait_time(amount, now)
+
+    def deficit_wait(self, amount: float, now: float) -> float:
+        with self.lock:
+            return super().deficit_wait(amount, now)
+
+    def take(self, amount: float, now: float):
+        with self.lock:
+            super().take(amount, now)
+            self.consumed += min(amount, self.capacity)
@@ -0,0 +1,135 @@
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# Free-text GenerateRequest fields that describe the campaign (and so feed the fingerprint)
+TEXT_FIELDS = (
+    "company", "event", "title", "product_description", "brand_name", "color",
+    "Target_audience", "Product", "Style", "campaign_message", "features",
+    "layout", "mood", "call_to_action",
+)
+
+WORD = re.compile(r"\w+")
+
+
+def normalize(text: str) -> list[str]:
+    """Words of ``text`` with case, accents-as-composed, punctuation and spacing differences removed."""
+    return WORD.findall(unicodedata.normalize("NFKC", text).casefold())
+
+
+def _hash64(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def simhash(features) -> int:
+    """64-bit SimHash: each bit is set when most of the feature hashes have it set."""
+    # Column-wise bit counts over the hashes' binary strings; much faster than 64 shifts per feature
+    rows = [format(_hash64(feature), "064b") for feature in features]
+    if not rows:
+        return 0
+    majority = len(rows) / 2
+    bits = "".join("1" if column.count("1") > majority else "0" for column in map("".join, zip(*rows)))
+    return int(bits, 2)
+
+
+def fingerprint(request) -> int:
+    # Words and word pairs, tagged with their field so "blue" as a colour and
+    # "blue" in the title don't cancel out; pairs keep some word order
+    features = []
+    for field in TEXT_FIELDS:
+        value = getattr(request, field, None)
+        if not value:
+            continue
+        words = normalize(" ".join(value) if isinstance(value, list) else value)
+        features.extend(f"{field}:{word}" for word in words)
+        features.extend(f"{field}:{a} {b}" for a, b in zip(words, words[1:]))
+    return simhash(features)
+
+
+def request_scope(request) -> tuple:
+    """Requests are only similar within one user and platform, and when they ask for the same output."""
+    return (
+        request.username.strip().casefold(),
+        request.platform.strip().casefold(),
+        request.num_images if request.want_images else 0,
+        request.num_captions if request.want_captions else 0,
+    )
+
+
+class SimilarityIndex:
+    """Maps request fingerprints to result-cache keys for near-duplicate lookups.
+
+    Fingerprints are split into ``bands`` equal bit ranges, each indexed in a
+    hash table, so a lookup only compares against entries sharing at least
+    one band. With more bands than ``max_distance``, any fingerprint within
+    ``max_distance`` bits shares a band (pigeonhole), so nothing in range is
+    missed. Entries expire after ``ttl`` seconds and the least recently used
+    are dropped beyond ``max_entries``.
+    """
+
+    def __init__(self, max_distance=3, max_entries=10_000, ttl=24 * 3600):
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.bands = max(4, max_distance + 1)
+        self._width = 64 // self.bands
+        self._mask = (1 << self._width) - 1
+        self._entries = OrderedDict()  # key -> (scope, fingerprint, created)
+        self._buckets = {}  # (scope, band, value) -> {key}
+        self._lock = threading.Lock()
+
+    def _bands(self, scope, fingerprint):
+        return [(scope, band, fingerprint >> (band * self._width) & self._mask) for band in range(self.bands)]
+
+    def add(self, scope: tuple, fingerprint: int, key: str):
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (scope, fingerprint, time.time())
+            for bucket in self._bands(scope, fingerprint):
+                self._buckets.setdefault(bucket, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._discard(next(iter(self._entries)))
+
+    def lookup(self, scope: tuple, fingerprint: int) -> tuple[str, int] | None:
+        """The closest entry within ``max_distance`` as ``(key, distance)``, or None."""
+        if self.max_distance <= 0:
+            return None
+        now = time.time()
+        best = None
+        with self._lock:
+            candidates = set()
+            for bucket in self._bands(scope, fingerprint):
+                candidates.update(self._buckets.get(bucket, ()))
+            for key in candidates:
+                _, other, created = self._entries[key]
+                if now - created >= self.ttl:
+                    self._discard(key)
+                    continue
+                distance = (fingerprint ^ other).bit_count()
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (key, distance)
+            if best is not None:
+                self._entries.move_to_end(best[0])
+        return best
+
+    def discard(self, key: str):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        scope, fingerprint, _ = entry
+        for bucket in self._bands(scope, fingerprint):
+            keys = self._buckets.get(bucket)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._buckets[bucket]
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,13 @@
+import json
+
+
+def format_sse(event: str, data) -> str:
+    # One Server-Sent Events frame; data is JSON so clients can JSON.parse(e.data)
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # keep reverse proxies from buffering the stream
+}
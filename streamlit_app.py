@@ -1,9 +1,9 @@
 import streamlit as st
 import requests
-import json
-from PIL import Image
-import io
-import base64
+from requests.adapters import HTTPAdapter
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Page config
 st.set_page_config(
@@ -14,7 +14,72 @@ st.set_page_config(
 )
 
 # Backend API URL
-BACKEND_URL = "http://localhost:8000"  # Change in production
+BACKEND_URL = os.getenv("SPARK_BACKEND_URL", "http://localhost:8000").rstrip("/")
+POLL_INTERVAL = 1.0  # seconds between job status checks
+IMAGE_FETCH_WORKERS = 6
+
+# ============================================================================
+# BACKEND CLIENT - one pooled session, memoized fetches
+# ============================================================================
+
+@st.cache_resource
+def http_session():
+    # Shared by every rerun and browser session: keeps connections to the backend open
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=IMAGE_FETCH_WORKERS * 2)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def submit_job(request_data):
+    response = http_session().post(f"{BACKEND_URL}/jobs", json=request_data, timeout=10)
+    response.raise_for_status()
+    return response.json()["job_id"]
+
+
+def poll_job(job_id):
+    # Never cached: each rerun wants the latest progress
+    response = http_session().get(f"{BACKEND_URL}/jobs/{job_id}", params={"include_prompts": "false"}, timeout=10)
+    response.raise_for_status()
+    return response.json()
+
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def download_image(path):
+    # Paths are content-addressed, so a cached download never goes stale. A failure
+    # raises, and Streamlit never caches exceptions: the next rerun tries again
+    response = http_session().get(f"{BACKEND_URL}/images/{path}", timeout=30)
+    response.raise_for_status()
+    return response.content
+
+
+def fetch_images(paths):
+    """Image bytes for a campaign's paths, downloaded in parallel; failed downloads map to None."""
+    def fetch(path):
+        try:
+            return download_image(path)
+        except requests.exceptions.RequestException:
+            return None
+
+    with ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS) as pool:
+        return dict(zip(paths, pool.map(fetch, paths)))
+
+
+@st.cache_data(show_spinner=False, ttl=30)
+def recent_campaigns(username):
+    response = http_session().get(f"{BACKEND_URL}/campaigns", params={"username": username, "limit": 10}, timeout=10)
+    response.raise_for_status()
+    return response.json()["items"]
+
+
+@st.cache_data(show_spinner=False, ttl=300)
+def load_campaign(campaign_id):
+    response = http_session().get(
+        f"{BACKEND_URL}/campaigns/{campaign_id}", params={"include_prompts": "false"}, timeout=10,
+    )
+    response.raise_for_status()
+    return response.json()
 
 # Custom CSS
 st.markdown("""
@@ -51,6 +116,8 @@ if 'generated_data' not in st.session_state:
     st.session_state.generated_data = None
 if 'current_page' not in st.session_state:
     st.session_state.current_page = 'input'
+if 'job' not in st.session_state:
+    st.session_state.job = None
 
 # Header
 st.markdown('<div class="main-header">⚡ Spark Studio</div>', unsafe_allow_html=True)
@@ -70,6 +137,27 @@ with st.sidebar:
     st.markdown("---")
     st.info("💡 **Tip**: Fill in the campaign details and click Generate to create AI-powered content!")
 
+    # Recent campaigns of the last user who generated from this session
+    last_username = st.session_state.get('last_username')
+    if last_username:
+        st.markdown("---")
+        st.subheader("🕘 Recent Campaigns")
+        try:
+            campaigns = recent_campaigns(last_username)
+        except requests.exceptions.RequestException:
+            campaigns = []
+            st.caption("Campaign history is unavailable.")
+        for campaign in campaigns:
+            label = f"{campaign['platform'].title()} · {campaign['title'] or campaign['company']}"
+            if st.button(label, key=f"campaign_{campaign['id']}"):
+                stored = load_campaign(campaign['id'])
+                st.session_state.generated_data = {
+                    'result': {**stored['result'], 'campaign_id': stored['id']},
+                    'input': stored['request']
+                }
+                st.session_state.current_page = 'results'
+                st.rerun()
+
 # ============================================================================
 # INPUT PAGE - Create Campaign
 # ============================================================================
@@ -222,34 +310,55 @@ if page == "Create Campaign":
             with st.expander("🔍 Request Payload"):
                 st.json(request_data)
             
-            # Make API call
-            with st.spinner("✨ Generating your campaign... This may take a moment!"):
-                try:
-                    response = requests.post(
-                        f"{BACKEND_URL}/generate",
-                        json=request_data,
-                        timeout=120
-                    )
-                    
-                    if response.status_code == 200:
-                        result = response.json()
-                        st.session_state.generated_data = {
-                            'result': result,
-                            'input': request_data
-                        }
-                        st.session_state.current_page = 'results'
-                        st.success("🎉 Campaign generated successfully!")
-                        st.info("👉 Switch to 'View Results' in the sidebar to see your content!")
-                        
-                    else:
-                        st.error(f"❌ Error: {response.status_code} - {response.text}")
-                        
-                except requests.exceptions.Timeout:
-                    st.error("⏱️ Request timed out. The backend might be taking too long.")
-                except requests.exceptions.ConnectionError:
-                    st.error("🔌 Cannot connect to backend. Make sure it's running at " + BACKEND_URL)
-                except Exception as e:
-                    st.error(f"❌ Error: {str(e)}")
+            # Long generations run as a background job; the block below polls it
+            try:
+                job_id = submit_job(request_data)
+            except requests.exceptions.ConnectionError:
+                st.error("🔌 Cannot connect to backend. Make sure it's running at " + BACKEND_URL)
+            except requests.exceptions.HTTPError as e:
+                st.error(f"❌ Error: {e.response.status_code} - {e.response.text}")
+            except Exception as e:
+                st.error(f"❌ Error: {str(e)}")
+            else:
+                st.session_state.job = {'id': job_id, 'input': request_data}
+                st.session_state.last_username = username
+                st.rerun()
+
+    # Job progress: poll once per rerun and rerun until it finishes, so the
+    # page stays interactive instead of waiting on one long request
+    job = st.session_state.job
+    if job is not None:
+        try:
+            snapshot = poll_job(job['id'])
+        except requests.exceptions.RequestException as e:
+            st.error(f"❌ Lost track of the generation job: {str(e)}")
+            st.session_state.job = None
+        else:
+            if snapshot['status'] in ('queued', 'running'):
+                progress = snapshot['progress']
+                total = progress['images_total'] + progress['captions_total']
+                done = progress['images_done'] + progress['captions_done']
+                st.progress(
+                    done / total if total else 0.0,
+                    text=f"✨ Generating your campaign... {done}/{total} ready ({snapshot['status']})"
+                )
+                for i, caption in enumerate(snapshot['partial']['captions'], 1):
+                    st.markdown(f"**Caption {i}**")
+                    st.text(caption)
+                time.sleep(POLL_INTERVAL)
+                st.rerun()
+            elif snapshot['status'] == 'succeeded':
+                st.session_state.generated_data = {
+                    'result': snapshot['result'],
+                    'input': job['input']
+                }
+                st.session_state.job = None
+                st.session_state.current_page = 'results'
+                st.success("🎉 Campaign generated successfully!")
+                st.info("👉 Switch to 'View Results' in the sidebar to see your content!")
+            else:
+                st.session_state.job = None
+                st.error(f"❌ Error: {snapshot['error']}")
 
 # ============================================================================
 # OUTPUT PAGE - View Results
@@ -318,37 +427,26 @@ elif page == "View Results":
                 with selected_tab[tabs.index("🖼️ Images")]:
                     st.subheader(f"Generated Images ({len(result['images'])})")
                     
-                    # Display images
+                    # Display images (fetched over HTTP from the backend's /images route)
+                    images = fetch_images(tuple(result['images']))
                     cols = st.columns(min(3, len(result['images'])))
-                    
-                    for i, img_filename in enumerate(result['images']):
+
+                    for i, img_path in enumerate(result['images']):
                         with cols[i % 3]:
-                            try:
-                                # Try to load image from local path
-                                img_path = f"{input_data['username']}_generated_images/{img_filename}"
-                                
-                                st.info(f"**Image {i+1}**")
-                                st.write(f"Filename: `{img_filename}`")
-                                st.write(f"Path: `{img_path}`")
-                                
-                                # Try to display image if it exists
-                                try:
-                                    img = Image.open(img_path)
-                                    st.image(img, caption=f"Image {i+1}", use_container_width=True)
-                                except:
-                                    st.warning("Image file not found locally. Check backend logs.")
-                                    # Show placeholder
-                                    st.image("https://via.placeholder.com/512x512?text=Image+" + str(i+1))
-                                
-                                if st.button(f"⬇️ Download", key=f"download_{i}"):
-                                    st.info("Download functionality coming soon!")
-                                    
-                            except Exception as e:
-                                st.error(f"Error loading image: {str(e)}")
-                    
-                    st.markdown("---")
-                    st.info("💡 **Note**: Images are saved locally by the backend. To display them here, you may need to add a static file serving endpoint to your FastAPI backend.")
-        
+                            st.info(f"**Image {i+1}**")
+                            data = images.get(img_path)
+                            if data is None:
+                                st.warning("Image could not be loaded from the backend.")
+                                continue
+                            st.image(data, caption=f"Image {i+1}", use_container_width=True)
+                            st.download_button(
+                                "⬇️ Download",
+                                data=data,
+                                file_name=img_path.rsplit("/", 1)[-1],
+                                mime="image/png",
+                                key=f"download_{i}"
+                            )
+
         # Show raw response for debugging
         with st.expander("🔍 View Raw API Response"):
             st.json(result)
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# The app reads these paths at import time (it opens the files on first use)
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+os.environ.setdefault("SPARK_CACHE_DIR", tempfile.mkdtemp(prefix="spark-cache-"))
+os.environ.setdefault("SPARK_HISTORY_DB", os.path.join(tempfile.mkdtemp(prefix="spark-history-"), "history.db"))
+os.environ.setdefault("SPARK_RETENTION_DB", os.path.join(tempfile.mkdtemp(prefix="spark-retention-"), "images.db"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,86 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TINY_PNG_B64 = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+
+class FakeOpenAI:
+    """Local HTTP server speaking the images and chat-completions API shapes.
+
+    ``script`` is a list of ``(status, delay_seconds)`` consumed one per
+    request; once it runs out every request gets ``default``. Retry-After is
+    sent with every 429.
+    """
+
+    def __init__(self, script=None, default=(200, 0.0)):
+        self.script = list(script or [])
+        self.default = default
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next(self, path):
+        with self._lock:
+            self.requests.append(path)
+            return self.script.pop(0) if self.script else self.default
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status, delay = fake._next(self.path)
+                time.sleep(delay)
+
+                if status != 200:
+                    body = {"error": {"message": f"injected {status}", "type": "fake", "code": None}}
+                elif self.path.endswith("/images/generations"):
+                    body = {"created": int(time.time()), "data": [{"b64_json": TINY_PNG_B64}]}
+                else:
+                    body = {
+                        "id": "chatcmpl-fake",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": "fake",
+                        "choices": [{
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": "Caption 1: hello #fake"},
+                        }],
+                    }
+
+                payload = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    if status == 429:
+                        self.send_header("Retry-After", "0")
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return Handler
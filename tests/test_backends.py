@@ -0,0 +1,46 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+from backends import BackendRouter, OpenAITextBackend, Unsupported
+
+
+class DirectUpstream:
+    async def call(self, operation, fn, **kwargs):
+        return await fn(10)
+
+
+class NoSchemaCompletions:
+    def __init__(self):
+        self.calls = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if "response_format" in kwargs:
+            response = httpx.Response(400, request=httpx.Request("POST", "http://test/v1/chat/completions"))
+            raise openai.BadRequestError("Invalid parameter: 'response_format' of type 'json_schema'", response=response, body=None)
+        message = SimpleNamespace(content="Caption 1: hello #a")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def test_structured_output_rejection_is_remembered_and_not_a_health_failure():
+    completions = NoSchemaCompletions()
+    client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    backend = OpenAITextBackend(DirectUpstream(), lambda: client, "old-model")
+    router = BackendRouter([backend], min_samples=1)
+
+    async def captions():
+        try:
+            return await router.call(None, lambda b: b.complete("p", schema={"name": "captions", "schema": {}}))
+        except Unsupported:
+            return await router.call(None, lambda b: b.complete("p"))
+
+    for _ in range(3):
+        assert asyncio.run(captions()) == "Caption 1: hello #a"
+
+    # One rejected structured call, then plain calls only
+    assert ["response_format" in call for call in completions.calls] == [True, False, False, False]
+    assert router.healthy(backend.name)
+    assert router.health[backend.name].error_rate() == (0.0, 3)
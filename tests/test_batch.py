@@ -0,0 +1,87 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+import main
+from scheduler import FairScheduler
+
+CAMPAIGN = {
+    "username": "tester",
+    "platform": "linkedin",
+    "company": "Spark Studio",
+    "event": "Product Launch",
+    "title": "Introducing AI Platform",
+    "product_description": "An AI marketing platform",
+    "num_images": 1,
+    "num_captions": 2,
+    "want_images": False,
+    "want_captions": True,
+    "use_cache": False,
+}
+
+
+async def _batch(body):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.post("/generate/batch", json=body)
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    scheduler = FairScheduler(user_rpm=60, user_burst=4, max_wait=5)
+    monkeypatch.setattr(main, "scheduler", scheduler)
+    return scheduler
+
+
+def test_batch_larger_than_the_limits_admit_is_rejected(scheduler):
+    campaigns = [{**CAMPAIGN, "title": f"Launch {i}", "want_images": True, "num_images": 5} for i in range(2)]
+    response = asyncio.run(_batch({"campaigns": campaigns, "platforms": ["linkedin", "instagram"]}))
+
+    assert response.status_code == 400
+    assert scheduler.queue_depth == 0
+
+
+def test_overloaded_user_cancels_the_other_users_queued_admission(scheduler):
+    async def scenario():
+        scheduler._user_bucket("busy").tokens = -20  # ~24s away: over max_wait
+        scheduler._user_bucket("queued").tokens = 0  # ~1s away: would queue
+        response = await _batch({"campaigns": [
+            {**CAMPAIGN, "username": "busy"},
+            {**CAMPAIGN, "username": "queued"},
+        ]})
+        assert response.status_code == 429
+        # Checked before asyncio.run would cancel leftovers itself
+        assert scheduler.queue_depth == 0
+        await asyncio.sleep(1.5)
+        # Refilled from 0, so it was never charged
+        assert scheduler._user_bucket("queued").wait_time(1, time.monotonic()) == 0
+
+    asyncio.run(scenario())
+
+
+def test_crop_failures_are_numbered_by_source_image_and_stay_off_the_source(scheduler, monkeypatch):
+    async def generate(**kwargs):
+        # Image 1 of 3 failed; images 2 and 3 landed
+        return [{"original": "tester/two.png"}, {"original": "tester/three.png"}], [{"index": 1, "error": "timeout"}]
+
+    async def crop(original, size):
+        if original == "tester/three.png" and size == "1536x1024":
+            raise OSError("cannot crop")
+        return {"original": f"{original}@{size}"}
+
+    monkeypatch.setattr(main, "agenerate_image_batch", generate)
+    monkeypatch.setattr(main.image_store, "acrop", crop)
+    campaign = {**CAMPAIGN, "want_images": True, "want_captions": False, "num_images": 3}
+    response = asyncio.run(_batch({
+        "campaign": campaign, "platforms": ["linkedin", "instagram", "twitter"], "derive_crops": True,
+    }))
+
+    platforms = response.json()["campaigns"][0]["platforms"]
+    assert platforms["linkedin"]["image_errors"] == [{"index": 1, "error": "timeout"}]
+    assert platforms["instagram"]["image_errors"] == [{"index": 1, "error": "timeout"}]
+    assert platforms["twitter"]["image_errors"] == [{"index": 1, "error": "timeout"}, {"index": 3, "error": "cannot crop"}]
+    assert platforms["twitter"]["images"] == ["tester/two.png@1536x1024"]
+    # The crop's image prompt is linkedin's, so is its cacheable prefix
+    assert platforms["twitter"]["prompt_tokens"]["image"] == platforms["linkedin"]["prompt_tokens"]["image"]
@@ -0,0 +1,14 @@
+from cache import ResultCache
+
+
+def test_resetting_a_key_does_not_inflate_the_disk_size(tmp_path):
+    cache = ResultCache(directory=str(tmp_path), max_bytes=10_000)
+    cache.set("ab" * 32, {"captions": ["x" * 100]})
+    size = sum(size for _, size, _ in cache._disk_entries())
+    for _ in range(200):
+        cache.set("ab" * 32, {"captions": ["x" * 100]})
+    cache.set("cd" * 32, {"captions": ["y"]})
+
+    assert cache._disk_bytes == sum(size for _, size, _ in cache._disk_entries())
+    assert cache._disk_bytes < 2 * size + 100
+    assert cache.get("cd" * 32) is not None
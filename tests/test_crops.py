@@ -0,0 +1,62 @@
+import os
+
+from PIL import Image
+
+import main
+from cache import ResultCache
+from crops import SAFE_AREA, crop_box, derive_crop
+from image_store import CONTENT_ADDRESSED_NAME
+from models import GenerateRequest
+from similarity import SimilarityIndex
+
+
+def test_crop_box_reaches_target_ratio_when_the_safe_area_allows():
+    # Square to 4:5 portrait only trims 20% of the width
+    assert crop_box(1000, 1000, 800, 1000) == (100, 0, 900, 1000)
+
+
+def test_crop_box_never_cuts_into_the_safe_area():
+    # Portrait to landscape would need a 1024x683 crop; the safe area keeps 70% of the height
+    left, top, right, bottom = crop_box(1024, 1536, 1536, 1024)
+    assert (left, right) == (0, 1024)
+    assert bottom - top >= 1536 * SAFE_AREA
+    assert top <= 1536 * (1 - SAFE_AREA) / 2 and bottom >= 1536 * (1 + SAFE_AREA) / 2
+
+
+def test_crop_box_slides_towards_saliency_within_the_safe_area():
+    columns = [0] * 90 + [100] * 10  # all the detail at the right edge
+    left, _, right, _ = crop_box(1000, 500, 400, 500, column_weights=columns)
+    assert right == 1000 - 150  # as far right as the safe area (150..850) allows
+    assert left == right - 700
+
+    centered = crop_box(1000, 500, 400, 500, column_weights=[1] * 100)
+    assert centered[0] == 150
+
+
+def test_derive_crop_writes_a_content_addressed_image_of_the_target_size(tmp_path):
+    source = tmp_path / "source.png"
+    Image.new("RGB", (1024, 1536), (200, 30, 30)).save(source)
+
+    path = derive_crop(str(source), "1536x1024")
+    assert os.path.dirname(path) == str(tmp_path)
+    assert CONTENT_ADDRESSED_NAME.match(os.path.basename(path))
+    with Image.open(path) as im:
+        assert im.size == (1536, 1024)
+        # Padded with a blurred copy of the image, not black bars
+        assert im.getpixel((5, 512)) == (200, 30, 30)
+
+    assert derive_crop(str(source), "1536x1024") == path
+    assert derive_crop(str(source), "1024x1536") == str(source)
+
+
+def test_batch_crops_are_never_served_as_similar_results(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "result_cache", ResultCache(directory=str(tmp_path / "cache")))
+    monkeypatch.setattr(main, "similar_results", SimilarityIndex())
+    request = GenerateRequest(
+        username="tester", platform="twitter", company="Spark Studio", event="Launch",
+        title="Introducing AI Platform", product_description="An AI marketing platform", allow_similar=True,
+    )
+    main.remember_result(request, "crop-key", {"images": [], "cropped_from": "linkedin"})
+
+    assert main.cached_result(request, "crop-key")[1] == {"cache": "hit"}
+    assert main.cached_result(request, "plain-key") == (None, None)
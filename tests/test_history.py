@@ -0,0 +1,45 @@
+import json
+import sqlite3
+
+from history_store import CampaignStore
+
+RESULT = {
+    "images": ["u_generated_images/a.png"],
+    "image_variants": [{"original": "u_generated_images/a.png", "thumbnail": "u_generated_images/a_thumb.webp"}],
+    "captions": ["one", "two"],
+}
+
+
+def test_platform_aliases_are_one_platform(tmp_path):
+    store = CampaignStore(str(tmp_path / "history.db"))
+    store.add_many([({"username": "u", "platform": "X"}, RESULT), ({"username": "u", "platform": "twitter"}, RESULT)])
+
+    assert store.stats()["by_platform"] == {"twitter": 2}
+    assert len(store.list(platform="x")["items"]) == 2
+
+
+def test_list_reads_the_preview_column_not_the_result(tmp_path):
+    store = CampaignStore(str(tmp_path / "history.db"))
+    campaign_id = store.add({"username": "u", "platform": "linkedin"}, RESULT)
+    store._connect().execute("UPDATE campaigns SET result = 'not json' WHERE id = ?", (campaign_id,))
+
+    assert store.list()["items"][0]["preview"] == "u_generated_images/a_thumb.webp"
+
+
+def test_databases_without_a_preview_column_are_migrated(tmp_path):
+    path = str(tmp_path / "history.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE campaigns (id TEXT PRIMARY KEY, username TEXT NOT NULL, platform TEXT NOT NULL,"
+        " company TEXT NOT NULL, title TEXT NOT NULL, created_at REAL NOT NULL, num_images INTEGER NOT NULL,"
+        " num_captions INTEGER NOT NULL, request TEXT NOT NULL, result TEXT NOT NULL)"
+    )
+    conn.execute(
+        "INSERT INTO campaigns VALUES ('old', 'u', 'x', 'Acme', 'T', 1.0, 1, 2, '{}', ?)", (json.dumps(RESULT),)
+    )
+    conn.commit()
+    conn.close()
+
+    item = CampaignStore(path).list(platform="twitter")["items"][0]
+    assert item["platform"] == "twitter"
+    assert item["preview"] == "u_generated_images/a_thumb.webp"
@@ -0,0 +1,102 @@
+import json
+import os
+
+import pytest
+
+import main
+from models import GenerateRequest
+from prompt import (
+    PlatformRules,
+    build_caption_prompt,
+    build_image_prompt,
+    get_platform_rules,
+    prompt_token_counts,
+    register_platform,
+    registered_platforms,
+)
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), "data", "prompt_golden.json")
+
+with open(GOLDEN_PATH, encoding="utf-8") as f:
+    GOLDEN = json.load(f)
+
+
+def _caption_prompt(req):
+    return build_caption_prompt(
+        req.platform, req.company, req.event, req.title, req.product_description,
+        req.num_captions, req.Target_audience, req.Product, req.call_to_action,
+    )
+
+
+@pytest.mark.parametrize("case", GOLDEN, ids=lambda c: f"{c['request']['platform'] or 'default'}-{c['request']['num_captions']}")
+def test_prompts_are_byte_identical_to_golden(case):
+    req = GenerateRequest(**case["request"])
+
+    assert build_image_prompt(req) == case["image_prompt"]
+    assert _caption_prompt(req) == case["caption_prompt"]
+
+
+def test_default_sizes_come_from_the_registry():
+    assert main.default_size_for_platform("linkedin") == "1024x1536"
+    assert main.default_size_for_platform("Instagram") == "1024x1536"
+    assert main.default_size_for_platform("twitter") == "1536x1024"
+    assert main.default_size_for_platform("X") == "1536x1024"
+    assert main.default_size_for_platform("facebook") == "1024x1024"
+
+
+def test_custom_platform_registration():
+    register_platform(PlatformRules(
+        name="threads-test",
+        aliases=("th-test",),
+        image_style=" Casual {candid} look.",
+        caption_intro="Write {n} Threads posts for: ",
+        caption_rules="- Conversational\n",
+        default_size="1024x1024",
+    ))
+    req = GenerateRequest(
+        username="u", platform="TH-TEST", company="Acme", event="Launch",
+        title="New", product_description="Widgets", num_captions=2,
+    )
+
+    assert get_platform_rules("th-test").name == "threads-test"
+    assert "Platform look: Casual {candid} look.\n" in build_image_prompt(req)
+    caption_prompt = _caption_prompt(req)
+    assert caption_prompt.startswith("Caption guidelines:\n- Conversational\n")
+    assert caption_prompt.endswith("Write 2 Threads posts for: Acme — Launch. Title: New. Details: Widgets.\n\nWrite EXACTLY 2 complete captions.")
+
+
+@pytest.mark.parametrize("platform", registered_platforms() + ["default"])
+def test_static_prefix_is_shared_across_requests(platform):
+    first = GenerateRequest(
+        username="a", platform=platform, company="Acme", event="Launch", title="Widgets",
+        product_description="Fast widgets", num_captions=2, Style="flat", mood="calm", color="red",
+    )
+    second = GenerateRequest(
+        username="b", platform=platform, company="Globex", event="Summer sale", title="Gadgets",
+        product_description="Durable gadgets for everyone", num_captions=5, Target_audience="Parents",
+        call_to_action="Shop now",
+    )
+    rules = get_platform_rules(platform)
+
+    for template, build in ((rules.image_template, build_image_prompt), (rules.caption_template, _caption_prompt)):
+        prefix = template.prefix
+        assert build(first).startswith(prefix)
+        assert build(second).startswith(prefix)
+        # The campaign's fields come after the shared prefix, never in it
+        for value in ("Acme", "Globex", "Widgets", "Gadgets", "Fast widgets", "Parents"):
+            assert value not in prefix
+
+    assert rules.caption_rules in rules.caption_template.prefix
+    assert rules.image_style in rules.image_template.prefix
+
+
+def test_prompt_token_counts():
+    req = GenerateRequest(
+        username="u", platform="linkedin", company="Acme", event="Launch",
+        title="New", product_description="Widgets", num_captions=2,
+    )
+    counts = prompt_token_counts(req.platform, build_image_prompt(req), _caption_prompt(req))
+
+    for kind in ("image", "caption"):
+        assert 0 < counts[kind]["static_prefix"] < counts[kind]["total"]
+    assert prompt_token_counts(req.platform, None, None) == {}
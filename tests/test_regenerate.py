@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+
+import main
+from history_store import CampaignStore
+from models import GenerateRequest
+from scheduler import FairScheduler
+
+REQUEST = GenerateRequest(
+    username="tester", platform="linkedin", company="Spark Studio", event="Product Launch",
+    title="Introducing AI Platform", product_description="An AI marketing platform",
+    num_images=3, want_images=True, want_captions=False,
+).model_dump()
+
+
+def _variant(name):
+    return {"original": f"tester_generated_images/{name}.png"}
+
+
+async def _regenerate(campaign_id, body):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        return await client.post(f"/campaigns/{campaign_id}/regenerate", json=body)
+
+
+def test_regenerating_a_failed_image_fills_its_slot(monkeypatch, tmp_path):
+    history = CampaignStore(str(tmp_path / "history.db"))
+    monkeypatch.setattr(main, "history", history)
+    monkeypatch.setattr(main, "scheduler", FairScheduler(user_rpm=600, user_burst=10))
+
+    async def fresh(**kwargs):
+        return [_variant("new") for _ in range(kwargs["n"])], []
+
+    monkeypatch.setattr(main, "agenerate_image_batch", fresh)
+    # Image 2 of 3 failed, so the stored list holds images 1 and 3
+    campaign_id = history.add(REQUEST, {
+        "image_prompt": "A launch poster",
+        "caption_prompt": None,
+        "size": "1024x1024",
+        "images": [_variant("one")["original"], _variant("three")["original"]],
+        "image_variants": [_variant("one"), _variant("three")],
+        "image_errors": [{"index": 2, "error": "upstream timeout"}],
+    })
+
+    response = asyncio.run(_regenerate(campaign_id, {"images": [2]}))
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["regenerated"]["images"] == [2]
+    assert body["images"] == [f"tester_generated_images/{name}.png" for name in ("one", "new", "three")]
+    assert "image_errors" not in body
+    assert history.get(campaign_id)["result"]["images"] == body["images"]
@@ -0,0 +1,37 @@
+import time
+
+from scheduler import FairScheduler
+from shared_state import SharedState
+
+
+def test_buckets_in_two_processes_share_one_level(tmp_path):
+    # Two SharedState objects on one file stand in for two worker processes
+    path = str(tmp_path / "state.db")
+    first, second = SharedState(path), SharedState(path)
+    a = first.bucket("requests", rate=0.001, capacity=10)
+    b = second.bucket("requests", rate=0.001, capacity=10)
+
+    now = time.monotonic()
+    a.take(6, now)
+    assert b.wait_time(6, now) == 0  # not synced yet: the other process can't know
+
+    first.sync_buckets()
+    second.sync_buckets()
+    assert round(b.tokens) == 4
+    assert b.wait_time(6, time.monotonic()) > 0
+
+    b.take(3, time.monotonic())
+    second.sync_buckets()
+    first.sync_buckets()
+    assert round(a.tokens) == 1
+    assert a.consumed == b.consumed == 0
+
+
+def test_scheduler_admission_does_not_touch_sqlite(tmp_path):
+    state = SharedState(str(tmp_path / "missing-dir" / "state.db"))
+    scheduler = FairScheduler(rpm=60, tpm=6000, bucket=state.bucket)
+
+    # The file can't even be created: admission still works from the local levels
+    assert scheduler.estimated_wait("alice", 1, 10) == 0
+    scheduler.requests.take(1, time.monotonic())
+    assert scheduler.requests.consumed == 1
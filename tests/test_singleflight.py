@@ -0,0 +1,133 @@
+import asyncio
+import base64
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import generator
+import main
+from cache import ResultCache
+from singleflight import SingleFlight
+
+CAMPAIGN = {
+    "username": "tester",
+    "platform": "linkedin",
+    "company": "Spark Studio",
+    "event": "Product Launch",
+    "title": "Introducing AI Platform",
+    "product_description": "An AI marketing platform",
+    "num_images": 1,
+    "num_captions": 2,
+    "want_images": True,
+    "want_captions": True,
+}
+
+# Within both the LinkedIn (3-8) and Instagram (8-15) hashtag ranges, so no caption needs repair
+HASHTAGS = ["#a", "#b", "#c", "#d", "#e", "#f", "#g", "#h"]
+
+
+class StubImages:
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+
+    async def generate(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        payload = base64.b64encode(f"png-{self.calls}".encode()).decode()
+        return SimpleNamespace(data=[SimpleNamespace(b64_json=payload)])
+
+
+class StubCompletions:
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        message = SimpleNamespace(content=json.dumps({"captions": [
+            {"body": "first", "hashtags": HASHTAGS},
+            {"body": "second", "hashtags": HASHTAGS},
+        ]}))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+@pytest.fixture
+def backend(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "result_cache", ResultCache(directory=str(tmp_path / "cache")))
+    monkeypatch.setattr(main, "inflight", SingleFlight())
+
+    stub = SimpleNamespace(images=StubImages(0.2), chat=SimpleNamespace(completions=StubCompletions(0.2)))
+    monkeypatch.setattr(generator, "async_client", stub)
+    return stub
+
+
+async def _fire(payloads):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        responses = await asyncio.gather(*(client.post("/generate", json=p) for p in payloads))
+    return [r.json() for r in responses]
+
+
+def test_identical_concurrent_requests_share_one_upstream_call(backend):
+    results = asyncio.run(_fire([CAMPAIGN] * 10))
+
+    assert backend.images.calls == 1
+    assert backend.chat.completions.calls == 1
+    assert [r["cache"] for r in results].count("miss") == 1
+    assert [r["cache"] for r in results].count("coalesced") == 9
+    assert all(r["images"] == results[0]["images"] for r in results)
+    tags = " ".join(HASHTAGS)
+    assert all(r["captions"] == [f"first\n\n{tags}", f"second\n\n{tags}"] for r in results)
+
+
+def test_coalescing_applies_to_cache_bypass_requests(backend):
+    asyncio.run(_fire([{**CAMPAIGN, "use_cache": False}] * 5))
+
+    assert backend.images.calls == 1
+    assert backend.chat.completions.calls == 1
+
+
+def test_different_fingerprints_are_not_coalesced(backend):
+    results = asyncio.run(_fire([CAMPAIGN, {**CAMPAIGN, "platform": "instagram"}]))
+
+    assert backend.images.calls == 2
+    assert backend.chat.completions.calls == 2
+    assert {r["cache"] for r in results} == {"miss"}
+
+
+def test_different_users_are_not_coalesced_or_served_each_others_files(backend):
+    results = asyncio.run(_fire([CAMPAIGN, {**CAMPAIGN, "username": "other"}]))
+
+    assert backend.images.calls == 2
+    assert {r["cache"] for r in results} == {"miss"}
+    assert results[1]["images"][0].startswith("other_generated_images/")
+
+    again = asyncio.run(_fire([{**CAMPAIGN, "username": "other"}]))
+    assert again[0]["cache"] == "hit"
+    assert again[0]["images"] == results[1]["images"]
+
+
+def test_failure_is_shared_and_flight_is_cleared():
+    flight = SingleFlight()
+    calls = 0
+
+    async def boom():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        raise RuntimeError("upstream down")
+
+    async def scenario():
+        outcomes = await asyncio.gather(*(flight.do("k", boom) for _ in range(4)), return_exceptions=True)
+        assert all(isinstance(o, RuntimeError) for o in outcomes)
+        assert len(flight) == 0
+        with pytest.raises(RuntimeError):
+            await flight.do("k", boom)
+
+    asyncio.run(scenario())
+    assert calls == 2
@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+from fake_openai import FakeOpenAI
+from upstream import CircuitOpenError, DeadlineExceeded, ResilientClient, RetryPolicy, request_deadline
+
+
+def _client(fake, **kwargs):
+    kwargs.setdefault("retry", RetryPolicy(max_attempts=3, base_delay=0.01, max_delay=0.05))
+    return ResilientClient(api_key="test-key", base_url=fake.base_url, **kwargs)
+
+
+async def _image(client, **call_kwargs):
+    try:
+        return await client.call("images", lambda timeout: client.openai.images.generate(
+            model="dall-e-3", prompt="p", n=1, size="1024x1024", response_format="b64_json", timeout=timeout,
+        ), **call_kwargs)
+    finally:
+        await client.aclose()
+
+
+def test_retries_429_and_5xx_then_succeeds():
+    with FakeOpenAI(script=[(429, 0), (503, 0)]) as fake:
+        response = asyncio.run(_image(_client(fake)))
+
+    assert response.data[0].b64_json
+    assert len(fake.requests) == 3
+
+
+def test_client_errors_are_not_retried():
+    with FakeOpenAI(script=[(400, 0)]) as fake:
+        with pytest.raises(openai.BadRequestError):
+            asyncio.run(_image(_client(fake)))
+
+    assert len(fake.requests) == 1
+
+
+def test_gives_up_after_max_attempts():
+    with FakeOpenAI(default=(500, 0)) as fake:
+        with pytest.raises(openai.InternalServerError):
+            asyncio.run(_image(_client(fake)))
+
+    assert len(fake.requests) == 3
+
+
+def test_circuit_opens_and_fails_fast():
+    async def scenario(fake):
+        client = _client(fake, retry=RetryPolicy(max_attempts=1), breaker_threshold=2, breaker_reset=60)
+        call = lambda timeout: client.openai.images.generate(model="dall-e-3", prompt="p", timeout=timeout)
+        try:
+            for _ in range(2):
+                with pytest.raises(openai.InternalServerError):
+                    await client.call("images", call)
+            with pytest.raises(CircuitOpenError):
+                await client.call("images", call)
+        finally:
+            await client.aclose()
+
+    with FakeOpenAI(default=(500, 0)) as fake:
+        asyncio.run(scenario(fake))
+
+    assert len(fake.requests) == 2
+
+
+def test_cancelled_half_open_probe_lets_the_next_call_probe():
+    async def scenario():
+        client = ResilientClient(api_key="test-key", retry=RetryPolicy(max_attempts=1), breaker_threshold=1, breaker_reset=0)
+        breaker = client.breaker("images")
+        breaker.record_failure()
+
+        async def hang(timeout):
+            await asyncio.sleep(60)
+
+        probe = asyncio.create_task(client.call("images", hang, hedge=False))
+        await asyncio.sleep(0.01)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        async def ok(timeout):
+            return "ok"
+
+        assert await client.call("images", ok, hedge=False) == "ok"
+        assert breaker.state == breaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_per_call_timeout_follows_request_deadline():
+    async def scenario(client):
+        with request_deadline(0.3):
+            await _image(client)
+
+    with FakeOpenAI(default=(200, 2.0)) as fake:
+        started = time.monotonic()
+        with pytest.raises((asyncio.TimeoutError, openai.APITimeoutError, DeadlineExceeded)):
+            asyncio.run(scenario(_client(fake)))
+        elapsed = time.monotonic() - started
+
+    assert elapsed < 1.5
+
+
+def test_hedged_request_beats_a_slow_primary():
+    async def scenario(fake):
+        client = _client(fake, hedge_percentile=0.9, hedge_min_samples=5)
+        for _ in range(5):
+            client.latency("images").add(0.05)
+        started = time.monotonic()
+        response = await _image(client)
+        return response, time.monotonic() - started
+
+    with FakeOpenAI(script=[(200, 1.5)], default=(200, 0.0)) as fake:
+        response, elapsed = asyncio.run(scenario(fake))
+
+    assert response.data[0].b64_json
+    assert len(fake.requests) == 2
+    assert elapsed < 1.0
@@ -0,0 +1,321 @@
+import asyncio
+import contextvars
+import os
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+from metrics import UPSTREAM_ERRORS, UPSTREAM_IN_FLIGHT, UPSTREAM_RETRIES, record_stage
+
+# Absolute time.monotonic() by which the current request must be answered
+_deadline = contextvars.ContextVar("upstream_deadline", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Upstream temporarily unavailable; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+@contextmanager
+def request_deadline(seconds: float | None):
+    """Bound every upstream call made inside the block (including retries) to ``seconds`` from now."""
+    if not seconds:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time() -> float | None:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+# ===================================================================
+# RETRY POLICY
+# ===================================================================
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, RETRYABLE_ERRORS):
+        return True
+    return isinstance(exc, openai.APIStatusError) and exc.status_code >= 500
+
+
+def retry_after_seconds(exc: BaseException) -> float | None:
+    response = getattr(exc, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 3
+    base_delay: float = 0.5
+    max_delay: float = 8.0
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float:
+        # "Full jitter" exponential backoff; a server-provided Retry-After wins if longer
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(backoff, min(retry_after or 0, self.max_delay))
+
+
+# ===================================================================
+# CIRCUIT BREAKER
+# ===================================================================
+
+class CircuitBreaker:
+    """Fail fast after ``failure_threshold`` consecutive upstream failures.
+
+    After ``reset_timeout`` seconds one probe call is let through (half-open);
+    its success closes the circuit, its failure opens it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def before_call(self):
+        if self.state == self.CLOSED:
+            return
+        elapsed = time.monotonic() - self.opened_at
+        if self.state == self.OPEN and elapsed >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return
+        raise CircuitOpenError(max(0.0, self.reset_timeout - elapsed))
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+    def record_abandoned(self):
+        # A call cancelled before it finished says nothing about the upstream's health;
+        # if it was the half-open probe, let the next call probe instead
+        self._probing = False
+
+
+# ===================================================================
+# LATENCY TRACKING (for hedging)
+# ===================================================================
+
+class LatencyWindow:
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# ===================================================================
+# CLIENT
+# ===================================================================
+
+class ResilientClient:
+    """OpenAI client wrapper: tuned connection pool, deadlines, retries, hedging and a circuit breaker.
+
+    ``call(operation, fn)`` runs ``fn(timeout)`` — a coroutine factory that
+    performs one upstream request with the given per-attempt timeout — under
+    the policy. Each operation name gets its own latency window and breaker.
+    """
+
+    def __init__(
+        self,
+        api_key=None,
+        base_url=None,
+        *,
+        max_connections=100,
+        max_keepalive_connections=20,
+        keepalive_expiry=30.0,
+        connect_timeout=5.0,
+        call_timeout=90.0,
+        retry=None,
+        hedge_percentile=None,
+        hedge_min_samples=20,
+        breaker_threshold=5,
+        breaker_reset=30.0,
+    ):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(call_timeout, connect=connect_timeout)
+        self._http = None
+        self._openai = None
+        self._pid = None
+        self.call_timeout = call_timeout
+        self.retry = retry or RetryPolicy()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.breakers = {}
+        self.latencies = {}
+
+    @property
+    def openai(self) -> AsyncOpenAI:
+        # Built on first use, and again in each forked worker: with a preloaded
+        # app the import happens in the master, and a connection pool must
+        # never be shared between processes
+        if self._openai is None or self._pid != os.getpid():
+            self._http = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+            # Retries are ours (jittered, deadline-aware); the SDK's own would double them up
+            self._openai = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=self._http, max_retries=0)
+            self._pid = os.getpid()
+        return self._openai
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        self.openai
+        return self._http
+
+    def breaker(self, operation: str) -> CircuitBreaker:
+        if operation not in self.breakers:
+            self.breakers[operation] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+        return self.breakers[operation]
+
+    def latency(self, operation: str) -> LatencyWindow:
+        if operation not in self.latencies:
+            self.latencies[operation] = LatencyWindow()
+        return self.latencies[operation]
+
+    def _attempt_timeout(self) -> float:
+        remaining = remaining_time()
+        if remaining is None:
+            return self.call_timeout
+        if remaining <= 0:
+            raise DeadlineExceeded("Request deadline exceeded before upstream call")
+        return min(self.call_timeout, remaining)
+
+    async def call(self, operation: str, fn, *, hedge: bool = True):
+        breaker = self.breaker(operation)
+        attempt = 0
+        while True:
+            breaker.before_call()
+            timeout = self._attempt_timeout()
+            try:
+                result = await self._timed(operation, fn, timeout, hedge)
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(operation=operation, error=type(e).__name__)
+                retryable = is_retryable(e) or isinstance(e, asyncio.TimeoutError)
+                if retryable:
+                    breaker.record_failure()
+                else:
+                    # 4xx means the request was wrong, not that the upstream is unhealthy
+                    breaker.record_success()
+                attempt += 1
+                if not retryable or attempt >= self.retry.max_attempts:
+                    raise
+                delay = self.retry.delay(attempt - 1, retry_after_seconds(e))
+                remaining = remaining_time()
+                if remaining is not None and delay >= remaining:
+                    raise
+                UPSTREAM_RETRIES.inc(operation=operation)
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled (client disconnect, job stopped) or interrupted
+                breaker.record_abandoned()
+                raise
+            breaker.record_success()
+            return result
+
+    async def _timed(self, operation, fn, timeout, hedge):
+        started = time.monotonic()
+        hedge_after = self._hedge_delay(operation) if hedge else None
+        try:
+            with UPSTREAM_IN_FLIGHT.track(operation=operation):
+                if hedge_after is None or hedge_after >= timeout:
+                    result = await asyncio.wait_for(fn(timeout), timeout)
+                else:
+                    result = await asyncio.wait_for(self._hedged(fn, timeout, hedge_after), timeout)
+        finally:
+            record_stage(f"upstream_{operation}", time.monotonic() - started)
+        self.latency(operation).add(time.monotonic() - started)
+        return result
+
+    def _hedge_delay(self, operation):
+        if self.hedge_percentile is None:
+            return None
+        window = self.latency(operation)
+        if len(window) < self.hedge_min_samples:
+            return None
+        return window.percentile(self.hedge_percentile)
+
+    async def _hedged(self, fn, timeout, hedge_after):
+        # Start a duplicate once the primary is slower than the tracked percentile; first success wins
+        primary = asyncio.ensure_future(fn(timeout))
+        done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        backup = asyncio.ensure_future(fn(max(0.001, timeout - hedge_after)))
+        pending = {primary, backup}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def aclose(self):
+        if self._http is not None and self._pid == os.getpid():
+            await self._http.aclose()
+        self._http = self._openai = None